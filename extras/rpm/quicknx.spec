@@ -81,6 +81,7 @@ if [ $1 -eq 1 ]; then
     %__install -d -m 700 -o nx -g nx %nx_homedir/.ssh/
     %__install -D -m 600 -o nx -g nx %_datadir/%{name}/authorized_keys.nomachine %nx_homedir/.ssh/authorized_keys
 fi
+chown nx:nx %_var/lib/%{name}/broker
 /sbin/chkconfig --add quicknx
 /sbin/service quicknx start > /dev/null 2>&1
 
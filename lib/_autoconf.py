@@ -0,0 +1,9 @@
+PACKAGE_VERSION = '0.3.1'
+VERSION_MAJOR = '0'
+VERSION_MINOR = '3'
+VERSION_REVISION = '1'
+VERSION_SUFFIX = ''
+VERSION_FULL = '0.3.1'
+LOCALSTATEDIR = '/var'
+SYSCONFDIR = '/etc'
+PKGLIBDIR = '/usr/lib/quicknx'
@@ -38,6 +38,7 @@ from io import StringIO
 from quicknx import constants
 from quicknx import daemon
 from quicknx import errors
+from quicknx import metrics
 from quicknx import protocol
 from quicknx import utils
 
@@ -60,6 +61,14 @@ _STATUS_MAP = {
     re.compile(r"^Session:\s+Session\s+(terminat|abort)ed\s+at\s+"),
   }
 
+_STATE_PHASES = {
+  constants.SESS_STATE_STARTING: constants.PHASE_SESSION_STARTING,
+  constants.SESS_STATE_WAITING: constants.PHASE_SESSION_WAITING,
+  }
+
+_SESSIONS = metrics.REGISTRY.GetGauge("quicknx_sessions",
+                                     "Number of sessions by state")
+
 _WATCHDOG_PID_RE = re.compile(r"^Info:\s+Watchdog\s+running\s+with\s+pid\s+"
                               r"'(?P<pid>\d+)'\.")
 _WAIT_WATCHDOG_RE = re.compile(r"^Info:\s+Waiting\s+the\s+watchdog\s+"
@@ -77,7 +86,7 @@ class UserApplication(daemon.Program):
   """Wraps the user-defined application.
 
   """
-  def __init__(self, env, cwd, args, logfile, login=False):
+  def __init__(self, env, cwd, args, logfile, login=False, lang=None):
     """Initializes this class.
 
     @type env: dict
@@ -90,6 +99,8 @@ class UserApplication(daemon.Program):
     @param logfile: Path to application logfile
     @type login: boolean
     @param login: Run the command as a login shell
+    @type lang: str or None
+    @param lang: Language, overrides LANG in the environment
 
     """
     if login:
@@ -99,7 +110,6 @@ class UserApplication(daemon.Program):
     else:
       executable = None
 
-    lang = self._GetLangEnv(env)
     if lang:
       env['LANG'] = lang
 
@@ -109,30 +119,6 @@ class UserApplication(daemon.Program):
                             executable=executable,
                             umask=constants.DEFAULT_APP_UMASK)
 
-  def _GetLangEnv(self, env):
-    lang_rx = re.compile("^\s*Language\s*=\s*(?P<lang>\S+)\s*$", re.M)
-    dmrc_path = os.path.expanduser("~/.dmrc")
-
-    if not os.path.exists(dmrc_path):
-      logging.debug("Dmrc doesn't exist")
-      return
-    logging.debug("Dmrc exists")
-
-    try:
-      contents = open(dmrc_path).read()
-    except IOError as err:
-      logging.warning("Error reading %r: %r", dmrc_path, err.strerror)
-      return
-
-    m = lang_rx.match(contents)
-    if not m:
-      logging.debug("Dmrc doesn't contain Language setting")
-      return
-
-    lang = m.group("lang")
-    logging.debug("Dmrc language setting %r", lang)
-    return lang
-
 
 class XAuthProgram(daemon.Program):
   """Wrapper for xauth.
@@ -244,6 +230,7 @@ class NxAgentProgram(daemon.Program):
     self._agent_pid = None
     self._watchdog_pid = None
     self._want_restore = False
+    self._options_written = False
 
     daemon.Program.__init__(self, args, env=env)
 
@@ -253,6 +240,16 @@ class NxAgentProgram(daemon.Program):
                                 self.stderr_line.connect(signal_name,
                                                          self._HandleStderrLine))
 
+  def PrepareStart(self):
+    """Writes the options file ahead of L{Start}.
+
+    This can be done while other programs needed for the session (e.g. xauth)
+    are still running.
+
+    """
+    self._UpdateOptionsFile()
+    self._options_written = True
+
   def Start(self):
     """Starts nxagent.
 
@@ -260,7 +257,8 @@ class NxAgentProgram(daemon.Program):
 
     """
     # Ensure options file exists
-    self._UpdateOptionsFile()
+    if not self._options_written:
+      self._UpdateOptionsFile()
 
     pid = daemon.Program.Start(self)
     self._agent_pid = pid
@@ -461,6 +459,13 @@ class NxAgentProgram(daemon.Program):
           new == constants.SESS_STATE_TERMINATED):
       logging.info("Nxagent terminated")
 
+    if new in _STATE_PHASES:
+      sess.MarkPhase(_STATE_PHASES[new])
+
+    if new != old:
+      _SESSIONS.Set(0, labels={"state": old})
+      _SESSIONS.Set(1, labels={"state": new})
+
     sess.state = new
     sess.Save()
 
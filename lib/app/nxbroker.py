@@ -0,0 +1,100 @@
+#
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""nxbroker program.
+
+Long-running daemon of the nx user serving logins passed to it by
+nxbroker-client. The configuration is parsed and all modules needed for a
+login are loaded once; every connection is served by a forked child running
+the same code as nxserver-login.
+
+"""
+
+
+import importlib
+import logging
+import signal
+
+from quicknx import broker
+from quicknx import cli
+from quicknx import constants
+from quicknx import errors
+from quicknx import utils
+from quicknx.app import nxserver_login
+
+auth = utils.LazyModule("quicknx.auth")
+
+
+PROGRAM = "nxbroker"
+
+# Loaded lazily by nxserver-login, but needed by most logins
+_PRELOAD_MODULES = [
+  "ctypes.util",
+  "pexpect",
+  "quicknx.auth",
+  ]
+
+
+class NxBrokerProgram(cli.GenericProgram):
+  def Run(self):
+    if utils.GetCurrentUserName() != constants.NXUSER:
+      raise errors.BrokerError("%s must run as user %s" %
+                               (PROGRAM, constants.NXUSER))
+
+    for name in _PRELOAD_MODULES:
+      importlib.import_module(name)
+
+    auth.CheckPrivileges(self.cfg)
+
+    def _Reload():
+      logging.info("Reloading configuration")
+      try:
+        self.LoadConfig()
+      except Exception:
+        logging.exception("Failed to reload configuration, keeping old one")
+
+    # Connections use the configuration loaded at the time they're accepted
+    server = broker.BrokerServer(constants.BROKER_SOCKET,
+                                 lambda: nxserver_login.RunLogin(self.cfg),
+                                 reload_fn=_Reload)
+
+    # Signal handlers only set flags, the work is done by server.Run
+    def _Stop(signum, _):
+      server.Stop()
+
+    def _RequestReload(signum, _):
+      server.RequestReload()
+
+    signal.signal(signal.SIGTERM, _Stop)
+    signal.signal(signal.SIGINT, _Stop)
+    signal.signal(signal.SIGHUP, _RequestReload)
+
+    server.Start()
+    try:
+      server.Run()
+    finally:
+      logging.info("Stopping")
+      server.Close()
+
+
+def Main():
+  logsetup = utils.LoggingSetup(PROGRAM)
+  NxBrokerProgram(logsetup).Main()
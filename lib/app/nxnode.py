@@ -28,20 +28,22 @@ via a Unix socket and updates the session database based on nxagent's output.
 
 
 import logging
-import pwd
 import select
 import signal
 import socket
 import sys
+import time
 import gobject
 
 from quicknx import cli
 from quicknx import constants
 from quicknx import daemon
 from quicknx import errors
+from quicknx import metrics
 from quicknx import node
 from quicknx import serializer
 from quicknx import session
+from quicknx import userdb
 from quicknx import utils
 
 
@@ -49,6 +51,10 @@ PROGRAM = "nxnode"
 
 _SESSION_START_TIMEOUT = 30
 
+_RPC_SECONDS = \
+  metrics.REGISTRY.GetHistogram("quicknx_node_rpc_seconds",
+                                "Time needed by nxnode to handle an RPC")
+
 
 class NxNodeContext(object):
   def __init__(self):
@@ -62,10 +68,6 @@ class NxNodeContext(object):
     self.processes = None
 
 
-def _GetUserUid(username):
-  return pwd.getpwnam(username).pw_uid
-
-
 def ValidateRequest(req):
   if not (isinstance(req, dict) and
           node.REQ_FIELD_CMD in req and
@@ -77,15 +79,15 @@ class ClientOperations(object):
   def __init__(self, ctx):
     self._ctx = ctx
 
-  def __call__(self, cmd, args):
+  def __call__(self, cmd, args, phases=None):
     logging.info("Received request: %r, %r", cmd, args)
 
     if cmd == node.CMD_STARTSESSION:
-      return self._StartSession(args)
+      return self._StartSession(args, phases)
 
     elif cmd == node.CMD_ATTACHSESSION:
       assert len(args) == 2
-      return self._AttachSession(args[0], args[1])
+      return self._AttachSession(args[0], args[1], phases)
 
     elif cmd == node.CMD_RESTORESESSION:
       return self._RestoreSession(args)
@@ -96,32 +98,39 @@ class ClientOperations(object):
     elif cmd == node.CMD_GET_SHADOW_COOKIE:
       return self._GetShadowCookie()
 
+    elif cmd == node.CMD_GET_METRICS:
+      return self._GetMetrics()
+
     else:
       raise errors.GenericError("Unknown command %r", cmd)
 
-  def _StartSession(self, args):
+  def _StartSession(self, args, phases):
     """Starts a new session.
 
     @type args: dict
     @param args: Arguments passed to command by client
+    @type phases: dict
+    @param phases: Startup phases recorded by nxserver
 
     """
-    return self._StartSessionInner(args, None)
+    return self._StartSessionInner(args, None, phases)
 
-  def _AttachSession(self, args, shadowcookie):
+  def _AttachSession(self, args, shadowcookie, phases):
     """Attaches to an existing session, shadowing it.
 
     @type args: dict
     @param args: Arguments passed to command by client
     @type shadowcookie: str
     @param shadowcookie: Session cookie for session to be shadowed
+    @type phases: dict
+    @param phases: Startup phases recorded by nxserver
 
     """
     assert shadowcookie
     logging.debug("Attaching to session with shadowcookie %r", shadowcookie)
-    return self._StartSessionInner(args, shadowcookie)
+    return self._StartSessionInner(args, shadowcookie, phases)
 
-  def _StartSessionInner(self, args, shadowcookie):
+  def _StartSessionInner(self, args, shadowcookie, phases):
     ctx = self._ctx
 
     if ctx.sessrunner:
@@ -129,6 +138,9 @@ class ClientOperations(object):
 
     ctx.session = node.NodeSession(ctx, args)
 
+    if isinstance(phases, dict):
+      ctx.session.AddPhases(phases)
+
     if shadowcookie:
       ctx.session.SetShadowCookie(shadowcookie)
 
@@ -181,6 +193,15 @@ class ClientOperations(object):
     # themselves can access the node socket.
     return ctx.session.cookie
 
+  def _GetMetrics(self):
+    """Returns the metrics of this nxnode.
+
+    @rtype: str
+    @return: Metrics in the text format
+
+    """
+    return metrics.REGISTRY.FormatText()
+
 
 class ClientConnection:
   def __init__(self, ctx):
@@ -206,6 +227,8 @@ class ClientConnection:
     pass
 
   def __HandleSlice(self, _, data):
+    start = time.time()
+    cmd = None
     success = False
     try:
       req = serializer.LoadJson(data)
@@ -213,19 +236,20 @@ class ClientConnection:
 
       cmd = req[node.REQ_FIELD_CMD]
       args = req[node.REQ_FIELD_ARGS]
+      phases = req.get(node.REQ_FIELD_PHASES)
 
       # Call function
-      result = self._ops(cmd, args)
+      result = self._ops(cmd, args, phases=phases)
       success = True
 
     except (SystemExit, KeyboardInterrupt):
       raise
 
-    except errors.GenericError, err:
+    except errors.GenericError as err:
       # Serialize exception arguments
       result = (err.__class__.__name__, err.args)
 
-    except Exception, err:
+    except Exception as err:
       logging.exception("Error while handling request")
       result = "Caught exception: %s" % str(err)
 
@@ -240,6 +264,10 @@ class ClientConnection:
 
     self.__channel.Write(serialized_data + node.PROTO_SEPARATOR)
 
+    _RPC_SECONDS.Observe(time.time() - start,
+                         labels={"cmd": cmd,
+                                 "success": str(success).lower()})
+
 
 class NodeSocket:
   def __init__(self, ctx, path):
@@ -255,11 +283,15 @@ class NodeSocket:
                          self.__HandleIO)
 
   def __HandleIO(self, source, cond):
-    if cond & gobject.IO_IN:
-      self.__IncomingConnection()
-      return True
+    start = time.time()
+    try:
+      if cond & gobject.IO_IN:
+        self.__IncomingConnection()
+        return True
 
-    return False
+      return False
+    finally:
+      daemon.ObserveCallback("accept", start)
 
   def __IncomingConnection(self):
     (conn, _) = self.__socket.accept()
@@ -287,7 +319,8 @@ class NxNodeProgram(cli.GenericProgram):
 
     (ctx.username, ctx.sessid) = self.args
 
-    ctx.uid = _GetUserUid(ctx.username)
+    ctx.uid = userdb.GetUserProfile(ctx.username,
+                                    ttl=self.cfg.user_cache_ttl).uid
 
     server = NodeSocket(ctx, ctx.sessmgr.GetSessionNodeSocket(ctx.sessid))
     server.Start()
@@ -296,6 +329,10 @@ class NxNodeProgram(cli.GenericProgram):
     gobject.timeout_add(_SESSION_START_TIMEOUT * 1000,
                         _CheckIfSessionWasStarted, ctx)
 
+    if ctx.cfg.metrics_interval > 0:
+      gobject.timeout_add(ctx.cfg.metrics_interval * 1000,
+                          node.WriteNodeMetrics, ctx)
+
     mainloop = gobject.MainLoop()
 
     logging.debug("Starting mainloop")
@@ -26,19 +26,24 @@
 
 import logging
 import optparse
-import socket
-import subprocess
+import os
 import sys
 
 from quicknx import cli
 from quicknx import constants
 from quicknx import errors
+from quicknx import metrics
 from quicknx import node
 from quicknx import protocol
+from quicknx import relay
 from quicknx import session
 from quicknx import utils
 
 
+# Only needed when connecting to the session using netcat
+subprocess = utils.LazyModule("subprocess")
+
+
 PROGRAM = "nxserver"
 
 NX_PROMPT_PARAMETERS = "Parameters: "
@@ -46,6 +51,9 @@ NX_PROMPT_PARAMETERS = "Parameters: "
 _SESSION_START_TIMEOUT = 30
 _SESSION_RESTORE_TIMEOUT = 60
 
+# Rows of the session list written to the client at once
+_LISTSESSION_FLUSH_ROWS = 100
+
 # TODO: Determine how the commercial NX version gets the depth from nxagent
 DEFAULT_DEPTH = 24
 
@@ -208,7 +216,7 @@ class ServerCommandHandler(object):
       elif cmd == protocol.NX_CMD_RESTORESESSION:
         return self._RestoreSession(args)
 
-    except errors.SessionParameterError, err:
+    except errors.SessionParameterError as err:
       logging.exception("Session parameter error")
       raise protocol.NxProtocolError(500, err.args[0], fatal=True)
 
@@ -260,7 +268,7 @@ class ServerCommandHandler(object):
     mgr = ctx.session_mgr
 
     # Parse parameters
-    parsed_params = dict(protocol.ParseParameters(self._GetParameters(args)))
+    parsed_params = protocol.ParseParameters(self._GetParameters(args))
 
     # TODO: Accepted parameters
 
@@ -293,19 +301,26 @@ class ServerCommandHandler(object):
     sessions = self._ListSessionInner(find_types, find_states)
 
     server.Write(127, "Session list of user '%s':" % ctx.username)
-    for line in utils.FormatTable(sessions, LISTSESSION_COLUMNS):
+    for (idx, line) in enumerate(utils.IterTable(sessions,
+                                                 LISTSESSION_COLUMNS)):
       server.WriteLine(line)
+
+      # Send long lists in parts instead of buffering all of it
+      if idx % _LISTSESSION_FLUSH_ROWS == _LISTSESSION_FLUSH_ROWS - 1:
+        server.Flush()
     server.WriteLine("")
     server.Write(148, ("Server capacity: not reached for user: %s" %
                        ctx.username))
 
   def _ListSessionInner(self, find_types, find_states):
-    """Returns a list of sessions filtered by parameters specified.
+    """Returns sessions filtered by parameters specified.
 
     @type find_types: list
     @param find_types: List of wanted session types
     @type find_states: list
     @param find_states: List of wanted (client) session states
+    @rtype: generator
+    @return: Sessions, loaded while being iterated
 
     """
     ctx = self._ctx
@@ -323,7 +338,7 @@ class ServerCommandHandler(object):
 
       return True
 
-    return mgr.FindSessionsWithFilter(ctx.username, _Filter)
+    return mgr.IterSessionsWithFilter(ctx.username, _Filter)
 
   def _StartSession(self, args):
     """Handle the startsession NX command.
@@ -369,7 +384,7 @@ class ServerCommandHandler(object):
 
     # Parse parameters
     params = self._GetParameters(args)
-    parsed_params = dict(protocol.ParseParameters(params))
+    parsed_params = protocol.ParseParameters(params)
 
     # Parameters will be checked in nxnode
 
@@ -378,12 +393,14 @@ class ServerCommandHandler(object):
 
     # Start nxnode daemon
     node.StartNodeDaemon(ctx.username, sessid)
+    metrics.MarkPhase(ctx.phases, constants.PHASE_NODE_DAEMON)
 
     # Connect to daemon and tell it to start our session
     nodeclient = self._GetNodeClient(sessid, True)
+    metrics.MarkPhase(ctx.phases, constants.PHASE_NODE_CONNECT)
     try:
       logging.debug("Sending startsession command")
-      nodeclient.StartSession(parsed_params)
+      nodeclient.StartSession(parsed_params, phases=ctx.phases)
     finally:
       nodeclient.Close()
 
@@ -424,7 +441,7 @@ class ServerCommandHandler(object):
 
     # Parse parameters
     params = self._GetParameters(args)
-    parsed_params = dict(protocol.ParseParameters(params))
+    parsed_params = protocol.ParseParameters(params)
 
     # Parameters will be checked in nxnode
 
@@ -451,12 +468,15 @@ class ServerCommandHandler(object):
 
     # Start nxnode daemon
     node.StartNodeDaemon(ctx.username, sessid)
+    metrics.MarkPhase(ctx.phases, constants.PHASE_NODE_DAEMON)
 
     # Connect to daemon and tell it to shadow our session
     nodeclient = self._GetNodeClient(sessid, True)
+    metrics.MarkPhase(ctx.phases, constants.PHASE_NODE_CONNECT)
     try:
       logging.debug("Sending attachsession command")
-      nodeclient.AttachSession(parsed_params, shadowcookie)
+      nodeclient.AttachSession(parsed_params, shadowcookie,
+                               phases=ctx.phases)
     finally:
       nodeclient.Close()
 
@@ -502,7 +522,7 @@ class ServerCommandHandler(object):
 
     # Parse parameters
     params = self._GetParameters(args)
-    parsed_params = dict(protocol.ParseParameters(params))
+    parsed_params = protocol.ParseParameters(params)
 
     # Parameters will be checked in nxnode
 
@@ -650,23 +670,25 @@ class ServerCommandHandler(object):
 
 class NxServerContext(object):
   def __init__(self):
+    self.cfg = None
     self.username = None
     self.session_mgr = None
     self.nxagent_port = None
+    self.phases = {}
 
 
 class NxServer(protocol.NxServerBase):
   def __init__(self, ctx):
     protocol.NxServerBase.__init__(self, sys.stdin, sys.stdout,
-                                   ServerCommandHandler(self, ctx))
+                                   ServerCommandHandler(self, ctx),
+                                   read_timeout=ctx.cfg.server_read_timeout)
     self._ctx = ctx
 
   def SendBanner(self):
     """Send banner to peer.
 
     """
-    # TODO: Hostname in configuration?
-    hostname = socket.getfqdn().lower()
+    hostname = node.GetHostname(self._ctx.cfg).lower()
     username = self._ctx.username
 
     self.Write(103, message="Welcome to: %s user: %s" % (hostname, username))
@@ -677,6 +699,9 @@ class NxServerProgram(cli.GenericProgram):
     options = cli.GenericProgram.BuildOptions(self)
     options.extend([
       optparse.make_option("--proto", type="int", dest="proto"),
+      optparse.make_option("--login-start", type="float", dest="login_start",
+                           help="Time at which nxserver-login started"
+                                " authenticating the user"),
       ])
     return options
 
@@ -689,19 +714,118 @@ class NxServerProgram(cli.GenericProgram):
     logging.info("Starting nxserver for user %s", username)
 
     ctx = NxServerContext()
+    ctx.cfg = self.cfg
     ctx.username = username
     ctx.session_mgr = session.NxSessionManager()
 
+    if self.options.login_start is not None:
+      ctx.phases[constants.PHASE_LOGIN_START] = self.options.login_start
+      metrics.MarkPhase(ctx.phases, constants.PHASE_LOGIN)
+
     try:
       NxServer(ctx).Start()
     finally:
       sys.stdout.flush()
 
+      try:
+        utils.ExportMetrics(PROGRAM)
+      except EnvironmentError:
+        logging.exception("Failed to export metrics")
+
     if ctx.nxagent_port is None:
-      logging.debug("No nxagent port, not starting netcat")
+      logging.debug("No nxagent port, not connecting to session")
+    elif self.cfg.session_proxy == constants.SESSION_PROXY_BUILTIN:
+      self._RunProxy("localhost", ctx.nxagent_port)
+    elif self.cfg.session_proxy == constants.SESSION_PROXY_HANDOFF:
+      self._ExecProxy("localhost", ctx.nxagent_port)
     else:
       self._RunNetcat("localhost", ctx.nxagent_port)
 
+  def _RunProxy(self, host, port):
+    """Relays data between stdio and the session in-process.
+
+    @type host: str
+    @param host: Hostname
+    @type port: int
+    @param port: Port
+
+    """
+    logging.info("Connecting to session (%s:%s)", host, port)
+
+    try:
+      (sent, received) = \
+        relay.RunTcpProxy((host, port), constants.STDIN_FILENO,
+                          constants.STDOUT_FILENO,
+                          buffer_size=self.cfg.session_proxy_buffer_size)
+    except EnvironmentError as err:
+      logging.error("Proxy to session failed: %s", err)
+      return
+
+    logging.debug("Session connection closed (sent=%s, received=%s)",
+                  sent, received)
+
+  def _ExecProxy(self, host, port):
+    """Connects to the session and replaces this process with fdcopy.
+
+    No Python interpreter stays resident for the lifetime of the session.
+    Doesn't return if successful. If fdcopy can't be executed, netcat is used
+    instead.
+
+    @type host: str
+    @param host: Hostname
+    @type port: int
+    @param port: Port
+
+    """
+    if not os.access(constants.FDCOPY, os.X_OK):
+      logging.error("Can't execute %s, falling back to netcat",
+                    constants.FDCOPY)
+      self._RunNetcat(host, port)
+      return
+
+    logging.info("Connecting to session (%s:%s), handing off to fdcopy",
+                 host, port)
+
+    try:
+      sock = relay.ConnectTcp((host, port),
+                              buffer_size=self.cfg.session_proxy_buffer_size)
+    except EnvironmentError as err:
+      logging.error("Connection to session failed: %s", err)
+      return
+
+    fd = sock.detach()
+    utils.SetCloseOnExecFlag(fd, False)
+
+    args = [constants.FDCOPY,
+            "%s:%s" % (constants.STDIN_FILENO, fd),
+            "%s:%s" % (fd, constants.STDOUT_FILENO)]
+
+    # stderr may be connected to the client, fdcopy's error messages must not
+    # end up there. The original is kept (close-on-exec) in case exec fails.
+    saved_stderr = os.dup(constants.STDERR_FILENO)
+    utils.SetCloseOnExecFlag(saved_stderr, True)
+    try:
+      devnull = os.open(os.devnull, os.O_WRONLY)
+      try:
+        os.dup2(devnull, constants.STDERR_FILENO)
+      finally:
+        os.close(devnull)
+
+      utils.FlushLogging()
+
+      try:
+        os.execv(args[0], args)
+      except OSError as err:
+        os.dup2(saved_stderr, constants.STDERR_FILENO)
+        logging.error("Can't execute %s: %s, falling back to netcat",
+                      args[0], err)
+    finally:
+      os.close(saved_stderr)
+
+    os.close(fd)
+
+    self._RunNetcat(host, port)
+
   def _RunNetcat(self, host, port):
     """Starts netcat and returns only after it's done.
 
@@ -28,15 +28,20 @@ import logging
 import os.path
 import re
 import sys
+import time
 
-from quicknx import auth
 from quicknx import cli
 from quicknx import constants
 from quicknx import errors
+from quicknx import metrics
 from quicknx import protocol
 from quicknx import utils
 
 
+# Not needed if the user already authenticated using SSH
+auth = utils.LazyModule("quicknx.auth")
+
+
 PROGRAM = "nxserver-login"
 
 NX_PROMPT_USER = "User: "
@@ -53,14 +58,120 @@ NX_SHELL_MODE_SHELL = "shell"
 RE_PROTOCOL = re.compile(r"^nxclient\s+-\s+version\s+(?P<ver>[\d.]+)\s*$",
                          re.I)
 
+# Seconds between checks for a free login slot
+_QUEUE_POLL_INTERVAL = 0.1
+
+# Seconds between messages to waiting clients
+_QUEUE_KEEPALIVE_INTERVAL = 5
+
+_ADMISSION_ADMITTED = "admitted"
+_ADMISSION_QUEUED = "queued"
+_ADMISSION_REJECTED = "rejected"
+_ADMISSION_TIMEOUT = "timeout"
+
+_LOGIN_ADMISSIONS = \
+  metrics.REGISTRY.GetCounter("quicknx_login_admissions_total",
+                              "Logins by admission result")
+_LOGIN_QUEUE_SECONDS = \
+  metrics.REGISTRY.GetHistogram("quicknx_login_queue_seconds",
+                                "Time logins waited for their turn")
+
+
+class LoginAdmission(object):
+  """Limits the number of logins authenticating at the same time.
+
+  The limit applies to all nxserver-login processes on the host. Logins
+  over the limit wait in a bounded first-in, first-out queue; once that's
+  full, logins are rejected. New logins only skip the queue if it's empty.
+
+  """
+  def __init__(self, cfg, _slots_dir=constants.LOGIN_SLOTS_DIR, _time=time):
+    """Initializes this class.
+
+    @type cfg: L{config.Config}
+    @param cfg: Configuration object
+
+    """
+    self._cfg = cfg
+    self._time = _time
+
+    self._slots = utils.SlotSemaphore(_slots_dir, "login",
+                                      cfg.login_max_concurrent)
+
+    if cfg.login_max_queued > 0:
+      self._queue = utils.TicketQueue(_slots_dir, "queue",
+                                      cfg.login_max_queued)
+    else:
+      self._queue = None
+
+  def _Done(self, result):
+    _LOGIN_ADMISSIONS.Inc(labels={"result": result})
+    return result in (_ADMISSION_ADMITTED, _ADMISSION_QUEUED)
+
+  def Acquire(self, keepalive_fn):
+    """Waits for the turn of this login.
+
+    @type keepalive_fn: callable
+    @param keepalive_fn: Called regularly while waiting
+    @rtype: bool
+    @return: Whether the login may continue
+
+    """
+    if ((self._queue is None or self._queue.IsEmpty()) and
+        self._slots.TryAcquire()):
+      return self._Done(_ADMISSION_ADMITTED)
+
+    if self._queue is None or not self._queue.TryEnter():
+      logging.warning("Too many logins waiting, rejecting login")
+      return self._Done(_ADMISSION_REJECTED)
+
+    start = self._time.time()
+    try:
+      logging.info("Too many concurrent logins, waiting")
+
+      deadline = start + self._cfg.login_queue_timeout
+      next_keepalive = start + _QUEUE_KEEPALIVE_INTERVAL
+
+      keepalive_fn()
+
+      while True:
+        self._time.sleep(_QUEUE_POLL_INTERVAL)
+
+        # Logins waiting longer get free slots first
+        if self._queue.IsFirst() and self._slots.TryAcquire():
+          return self._Done(_ADMISSION_QUEUED)
+
+        now = self._time.time()
+
+        if now >= deadline:
+          logging.warning("Timeout while waiting for login slot")
+          return self._Done(_ADMISSION_TIMEOUT)
+
+        if now >= next_keepalive:
+          keepalive_fn()
+          next_keepalive = now + _QUEUE_KEEPALIVE_INTERVAL
+
+    finally:
+      self._queue.Leave()
+      _LOGIN_QUEUE_SECONDS.Observe(self._time.time() - start)
+
+  def Release(self):
+    """Releases the slot of this login.
+
+    Can be called more than once.
+
+    """
+    self._slots.Release()
+
 
 class LoginCommandHandler(object):
   """NX protocol handler for the nxserver-login component.
 
   """
-  def __init__(self, server, cfg):
+  def __init__(self, server, cfg, _get_username=utils.GetCurrentUserName):
     self._server = server
     self._cfg = cfg
+    self._get_username = _get_username
     self._protocol_version = None
 
   def __call__(self, command):
@@ -122,9 +233,7 @@ class LoginCommandHandler(object):
     """The "login" command.
 
     """
-    if utils.GetCurrentUserName() != constants.NXUSER:
-      # If current user is not 'nx', user has already authenticated against
-      # ssh as himself. So we just run nx server.
+    if self._IsAuthenticated():
       return self._RunNxServer()
 
     server = self._server
@@ -172,6 +281,21 @@ class LoginCommandHandler(object):
 
     self._TryLogin(username, password)
 
+  def _IsAuthenticated(self):
+    """Returns whether the peer already authenticated as the current user.
+
+    If the current user is neither "nx" nor root, the user has already
+    authenticated against ssh as himself. Root is only used for the pam
+    method and always requires a login.
+
+    @rtype: bool
+
+    """
+    if self._cfg.auth_method == constants.AUTH_METHOD_PAM:
+      return False
+
+    return self._get_username() not in (constants.NXUSER, constants.ROOTUSER)
+
   def _Set(self, args):
     """The "set" command.
 
@@ -218,9 +342,12 @@ class LoginCommandHandler(object):
       raise protocol.NxProtocolError(500,
                                      "ERROR: unknown shell mode '%s'" % value)
 
-  def _GetNxServerArgs(self, username):
+  def _GetNxServerArgs(self, username, login_start=None):
     """Returns command line arguments to run nxserver for a given username
 
+    @type login_start: float
+    @param login_start: Time at which authentication started
+
     """
     if self._protocol_version is None:
       # Fallback to default version
@@ -228,7 +355,12 @@ class LoginCommandHandler(object):
     else:
       protocol_version = self._protocol_version
 
-    return [constants.NXSERVER, "--proto=%s" % protocol_version, "--", username]
+    args = [constants.NXSERVER, "--proto=%s" % protocol_version]
+
+    if login_start is not None:
+      args.append("--login-start=%.6f" % login_start)
+
+    return args + ["--", username]
 
   def _RunNxServer(self):
     """Runs nxserver as the current user.
@@ -241,6 +373,8 @@ class LoginCommandHandler(object):
     env = os.environ.copy()
     env["LC_ALL"] = "C"
     args = self._GetNxServerArgs(utils.GetCurrentUserName())
+    self._server.Flush()
+    utils.FlushLogging()
     os.execve(args[0], args, env)
 
   def _TryLogin(self, username, password):
@@ -248,15 +382,36 @@ class LoginCommandHandler(object):
 
     """
     server = self._server
+    login_start = time.time()
 
     logging.info("Trying login for user %r using auth method %r", username,
                  self._cfg.auth_method)
 
     # Passing username to support virtual users in the future
-    args = self._GetNxServerArgs(username)
+    args = self._GetNxServerArgs(username, login_start=login_start)
+
+    if self._cfg.login_max_concurrent > 0:
+      admission = LoginAdmission(self._cfg)
+
+      def keepalive_fn():
+        server.Write(149, "Server busy, waiting for login")
+        server.Flush()
+
+      if not admission.Acquire(keepalive_fn):
+        server.Write(503, "ERROR: Server busy, please try again later.")
+        raise protocol.NxQuietQuitServer()
+    else:
+      admission = None
 
     authenticator = auth.GetAuthenticator(self._cfg)
 
+    if admission:
+      # Let the next login start as soon as authentication is done
+      authenticator.result_fn = lambda _: admission.Release()
+
+    # The authenticator writes to the output file descriptor directly
+    server.Flush()
+
     try:
       # AuthenticateAndRun doesn't return until the client disconnects or an
       # error occurs.
@@ -267,6 +422,9 @@ class LoginCommandHandler(object):
     except errors.AuthError:
       logging.exception("Error in authentication")
       server.Write(503, "ERROR: Internal error.")
+    finally:
+      if admission:
+        admission.Release()
 
     raise protocol.NxQuietQuitServer()
 
@@ -275,7 +433,8 @@ class LoginServer(protocol.NxServerBase):
   def __init__(self, cfg):
     self._cfg = cfg
     protocol.NxServerBase.__init__(self, sys.stdin, sys.stdout,
-                                   LoginCommandHandler(self, cfg))
+                                   LoginCommandHandler(self, cfg),
+                                   read_timeout=cfg.login_read_timeout)
 
   def SendBanner(self):
     """Send banner to peer.
@@ -288,9 +447,32 @@ class LoginServer(protocol.NxServerBase):
     self.WriteLine(banner)
 
 
+def RunLogin(cfg):
+  """Serves a client connected to stdin and stdout.
+
+  Also used by nxbroker, which calls this in a child process for every
+  connection.
+
+  @type cfg: L{config.Config}
+  @param cfg: Configuration object
+
+  """
+  try:
+    LoginServer(cfg).Start()
+  finally:
+    try:
+      utils.ExportMetrics(PROGRAM)
+    except EnvironmentError:
+      logging.exception("Failed to export metrics")
+
+
 class NxServerLoginProgram(cli.GenericProgram):
   def Run(self):
-    LoginServer(self.cfg).Start()
+    if self.cfg.auth_method == constants.AUTH_METHOD_PAM:
+      # Fail at startup instead of after the client sent its password
+      auth.CheckPrivileges(self.cfg)
+
+    RunLogin(self.cfg)
 
 
 def Main():
@@ -22,18 +22,93 @@
 """Module for authentication"""
 
 
+import ctypes
+import errno
+import hashlib
 import logging
 import os
-import pexpect
+import pwd
 import re
+import socket
+import time
 from io import StringIO
 
 from quicknx import constants
 from quicknx import errors
+from quicknx import metrics
+from quicknx import relay
+from quicknx import serializer
 from quicknx import utils
 
 
+# Only needed by some authentication methods
+pexpect = utils.LazyModule("pexpect")
+_ctypes_util = utils.LazyModule("ctypes.util")
+
+
+_AUTH_RESULT_SUCCESS = "success"
+_AUTH_RESULT_FAILED = "failed"
+_AUTH_RESULT_TIMEOUT = "timeout"
+
+# Seconds to wait for the authenticated program after its output was closed
+_CHILD_EXIT_TIMEOUT = 30
+
+# Characters of an unfinished output line searched for prompts
+_PROMPT_WINDOW = 4096
+
+# Characters of output kept for error messages
+_TRANSCRIPT_SIZE = 4096
+
+# Characters read from the authentication program at once
+_PROMPT_READ_SIZE = 64 * 1024
+
+# PAM constants from security/_pam_types.h
+_PAM_SUCCESS = 0
+_PAM_BUF_ERR = 5
+_PAM_PROMPT_ECHO_OFF = 1
+_PAM_PROMPT_ECHO_ON = 2
+_PAM_ERROR_MSG = 3
+_PAM_TEXT_INFO = 4
+_PAM_ESTABLISH_CRED = 0x0002
+_PAM_DELETE_CRED = 0x0004
+
+# PATH for programs started by PamAuth
+_PAM_USER_PATH = "/usr/local/bin:/usr/bin:/bin"
+
+_AUTH_SECONDS = \
+  metrics.REGISTRY.GetHistogram("quicknx_auth_seconds",
+                                "Time needed to authenticate a user")
+_AUTH_CACHE_REQUESTS = \
+  metrics.REGISTRY.GetCounter("quicknx_auth_cache_requests_total",
+                              "Authentication cache lookups by result")
+
+_CACHE_HIT = "hit"
+_CACHE_MISS = "miss"
+_CACHE_NEGATIVE_HIT = "negative-hit"
+_CACHE_BLOCKED = "blocked"
+
+# Parameters for hashing cached credentials
+_CACHE_HASH_NAME = "sha256"
+_CACHE_HASH_ROUNDS = 10000
+_CACHE_SALT_BYTES = 16
+
+# Number of failures kept per user
+_CACHE_MAX_FAILURES_KEPT = 32
+
+_SSH_POOL_SOCKET_SUFFIX = ".sock"
+_SSH_POOL_VERIFIER_SUFFIX = ".verifier"
+
+# Seconds after which a pooled SSH master connection isn't used for new logins
+# anymore, even if it's still in use. This limits for how long a changed
+# password is still accepted.
+_SSH_POOL_MAX_AGE = 3600
+
+
 class _AuthBase(object):
+  # Whether the authenticated program can be run without checking the
+  # password again, see L{RunAuthenticated}
+  CAN_SKIP_AUTH = False
+
   def __init__(self, cfg,
                stdout_fileno=constants.STDOUT_FILENO,
                stdin_fileno=constants.STDIN_FILENO):
@@ -41,9 +116,180 @@ class _AuthBase(object):
     self._stdout_fileno = stdout_fileno
     self._stdin_fileno = stdin_fileno
 
+    # Called with the result as soon as authentication is done
+    self.result_fn = None
+
   def AuthenticateAndRun(self, username, password, args):
     raise NotImplementedError()
 
+  def RunAuthenticated(self, username, args):
+    """Runs the program for an already authenticated user.
+
+    Only available if L{CAN_SKIP_AUTH} is set.
+
+    """
+    raise NotImplementedError()
+
+  def _AuthDone(self, start, result):
+    """Records how long an authentication took and reports its result.
+
+    @type start: float
+    @param start: Time at which authentication started
+    @type result: str
+    @param result: Outcome of authentication
+
+    """
+    _AUTH_SECONDS.Observe(time.time() - start,
+                          labels={"method": self._cfg.auth_method,
+                                  "result": result})
+
+    if self.result_fn:
+      self.result_fn(result)
+
+
+class _PromptReader(object):
+  """Reads a program's output and matches prompts incrementally.
+
+  Every line is searched once. Only the last C{window} characters of an
+  unfinished line are kept, so patterns must not span lines and a C{^}
+  matches at the start of any line. Only the last C{transcript_size}
+  characters of output are kept for error messages.
+
+  """
+  def __init__(self, child, window=_PROMPT_WINDOW,
+               transcript_size=_TRANSCRIPT_SIZE):
+    """Initializes this class.
+
+    @type child: C{pexpect.spawn}
+    @param child: Program to read from
+
+    """
+    self._child = child
+    self._window = window
+    self._transcript_size = transcript_size
+
+    self._transcript = ""
+    self._transcript_truncated = False
+
+    # Unfinished line and whether its start was cut off
+    self._line = ""
+    self._line_truncated = False
+
+    # Output after the last match
+    self.buffer = ""
+
+  def GetTranscript(self):
+    """Returns the end of the output read so far.
+
+    """
+    if self._transcript_truncated:
+      return "..." + self._transcript
+    return self._transcript
+
+  def _AddTranscript(self, data):
+    self._transcript += data
+
+    if len(self._transcript) > self._transcript_size:
+      self._transcript = self._transcript[-self._transcript_size:]
+      self._transcript_truncated = True
+
+  @staticmethod
+  def _SearchLine(patterns, line, truncated):
+    """Finds the earliest match of any pattern in a line.
+
+    @rtype: tuple or None
+    @return: (index of pattern, match object)
+
+    """
+    if truncated:
+      # The first character is only kept so "^" doesn't match at the start
+      pos = 1
+    else:
+      pos = 0
+
+    result = None
+
+    for (idx, pattern) in enumerate(patterns):
+      m = pattern.search(line, pos)
+      if m and (result is None or m.start() < result[1].start()):
+        result = (idx, m)
+
+    return result
+
+  def _Feed(self, patterns, data):
+    """Searches new output.
+
+    @rtype: tuple or None
+    @return: (index of pattern, matched text)
+
+    """
+    pending = self._line + data
+    truncated = self._line_truncated
+    pos = 0
+
+    while True:
+      end = pending.find("\n", pos)
+      if end == -1:
+        line = pending[pos:]
+      else:
+        line = pending[pos:end + 1]
+
+      result = self._SearchLine(patterns, line, truncated)
+      if result:
+        (idx, m) = result
+        self._line = ""
+        self._line_truncated = False
+        self.buffer = pending[pos + m.end():]
+        return (idx, m.group(0))
+
+      if end == -1:
+        break
+
+      pos = end + 1
+      truncated = False
+
+    line = pending[pos:]
+    if len(line) > self._window:
+      line = line[-(self._window + 1):]
+      truncated = True
+
+    self._line = line
+    self._line_truncated = truncated
+
+    return None
+
+  def Expect(self, patterns, timeout):
+    """Waits for output matching one of the patterns.
+
+    Output after the match is left in L{buffer}.
+
+    @type patterns: list of compiled regular expressions
+    @param patterns: Patterns to search for
+    @type timeout: float
+    @param timeout: Timeout in seconds
+    @rtype: tuple
+    @return: (index of pattern, matched text)
+    @raise pexpect.EOF: When the program closed its output
+    @raise pexpect.TIMEOUT: When no match was found in time
+
+    """
+    data = self.buffer
+    self.buffer = ""
+
+    deadline = time.time() + timeout
+
+    while True:
+      result = self._Feed(patterns, data)
+      if result:
+        return result
+
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        raise pexpect.TIMEOUT("Timeout while waiting for prompt")
+
+      data = self._child.read_nonblocking(_PROMPT_READ_SIZE, remaining)
+      self._AddTranscript(data)
+
 
 class _ExpectAuthBase(_AuthBase):
   def AuthenticateAndRun(self, username, password, args):
@@ -65,59 +311,88 @@ class _ExpectAuthBase(_AuthBase):
                                            self.GetPasswordPrompt())
     nx_idx = self._AddPattern(patterns, re.compile("^NX> ", re.M))
 
+    start = time.time()
+
     # Start child process
     # TODO: Timeout in configuration and/or per auth method
     child = pexpect.spawn(all_args[0], args=all_args[1:], env=env,
-                          timeout=30)
+                          timeout=30, encoding="UTF-8",
+                          codec_errors="replace")
 
-    buf = StringIO()
+    reader = _PromptReader(child)
+    end_of_line = [re.compile(re.escape(os.linesep))]
     nxbuf = StringIO()
     auth_successful = False
 
     try:
       while True:
-        idx = child.expect(patterns)
-
-        # Store all output seen before the match
-        buf.write(child.before)
-        # Store the matched output
-        buf.write(child.after)
+        (idx, matched) = reader.Expect(patterns, child.timeout)
 
         if idx == password_prompt_idx:
           self._Send(child, password + os.linesep)
 
           # Wait for end of password prompt
-          child.expect(os.linesep)
+          reader.Expect(end_of_line, child.timeout)
 
         # TODO: Timeout for programs not printing NX prompt within X seconds
         elif idx == nx_idx:
           # Program was started
           auth_successful = True
 
-          nxbuf.write(child.after)
-          nxbuf.write(child.buffer)
+          nxbuf.write(matched)
+          nxbuf.write(reader.buffer)
           break
 
         else:
           raise AssertionError("Invalid index")
 
     except pexpect.EOF:
-      buf.write(child.before)
+      pass
 
     except pexpect.TIMEOUT:
-      buf.write(child.before)
-      logging.debug("Authentication timed out (output=%r)", buf.getvalue())
+      logging.debug("Authentication timed out (output=%r)",
+                    reader.GetTranscript())
+      self._AuthDone(start, _AUTH_RESULT_TIMEOUT)
       raise errors.AuthTimeoutError()
 
     if not auth_successful:
+      # Collect exit status
+      child.close()
+
+      self._AuthDone(start, _AUTH_RESULT_FAILED)
       raise errors.AuthFailedError(("Authentication failed (output=%r, "
                                     "exitstatus=%s, signum=%s)") %
-                                   (utils.NormalizeSpace(buf.getvalue()),
+                                   (utils.NormalizeSpace(
+                                      reader.GetTranscript()),
                                     child.exitstatus, child.signalstatus))
 
+    self._AuthDone(start, _AUTH_RESULT_SUCCESS)
+
     # Write protocol buffer contents to stdout
     os.write(self._stdout_fileno, bytes(nxbuf.getvalue(), 'UTF-8'))
 
+    if self._cfg.auth_relay == constants.AUTH_RELAY_SPLICE:
+      self._RunRelay(child, env)
+    else:
+      self._RunFdCopy(child, env)
+
+    # Discard anything left in buffer
+    child.read()
+
+    logging.info("Waiting for authenticated program to finish")
+    if not utils.WaitForChild(child.pid, timeout=_CHILD_EXIT_TIMEOUT):
+      logging.error("Timeout while waiting for authenticated program "
+                    "to finish")
+
+    child.close()
+
+    logging.debug(("Authenticated program finished (exitstatus=%s, "
+                   "signalstatus=%s)"), child.exitstatus, child.signalstatus)
+
+  def _RunFdCopy(self, child, env):
+    """Copies data between stdio and the child using fdcopy.
+
+    """
     utils.SetCloseOnExecFlag(child.fileno(), False)
     utils.SetCloseOnExecFlag(self._stdin_fileno, False)
     utils.SetCloseOnExecFlag(self._stdout_fileno, False)
@@ -132,24 +407,14 @@ class _ExpectAuthBase(_AuthBase):
     logging.debug("fdcopy exited (exitstatus=%s, signum=%s)",
                   exitcode, signum)
 
-    # Discard anything left in buffer
-    child.read()
-
-    def _CheckChild():
-      if child.isalive():
-        raise utils.RetryAgain()
-
-    logging.info("Waiting for authenticated program to finish")
-    try:
-      utils.Retry(_CheckChild, 0.5, 1.1, 5.0, 30)
-    except utils.RetryTimeout:
-      logging.error("Timeout while waiting for authenticated program "
-                    "to finish")
-
-    child.close()
+  def _RunRelay(self, child, env):
+    """Copies data between stdio and the child in-process.
 
-    logging.debug(("Authenticated program finished (exitstatus=%s, "
-                   "signalstatus=%s)"), child.exitstatus, child.signalstatus)
+    """
+    (sent, received) = \
+      relay.Relay([(self._stdin_fileno, child.fileno()),
+                   (child.fileno(), self._stdout_fileno)]).Run()
+    logging.debug("Relay finished (sent=%s, received=%s)", sent, received)
 
   def _GetFdCopyPath(self):
     return constants.FDCOPY
@@ -195,6 +460,46 @@ class SuAuth(_ExpectAuthBase):
 
 
 class SshAuth(_ExpectAuthBase):
+  def __init__(self, cfg,
+               stdout_fileno=constants.STDOUT_FILENO,
+               stdin_fileno=constants.STDIN_FILENO,
+               _pool=None):
+    _ExpectAuthBase.__init__(self, cfg, stdout_fileno=stdout_fileno,
+                             stdin_fileno=stdin_fileno)
+
+    if _pool is None and cfg.auth_ssh_pool_size > 0:
+      _pool = SshConnectionPool(_GetSshPoolDir(), cfg.auth_ssh_pool_size,
+                                cfg.auth_ssh_pool_idle, cfg.ssh)
+
+    self._pool = _pool
+    self._pool_options = []
+    self._pool_new_master = None
+
+  def AuthenticateAndRun(self, username, password, args):
+    if self._pool is not None:
+      try:
+        (self._pool_options, new_master) = \
+          self._pool.GetOptions(username, self._cfg.auth_ssh_host,
+                                self._cfg.auth_ssh_port, password)
+      except EnvironmentError as err:
+        logging.warning("Not using SSH connection pool: %s", err)
+      else:
+        if new_master:
+          self._pool_new_master = (username, password)
+
+    _ExpectAuthBase.AuthenticateAndRun(self, username, password, args)
+
+  def _AuthDone(self, start, result):
+    if result == _AUTH_RESULT_SUCCESS and self._pool_new_master:
+      (username, password) = self._pool_new_master
+      try:
+        self._pool.Add(username, self._cfg.auth_ssh_host,
+                       self._cfg.auth_ssh_port, password)
+      except EnvironmentError as err:
+        logging.warning("Can't add connection to SSH pool: %s", err)
+
+    _ExpectAuthBase._AuthDone(self, start, result)
+
   def GetCommand(self, username, args):
     # TODO: Allow for per-user hostname. A very flexible way would be to run an
     # external script (e.g. "/.../userhost $username"), and let it print the
@@ -213,7 +518,7 @@ class SshAuth(_ExpectAuthBase):
       "-oStrictHostKeyChecking=no",
       # Don't try to write a known_hosts file
       "-oUserKnownHostsFile=/dev/null",
-      ]
+      ] + self._pool_options
 
     cmd = utils.ShellQuoteArgs(args)
     return ([self._cfg.ssh, "-2", "-x", "-l", username, "-p", str(port)] +
@@ -223,9 +528,936 @@ class SshAuth(_ExpectAuthBase):
     return re.compile(r"^.*@.*\s+password:\s*", re.I | re.M)
 
 
+def _GetPamResponses(messages, password):
+  """Answers the messages of a PAM conversation.
+
+  Every prompt without echo is answered with the password. Other messages are
+  logged.
+
+  @type messages: list of tuples
+  @param messages: List of (message style, text)
+  @type password: str
+  @param password: Password
+  @rtype: list
+  @return: Response for each message, C{None} for messages not needing one
+
+  """
+  responses = []
+
+  for (style, text) in messages:
+    if style == _PAM_PROMPT_ECHO_OFF:
+      responses.append(password)
+
+    elif style == _PAM_PROMPT_ECHO_ON:
+      # We only know the password, the username is passed to pam_start
+      logging.warning("PAM asked for unknown input: %r", text)
+      responses.append("")
+
+    else:
+      if style == _PAM_ERROR_MSG:
+        logging.warning("PAM error message: %r", text)
+      else:
+        logging.debug("PAM message: %r", text)
+      responses.append(None)
+
+  return responses
+
+
+class _PamMessage(ctypes.Structure):
+  _fields_ = [
+    ("msg_style", ctypes.c_int),
+    ("msg", ctypes.c_char_p),
+    ]
+
+
+class _PamResponse(ctypes.Structure):
+  # The response string is freed by PAM, hence it's allocated using libc and
+  # not managed by ctypes
+  _fields_ = [
+    ("resp", ctypes.c_void_p),
+    ("resp_retcode", ctypes.c_int),
+    ]
+
+
+_PAM_CONV_FUNC = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int,
+                                  ctypes.POINTER(ctypes.POINTER(_PamMessage)),
+                                  ctypes.POINTER(ctypes.POINTER(_PamResponse)),
+                                  ctypes.c_void_p)
+
+
+class _PamConv(ctypes.Structure):
+  _fields_ = [
+    ("conv", _PAM_CONV_FUNC),
+    ("appdata_ptr", ctypes.c_void_p),
+    ]
+
+
+class PamLibrary(object):
+  """Minimal ctypes binding for libpam.
+
+  """
+  def __init__(self):
+    """Initializes this class.
+
+    Libraries are only loaded when first used.
+
+    """
+    self._libpam = None
+    self._libc = None
+
+  def _Load(self):
+    """Loads libpam and libc.
+
+    """
+    if self._libpam is not None:
+      return
+
+    libname = _ctypes_util.find_library("pam")
+    if not libname:
+      raise errors.AuthError("PAM library not found")
+
+    libpam = ctypes.CDLL(libname)
+    libc = ctypes.CDLL(_ctypes_util.find_library("c"))
+
+    libc.calloc.restype = ctypes.c_void_p
+    libc.calloc.argtypes = [ctypes.c_size_t, ctypes.c_size_t]
+    libc.strdup.restype = ctypes.c_void_p
+    libc.strdup.argtypes = [ctypes.c_char_p]
+    libc.free.restype = None
+    libc.free.argtypes = [ctypes.c_void_p]
+
+    libpam.pam_start.restype = ctypes.c_int
+    libpam.pam_start.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                                 ctypes.POINTER(_PamConv),
+                                 ctypes.POINTER(ctypes.c_void_p)]
+    libpam.pam_authenticate.restype = ctypes.c_int
+    libpam.pam_authenticate.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    libpam.pam_acct_mgmt.restype = ctypes.c_int
+    libpam.pam_acct_mgmt.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    libpam.pam_setcred.restype = ctypes.c_int
+    libpam.pam_setcred.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    libpam.pam_open_session.restype = ctypes.c_int
+    libpam.pam_open_session.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    libpam.pam_close_session.restype = ctypes.c_int
+    libpam.pam_close_session.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    libpam.pam_getenvlist.restype = ctypes.POINTER(ctypes.c_void_p)
+    libpam.pam_getenvlist.argtypes = [ctypes.c_void_p]
+    libpam.pam_end.restype = ctypes.c_int
+    libpam.pam_end.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    libpam.pam_strerror.restype = ctypes.c_char_p
+    libpam.pam_strerror.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+    self._libpam = libpam
+    self._libc = libc
+
+  def _Conversation(self, password, count, messages, responses):
+    """PAM conversation function.
+
+    """
+    libc = self._libc
+
+    msglist = []
+    for idx in range(count):
+      msg = messages[idx].contents
+      msglist.append((msg.msg_style,
+                      (msg.msg or b"").decode("UTF-8", "replace")))
+
+    addr = libc.calloc(count, ctypes.sizeof(_PamResponse))
+    if not addr:
+      return _PAM_BUF_ERR
+
+    result = ctypes.cast(addr, ctypes.POINTER(_PamResponse))
+
+    for (idx, text) in enumerate(_GetPamResponses(msglist, password)):
+      if text is not None:
+        result[idx].resp = libc.strdup(text.encode("UTF-8"))
+      result[idx].resp_retcode = 0
+
+    responses[0] = result
+
+    return _PAM_SUCCESS
+
+  def Start(self, service, username, password):
+    """Starts a PAM transaction.
+
+    @type service: str
+    @param service: PAM service name
+    @type username: str
+    @param username: Username
+    @type password: str or None
+    @param password: Password, None if it won't be checked
+    @rtype: L{_PamTransaction}
+    @raise errors.AuthError: When PAM could not be initialized
+
+    """
+    self._Load()
+
+    # Referenced by the transaction as long as PAM may call it
+    conv = _PamConv(_PAM_CONV_FUNC(lambda count, messages, responses, _:
+                                   self._Conversation(password, count,
+                                                      messages, responses)),
+                    None)
+    handle = ctypes.c_void_p()
+
+    ret = self._libpam.pam_start(service.encode("UTF-8"),
+                                 username.encode("UTF-8"),
+                                 ctypes.byref(conv), ctypes.byref(handle))
+    if ret != _PAM_SUCCESS:
+      raise errors.AuthError("pam_start failed with code %s" % ret)
+
+    return _PamTransaction(self._libpam, self._libc, handle, conv)
+
+
+class _PamTransaction(object):
+  """A started PAM transaction, see L{PamLibrary.Start}.
+
+  """
+  def __init__(self, libpam, libc, handle, conv):
+    self._libpam = libpam
+    self._libc = libc
+    self._handle = handle
+    self._conv = conv
+    self._status = _PAM_SUCCESS
+    self._session_open = False
+    self._cred_established = False
+
+  def _Check(self, ret, what, error_cls=errors.AuthError):
+    self._status = ret
+
+    if ret != _PAM_SUCCESS:
+      msg = self._libpam.pam_strerror(self._handle, ret) or b""
+      raise error_cls("PAM %s failed: %s" %
+                      (what, msg.decode("UTF-8", "replace")))
+
+  def Authenticate(self):
+    """Checks the user's credentials and account status.
+
+    @raise errors.AuthFailedError: When the credentials were not accepted
+
+    """
+    self._Check(self._libpam.pam_authenticate(self._handle, 0),
+                "authentication", error_cls=errors.AuthFailedError)
+    self.CheckAccount()
+
+  def CheckAccount(self):
+    """Checks the account status (e.g. expiry, access restrictions).
+
+    @raise errors.AuthFailedError: When the account may not be used
+
+    """
+    self._Check(self._libpam.pam_acct_mgmt(self._handle, 0),
+                "account check", error_cls=errors.AuthFailedError)
+
+  def OpenSession(self):
+    """Establishes credentials and opens a session for the user.
+
+    """
+    self._Check(self._libpam.pam_setcred(self._handle, _PAM_ESTABLISH_CRED),
+                "establishing credentials")
+    self._cred_established = True
+
+    self._Check(self._libpam.pam_open_session(self._handle, 0),
+                "opening session")
+    self._session_open = True
+
+  def CloseSession(self):
+    """Closes the session and deletes credentials, if established.
+
+    """
+    if self._session_open:
+      self._session_open = False
+      ret = self._libpam.pam_close_session(self._handle, 0)
+      if ret != _PAM_SUCCESS:
+        logging.warning("PAM closing session failed with code %s", ret)
+
+    if self._cred_established:
+      self._cred_established = False
+      ret = self._libpam.pam_setcred(self._handle, _PAM_DELETE_CRED)
+      if ret != _PAM_SUCCESS:
+        logging.warning("PAM deleting credentials failed with code %s", ret)
+
+  def GetEnvironment(self):
+    """Returns the environment set by PAM modules (e.g. pam_env).
+
+    @rtype: dict
+
+    """
+    libc = self._libc
+
+    envlist = self._libpam.pam_getenvlist(self._handle)
+    if not envlist:
+      return {}
+
+    result = {}
+    try:
+      idx = 0
+      while envlist[idx]:
+        entry = ctypes.string_at(envlist[idx]).decode("UTF-8", "replace")
+        libc.free(envlist[idx])
+        (name, sep, value) = entry.partition("=")
+        if sep:
+          result[name] = value
+        idx += 1
+    finally:
+      libc.free(envlist)
+
+    return result
+
+  def End(self):
+    """Ends the transaction.
+
+    """
+    self.CloseSession()
+
+    if self._handle is not None:
+      self._libpam.pam_end(self._handle, self._status)
+      self._handle = None
+
+
+def _RunAsUser(username, args, pam_env=None):
+  """Runs a program as another user and waits for it to finish.
+
+  Standard input and output are inherited. Switching to another user requires
+  root privileges.
+
+  @type username: str
+  @param username: Username
+  @type args: list
+  @param args: Program and arguments
+  @type pam_env: dict
+  @param pam_env: Additional environment set by PAM modules
+  @rtype: int
+  @return: Exit code, or negative signal number if the program was killed by
+    a signal (same as L{subprocess.Popen.returncode})
+
+  """
+  pw = pwd.getpwnam(username)
+
+  env = {
+    "HOME": pw.pw_dir,
+    "USER": pw.pw_name,
+    "LOGNAME": pw.pw_name,
+    "SHELL": pw.pw_shell,
+    "PATH": _PAM_USER_PATH,
+    "LANG": "C",
+    }
+
+  if pam_env:
+    env.update(pam_env)
+
+  pid = os.fork()
+  if pid == 0:
+    # Child
+    try:
+      if os.getuid() != pw.pw_uid:
+        os.initgroups(pw.pw_name, pw.pw_gid)
+        os.setgid(pw.pw_gid)
+        os.setuid(pw.pw_uid)
+
+      try:
+        os.chdir(pw.pw_dir)
+      except OSError:
+        os.chdir("/")
+
+      utils.FlushLogging()
+      os.execve(args[0], args, env)
+    except:
+      logging.exception("Failed to start %r as user %r", args, username)
+    utils.FlushLogging()
+    os._exit(constants.EXIT_FAILURE)
+
+  (_, status) = os.waitpid(pid, 0)
+
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+
+  return os.WEXITSTATUS(status)
+
+
+def CheckPrivileges(cfg, _geteuid=os.geteuid):
+  """Checks whether the configured authentication method can be used.
+
+  @type cfg: L{config.Config}
+  @param cfg: Configuration object
+  @raise errors.AuthError: When the method needs privileges the current
+    process doesn't have
+
+  """
+  if cfg.auth_method == constants.AUTH_METHOD_PAM and _geteuid() != 0:
+    raise errors.AuthError("Authentication method %r requires running as"
+                           " root" % cfg.auth_method)
+
+
+class PamAuth(_AuthBase):
+  """Authenticates users in-process using PAM.
+
+  No pty, shell or prompt scraping is needed and the authenticated program
+  is started directly as the target user. The program runs within a PAM
+  session, so session modules (e.g. pam_limits, pam_mkhomedir or
+  pam_systemd) are used. This requires nxserver-login to run as root.
+
+  """
+  CAN_SKIP_AUTH = True
+
+  def __init__(self, cfg,
+               stdout_fileno=constants.STDOUT_FILENO,
+               stdin_fileno=constants.STDIN_FILENO,
+               _pam=None, _run_fn=_RunAsUser, _geteuid=os.geteuid):
+    _AuthBase.__init__(self, cfg, stdout_fileno=stdout_fileno,
+                       stdin_fileno=stdin_fileno)
+
+    CheckPrivileges(cfg, _geteuid=_geteuid)
+
+    if _pam is None:
+      _pam = PamLibrary()
+
+    self._pam = _pam
+    self._run_fn = _run_fn
+
+  def AuthenticateAndRun(self, username, password, args):
+    logging.debug("Authenticating as '%s' using PAM service %r, running %r",
+                  username, self._cfg.auth_pam_service, args)
+
+    start = time.time()
+
+    txn = self._pam.Start(self._cfg.auth_pam_service, username, password)
+    try:
+      try:
+        txn.Authenticate()
+      except errors.AuthFailedError:
+        self._AuthDone(start, _AUTH_RESULT_FAILED)
+        raise
+
+      self._AuthDone(start, _AUTH_RESULT_SUCCESS)
+
+      self._RunInSession(txn, username, args)
+    finally:
+      txn.End()
+
+  def RunAuthenticated(self, username, args):
+    # The password isn't checked, but account and session modules still run
+    txn = self._pam.Start(self._cfg.auth_pam_service, username, None)
+    try:
+      txn.CheckAccount()
+      self._RunInSession(txn, username, args)
+    finally:
+      txn.End()
+
+  def _RunInSession(self, txn, username, args):
+    """Runs the program within a PAM session.
+
+    """
+    txn.OpenSession()
+    try:
+      try:
+        returncode = self._run_fn(username, args,
+                                  pam_env=txn.GetEnvironment())
+      except (KeyError, OSError) as err:
+        raise errors.AuthError("Can't run %r as user %r: %s" %
+                               (args, username, err))
+    finally:
+      txn.CloseSession()
+
+    (exitcode, signum) = utils.GetExitcodeSignal(returncode)
+
+    logging.debug("Authenticated program finished (exitstatus=%s, "
+                  "signalstatus=%s)", exitcode, signum)
+
+
+def _HashPassword(username, password, salt):
+  """Returns a salted hash of a user's password.
+
+  @type salt: str
+  @param salt: Hex-encoded salt
+
+  """
+  return hashlib.pbkdf2_hmac(_CACHE_HASH_NAME,
+                             ("%s\0%s" % (username, password)).encode("UTF-8"),
+                             bytes.fromhex(salt),
+                             _CACHE_HASH_ROUNDS).hex()
+
+
+def _NewHashEntry(username, password, now):
+  """Returns a new cache entry for a password.
+
+  @rtype: list
+  @return: List of [salt, hash, timestamp]
+
+  """
+  salt = os.urandom(_CACHE_SALT_BYTES).hex()
+  return [salt, _HashPassword(username, password, salt), now]
+
+
+def _MatchHashEntry(entry, username, password):
+  (salt, hashed, _) = entry
+  return _HashPassword(username, password, salt) == hashed
+
+
+def _RunSshControl(args):
+  """Runs an SSH control command (e.g. C{ssh -O stop}).
+
+  """
+  return os.spawnv(os.P_WAIT, args[0], args)
+
+
+class SshConnectionPool(object):
+  """Pool of SSH master connections, one per user and host.
+
+  The first login of a user creates a master connection, which SSH keeps for
+  C{idle_timeout} seconds after its last session ended (C{ControlPersist}).
+  Later logins with the same password run over the master connection without
+  a new key exchange or password authentication. To check the password, a
+  salted hash is stored next to the control socket.
+
+  """
+  def __init__(self, directory, size, idle_timeout, ssh,
+               _time=time, _run_fn=_RunSshControl):
+    """Initializes this class.
+
+    @type directory: str
+    @param directory: Directory for control sockets, created if missing
+    @type size: int
+    @param size: Maximum number of master connections
+    @type idle_timeout: int
+    @param idle_timeout: Seconds for which unused master connections are kept
+    @type ssh: str
+    @param ssh: Path to ssh program
+
+    """
+    assert size > 0
+
+    self._directory = directory
+    self._size = size
+    self._idle_timeout = idle_timeout
+    self._ssh = ssh
+    self._time = _time
+    self._run_fn = _run_fn
+
+  def _GetPaths(self, username, host, port):
+    """Returns the control socket and verifier paths for a connection.
+
+    """
+    # Control socket paths are limited in length, hence the name is hashed
+    key = hashlib.sha256(("%s@%s:%s" % (username, host, port)).encode("UTF-8"))
+    path = os.path.join(self._directory, key.hexdigest()[:32])
+    return (path + _SSH_POOL_SOCKET_SUFFIX, path + _SSH_POOL_VERIFIER_SUFFIX)
+
+  def _EnsureDirectory(self):
+    try:
+      os.mkdir(self._directory, 0o700)
+    except OSError as err:
+      if err.errno != errno.EEXIST:
+        raise
+
+  @staticmethod
+  def _IsAlive(sockpath):
+    """Checks whether a master connection is listening on a control socket.
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(sockpath)
+    except socket.error:
+      return False
+    finally:
+      sock.close()
+
+    return True
+
+  @staticmethod
+  def _LoadVerifier(filename):
+    try:
+      entry = serializer.LoadJson(open(filename).read())
+    except (IOError, ValueError):
+      return None
+
+    if not (isinstance(entry, list) and len(entry) == 3):
+      return None
+
+    return entry
+
+  def _Remove(self, sockpath, verifier):
+    """Removes a master connection from the pool.
+
+    The master connection stops accepting new sessions. Running sessions are
+    not affected.
+
+    """
+    if self._IsAlive(sockpath):
+      logging.debug("Stopping SSH master connection %s", sockpath)
+      self._run_fn([self._ssh, "-S", sockpath, "-O", "stop", "quicknx-pool"])
+
+    utils.RemoveFile(sockpath)
+    utils.RemoveFile(verifier)
+
+  def _Evict(self, keep):
+    """Removes least recently used connections until C{keep} are left.
+
+    """
+    entries = []
+
+    for name in utils.ListVisibleFiles(self._directory):
+      if not name.endswith(_SSH_POOL_VERIFIER_SUFFIX):
+        continue
+
+      verifier = os.path.join(self._directory, name)
+      sockpath = (verifier[:-len(_SSH_POOL_VERIFIER_SUFFIX)] +
+                  _SSH_POOL_SOCKET_SUFFIX)
+
+      try:
+        mtime = os.stat(verifier).st_mtime
+      except OSError:
+        continue
+
+      entries.append((mtime, sockpath, verifier))
+
+    entries.sort()
+
+    while len(entries) > keep:
+      (_, sockpath, verifier) = entries.pop(0)
+      self._Remove(sockpath, verifier)
+
+  def GetOptions(self, username, host, port, password):
+    """Returns the SSH options for a login.
+
+    @rtype: tuple
+    @return: List of options and whether a new master connection is created;
+      if so, L{Add} must be called once the password was accepted
+
+    """
+    self._EnsureDirectory()
+
+    (sockpath, verifier) = self._GetPaths(username, host, port)
+
+    if self._IsAlive(sockpath):
+      entry = self._LoadVerifier(verifier)
+
+      if entry and self._time.time() - entry[2] <= _SSH_POOL_MAX_AGE:
+        if not _MatchHashEntry(entry, username, password):
+          # Different password, leave the existing connection alone
+          logging.debug("Password doesn't match SSH master connection %s",
+                        sockpath)
+          return (["-oControlMaster=no", "-oControlPath=none"], False)
+
+        logging.debug("Reusing SSH master connection %s", sockpath)
+
+        # Mark as recently used
+        now = self._time.time()
+        os.utime(verifier, (now, now))
+
+        # If the master connection is gone by now, SSH connects on its own
+        return (["-oControlMaster=no", "-oControlPath=%s" % sockpath], False)
+
+    # Expired, stale or unknown connection
+    self._Remove(sockpath, verifier)
+    self._Evict(self._size - 1)
+
+    logging.debug("Creating SSH master connection %s", sockpath)
+
+    return (["-oControlMaster=yes",
+             "-oControlPath=%s" % sockpath,
+             "-oControlPersist=%d" % self._idle_timeout], True)
+
+  def Add(self, username, host, port, password):
+    """Records the password for a newly created master connection.
+
+    """
+    (_, verifier) = self._GetPaths(username, host, port)
+    now = self._time.time()
+    utils.WriteFile(verifier,
+                    data=serializer.DumpJson(_NewHashEntry(username, password,
+                                                           now)),
+                    mode=0o600)
+    os.utime(verifier, (now, now))
+
+
+class AuthCache(object):
+  """Persistent cache of authentication results.
+
+  Only salted hashes of passwords are stored. Entries per user::
+
+    {
+      "verified": [salt, hash, timestamp] or None,
+      "failed": [[salt, hash, timestamp], ...],
+    }
+
+  """
+  def __init__(self, filename, _time=time):
+    """Initializes this class.
+
+    @type filename: str
+    @param filename: Path to cache file
+
+    """
+    self._filename = filename
+    self._time = _time
+
+  def _Load(self):
+    try:
+      fh = open(self._filename)
+      try:
+        data = serializer.LoadJson(fh.read())
+      finally:
+        fh.close()
+    except (IOError, ValueError):
+      return {}
+
+    if not isinstance(data, dict):
+      return {}
+
+    return data
+
+  def GetEntry(self, username):
+    """Returns the cached results of a user.
+
+    The result can be passed to L{IsVerified}, L{IsRecentFailure} and
+    L{CountFailures} to read the cache only once for several checks.
+
+    @rtype: dict
+
+    """
+    entry = self._Load().get(username, None)
+    if not isinstance(entry, dict):
+      return {}
+    return entry
+
+  def _Update(self, username, fn, max_age):
+    """Modifies the entry of a user while holding the lock.
+
+    Entries older than C{max_age} seconds are removed.
+
+    """
+    lock = utils.FileLock(self._filename + ".lock")
+    try:
+      lock.Exclusive()
+
+      data = self._Load()
+      now = self._time.time()
+
+      entry = data.get(username, None)
+      if not isinstance(entry, dict):
+        entry = {}
+
+      fn(entry, now)
+
+      data[username] = entry
+
+      # Remove expired data
+      for (name, userentry) in list(data.items()):
+        verified = userentry.get("verified", None)
+        if verified and now - verified[2] > max_age:
+          verified = None
+
+        failed = [i for i in userentry.get("failed", [])
+                  if now - i[2] <= max_age]
+
+        if verified or failed:
+          data[name] = {"verified": verified, "failed": failed}
+        else:
+          del data[name]
+
+      utils.WriteFile(self._filename, data=serializer.DumpJson(data),
+                      mode=0o600)
+    finally:
+      lock.Close()
+
+  def IsVerified(self, username, password, ttl, entry=None):
+    """Checks whether a password was verified within the last C{ttl} seconds.
+
+    @type entry: dict
+    @param entry: Result of L{GetEntry}, read from the cache if not given
+
+    """
+    if entry is None:
+      entry = self.GetEntry(username)
+
+    verified = entry.get("verified", None)
+    return bool(verified and
+                self._time.time() - verified[2] <= ttl and
+                _MatchHashEntry(verified, username, password))
+
+  def IsRecentFailure(self, username, password, ttl, entry=None):
+    """Checks whether a password failed within the last C{ttl} seconds.
+
+    @type entry: dict
+    @param entry: Result of L{GetEntry}, read from the cache if not given
+
+    """
+    if entry is None:
+      entry = self.GetEntry(username)
+
+    now = self._time.time()
+    for failure in entry.get("failed", []):
+      if (now - failure[2] <= ttl and
+          _MatchHashEntry(failure, username, password)):
+        return True
+    return False
+
+  def CountFailures(self, username, ttl, entry=None):
+    """Returns the number of failures within the last C{ttl} seconds.
+
+    @type entry: dict
+    @param entry: Result of L{GetEntry}, read from the cache if not given
+
+    """
+    if entry is None:
+      entry = self.GetEntry(username)
+
+    now = self._time.time()
+    return len([i for i in entry.get("failed", []) if now - i[2] <= ttl])
+
+  def AddVerified(self, username, password, max_age):
+    """Records a verified password, forgetting previous failures.
+
+    """
+    def _Fn(entry, now):
+      entry["verified"] = _NewHashEntry(username, password, now)
+      entry["failed"] = []
+    self._Update(username, _Fn, max_age)
+
+  def ResetFailures(self, username, max_age):
+    """Forgets all failures of a user.
+
+    """
+    def _Fn(entry, now):
+      entry["failed"] = []
+    self._Update(username, _Fn, max_age)
+
+  def AddFailure(self, username, password, max_age):
+    """Records a failed password.
+
+    """
+    def _Fn(entry, now):
+      failed = entry.get("failed", [])
+      failed.append(_NewHashEntry(username, password, now))
+      entry["failed"] = failed[-_CACHE_MAX_FAILURES_KEPT:]
+      entry["verified"] = None
+    self._Update(username, _Fn, max_age)
+
+
+class CachingAuthenticator(object):
+  """Authenticator remembering recent results of another authenticator.
+
+  Recently verified passwords skip authentication if the wrapped
+  authenticator supports it (see L{_AuthBase.CAN_SKIP_AUTH}). Recently failed
+  passwords and users with too many failures are rejected without asking the
+  wrapped authenticator.
+
+  """
+  def __init__(self, cfg, authenticator, cache):
+    """Initializes this class.
+
+    @type authenticator: L{_AuthBase}
+    @param authenticator: Wrapped authenticator
+    @type cache: L{AuthCache}
+    @param cache: Cache
+
+    """
+    self._cfg = cfg
+    self._auth = authenticator
+    self._cache = cache
+
+    # Called with the result as soon as authentication is done
+    self.result_fn = None
+
+  def _GetMaxAge(self):
+    return max(self._cfg.auth_cache_ttl, self._cfg.auth_failure_ttl)
+
+  def _Lookup(self, username, password):
+    """Looks up credentials in the cache.
+
+    @rtype: str
+    @return: One of C{_CACHE_*}
+
+    """
+    cfg = self._cfg
+    cache = self._cache
+
+    if not (cfg.auth_max_failures > 0 or cfg.auth_failure_ttl > 0 or
+            (cfg.auth_cache_ttl > 0 and self._auth.CAN_SKIP_AUTH)):
+      return _CACHE_MISS
+
+    # Read only once for all checks
+    entry = cache.GetEntry(username)
+
+    if (cfg.auth_max_failures > 0 and
+        cache.CountFailures(username, cfg.auth_failure_ttl, entry=entry) >=
+        cfg.auth_max_failures):
+      return _CACHE_BLOCKED
+
+    if (cfg.auth_failure_ttl > 0 and
+        cache.IsRecentFailure(username, password, cfg.auth_failure_ttl,
+                              entry=entry)):
+      return _CACHE_NEGATIVE_HIT
+
+    if (cfg.auth_cache_ttl > 0 and self._auth.CAN_SKIP_AUTH and
+        cache.IsVerified(username, password, cfg.auth_cache_ttl,
+                         entry=entry)):
+      return _CACHE_HIT
+
+    return _CACHE_MISS
+
+  def _HandleResult(self, username, password, result):
+    """Updates the cache after authentication.
+
+    """
+    cfg = self._cfg
+
+    try:
+      if result == _AUTH_RESULT_SUCCESS:
+        if cfg.auth_cache_ttl > 0:
+          self._cache.AddVerified(username, password, self._GetMaxAge())
+        elif cfg.auth_max_failures > 0:
+          self._cache.ResetFailures(username, self._GetMaxAge())
+
+      elif result == _AUTH_RESULT_FAILED:
+        if cfg.auth_failure_ttl > 0:
+          self._cache.AddFailure(username, password, self._GetMaxAge())
+
+    except EnvironmentError:
+      logging.exception("Failed to update authentication cache")
+
+    if self.result_fn:
+      self.result_fn(result)
+
+  def AuthenticateAndRun(self, username, password, args):
+    result = self._Lookup(username, password)
+
+    _AUTH_CACHE_REQUESTS.Inc(labels={"result": result})
+
+    logging.debug("Authentication cache lookup for %r: %s", username, result)
+
+    if result == _CACHE_BLOCKED:
+      raise errors.AuthFailedError("Too many failed authentication attempts"
+                                   " for user %r" % username)
+
+    if result == _CACHE_NEGATIVE_HIT:
+      raise errors.AuthFailedError("Password failed recently for user %r" %
+                                   username)
+
+    if result == _CACHE_HIT:
+      if self.result_fn:
+        self.result_fn(_AUTH_RESULT_SUCCESS)
+      return self._auth.RunAuthenticated(username, args)
+
+    self._auth.result_fn = \
+      lambda result: self._HandleResult(username, password, result)
+
+    return self._auth.AuthenticateAndRun(username, password, args)
+
+
+def _GetAuthCacheFile():
+  return "%s/%s.json" % (constants.AUTH_CACHE_DIR, utils.GetCurrentUserName())
+
+
+def _GetSshPoolDir():
+  return "%s/%s" % (constants.AUTH_SSH_POOL_DIR, utils.GetCurrentUserName())
+
+
 _AUTH_METHOD_MAP = {
   constants.AUTH_METHOD_SU: SuAuth,
   constants.AUTH_METHOD_SSH: SshAuth,
+  constants.AUTH_METHOD_PAM: PamAuth,
   }
 
 
@@ -246,4 +1478,12 @@ def GetAuthenticator(cfg, _method_map=_AUTH_METHOD_MAP):
   except KeyError:
     raise errors.UnknownAuthMethod("Unknown authentication method %r" % method)
 
-  return cls(cfg)
+  authenticator = cls(cfg)
+
+  if (cfg.auth_cache_ttl > 0 or
+      cfg.auth_failure_ttl > 0 or
+      cfg.auth_max_failures > 0):
+    cache = AuthCache(_GetAuthCacheFile())
+    authenticator = CachingAuthenticator(cfg, authenticator, cache)
+
+  return authenticator
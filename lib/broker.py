@@ -0,0 +1,436 @@
+#
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Module for the connection broker.
+
+The broker is a long-running process serving logins without starting a new
+Python interpreter for each of them. A client (usually nxbroker-client, the
+login shell of the nx user) connects to the broker's Unix socket, passes its
+stdin and stdout using SCM_RIGHTS and sends its environment. The broker forks
+a child for the connection, which runs the login on the passed file
+descriptors and reports the exit status back to the client.
+
+Request format: the magic string, sent together with the file descriptors,
+followed by the environment as NUL-terminated "name=value" strings and an
+empty string. The reply is a single byte containing the exit status.
+
+"""
+
+
+import array
+import errno
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+
+from quicknx import constants
+from quicknx import errors
+from quicknx import utils
+
+
+REQUEST_MAGIC = b"QNXBROKER1\n"
+
+# stdin and stdout, stderr stays with the broker to be logged
+FD_COUNT = 2
+
+_MAX_REQUEST_SIZE = 64 * 1024
+_REQUEST_TIMEOUT = 10
+_LISTEN_BACKLOG = 128
+
+# Seconds between checks for exited children
+_REAP_INTERVAL = 1.0
+
+_STRUCT_UCRED = "3i"
+
+
+def GetPeerUid(sock):
+  """Returns the user ID of the process connected to a Unix socket.
+
+  @type sock: socket.socket
+  @param sock: Connected Unix socket
+  @rtype: int
+
+  """
+  creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                          struct.calcsize(_STRUCT_UCRED))
+  (_, uid, _) = struct.unpack(_STRUCT_UCRED, creds)
+  return uid
+
+
+def SendRequest(sock, fds, env):
+  """Sends a request to the broker.
+
+  @type sock: socket.socket
+  @param sock: Socket connected to the broker
+  @type fds: list
+  @param fds: File descriptors to use as stdin and stdout
+  @type env: dict
+  @param env: Environment variables
+
+  """
+  assert len(fds) == FD_COUNT
+
+  sock.sendmsg([REQUEST_MAGIC],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                  array.array("i", fds))])
+
+  data = b"".join([os.fsencode("%s=%s" % item) + b"\0"
+                   for item in env.items()])
+  sock.sendall(data + b"\0")
+
+
+def ReadReply(sock):
+  """Waits for the broker to report the exit status.
+
+  @type sock: socket.socket
+  @param sock: Socket connected to the broker
+  @rtype: int
+  @return: Exit status of the login
+
+  """
+  try:
+    data = sock.recv(1)
+  except socket.error as err:
+    raise errors.BrokerError("Error while waiting for exit status: %s" % err)
+
+  if not data:
+    raise errors.BrokerError("Broker closed connection without exit status")
+  return ord(data)
+
+
+def _ReceiveFds(sock):
+  """Receives the magic string together with the file descriptors.
+
+  """
+  fdsize = array.array("i").itemsize * FD_COUNT
+
+  (data, ancdata, flags, _) = \
+    sock.recvmsg(len(REQUEST_MAGIC), socket.CMSG_SPACE(fdsize))
+
+  fds = array.array("i")
+  for (level, kind, cmsg_data) in ancdata:
+    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+      fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) %
+                                                 fds.itemsize)])
+
+  fds = list(fds)
+
+  if not (data or fds):
+    raise errors.BrokerError("Connection closed before request")
+
+  if (data != REQUEST_MAGIC or len(fds) != FD_COUNT or
+      flags & socket.MSG_CTRUNC):
+    for fd in fds:
+      utils.CloseFd(fd)
+    raise errors.BrokerError("Invalid request")
+
+  return fds
+
+
+def _ReceiveEnvironment(sock):
+  """Receives the environment following the file descriptors.
+
+  """
+  data = b""
+  while not (data.endswith(b"\0\0") or data == b"\0"):
+    if len(data) > _MAX_REQUEST_SIZE:
+      raise errors.BrokerError("Request too large")
+
+    buf = sock.recv(4096)
+    if not buf:
+      raise errors.BrokerError("Connection closed during request")
+
+    data += buf
+
+  env = {}
+  for item in data[:-1].split(b"\0")[:-1]:
+    (name, sep, value) = os.fsdecode(item).partition("=")
+    if sep:
+      env[name] = value
+
+  return env
+
+
+def ReceiveRequest(sock):
+  """Receives a request from a client.
+
+  @type sock: socket.socket
+  @param sock: Connection from client
+  @rtype: tuple
+  @return: File descriptors and environment
+
+  """
+  sock.settimeout(_REQUEST_TIMEOUT)
+  try:
+    fds = _ReceiveFds(sock)
+    try:
+      env = _ReceiveEnvironment(sock)
+    except:
+      for fd in fds:
+        utils.CloseFd(fd)
+      raise
+  except socket.timeout:
+    raise errors.BrokerError("Timeout while receiving request")
+  finally:
+    sock.settimeout(None)
+
+  return (fds, env)
+
+
+def _ReplaceStdio(fds):
+  """Makes the passed file descriptors this process' stdin and stdout.
+
+  """
+  sys.stdout.flush()
+
+  for (target, fd) in zip([constants.STDIN_FILENO, constants.STDOUT_FILENO],
+                          fds):
+    if fd != target:
+      os.dup2(fd, target)
+      os.close(fd)
+
+  # The original objects stay referenced by sys.__stdin__ and sys.__stdout__
+  sys.stdin = open(constants.STDIN_FILENO, "r", closefd=False)
+  sys.stdout = open(constants.STDOUT_FILENO, "w", closefd=False)
+
+
+def _CallHandler(fn):
+  """Calls the handler of a connection and returns its exit status.
+
+  """
+  try:
+    status = fn()
+  except SystemExit as err:
+    status = err.code
+  except Exception:
+    logging.exception("Error while serving connection")
+    return constants.EXIT_FAILURE
+
+  if status is None:
+    return constants.EXIT_SUCCESS
+
+  if not isinstance(status, int):
+    return constants.EXIT_FAILURE
+
+  return status & 0xff
+
+
+class BrokerServer(object):
+  """Serves connections on a Unix socket.
+
+  Every connection is handled in its own child process. Only processes of the
+  same user as the broker are accepted.
+
+  """
+  def __init__(self, path, handler_fn, reload_fn=None, _uid=None):
+    """Initializes this class.
+
+    @type path: str
+    @param path: Path of the Unix socket
+    @type handler_fn: callable
+    @param handler_fn: Called in the child process once stdin and stdout have
+      been replaced, returns the exit status
+    @type reload_fn: callable
+    @param reload_fn: Called by L{Run} after L{RequestReload}
+
+    """
+    if _uid is None:
+      _uid = os.getuid()
+
+    self._path = path
+    self._handler_fn = handler_fn
+    self._reload_fn = reload_fn
+    self._uid = _uid
+    self._socket = None
+    self._children = set()
+    self._running = False
+    self._reload_requested = False
+
+  def Start(self):
+    """Starts listening on the socket.
+
+    """
+    self._RemoveStaleSocket()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.bind(self._path)
+      os.chmod(self._path, 0o600)
+      sock.listen(_LISTEN_BACKLOG)
+    except:
+      sock.close()
+      raise
+
+    self._socket = sock
+
+    logging.info("Listening on %s", self._path)
+
+  def _RemoveStaleSocket(self):
+    """Removes the socket of a broker which is no longer running.
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self._path)
+    except socket.error as err:
+      if err.errno == errno.ECONNREFUSED:
+        logging.info("Removing stale socket %s", self._path)
+        utils.RemoveFile(self._path)
+      elif err.errno != errno.ENOENT:
+        raise
+    else:
+      raise errors.BrokerError("Broker already running on %s" % self._path)
+    finally:
+      sock.close()
+
+  def Stop(self):
+    """Makes L{Run} return.
+
+    Can be called from a signal handler.
+
+    """
+    self._running = False
+
+  def RequestReload(self):
+    """Makes L{Run} call the reload function before the next connection.
+
+    Can be called from a signal handler.
+
+    """
+    self._reload_requested = True
+
+  def Close(self):
+    """Closes and removes the socket.
+
+    Children still serving connections are not waited for.
+
+    """
+    if self._socket is not None:
+      self._socket.close()
+      self._socket = None
+      utils.RemoveFile(self._path)
+
+  def Run(self):
+    """Accepts connections until L{Stop} is called.
+
+    """
+    assert self._socket is not None
+
+    poller = select.poll()
+    poller.register(self._socket.fileno(), select.POLLIN)
+
+    self._running = True
+
+    while self._running:
+      ready = poller.poll(_REAP_INTERVAL * 1000)
+
+      if self._reload_requested:
+        self._reload_requested = False
+        if self._reload_fn:
+          self._reload_fn()
+
+      if ready:
+        try:
+          (conn, _) = self._socket.accept()
+        except socket.error as err:
+          if err.errno in (errno.EAGAIN, errno.ECONNABORTED):
+            continue
+          raise
+
+        try:
+          self._Fork(conn)
+        finally:
+          conn.close()
+
+      self._ReapChildren()
+
+  def _ReapChildren(self):
+    """Collects exited children.
+
+    """
+    for pid in list(self._children):
+      (result, status) = os.waitpid(pid, os.WNOHANG)
+      if result:
+        self._children.discard(pid)
+        logging.debug("Connection handler %s exited (status %s)", pid, status)
+
+  def _Fork(self, conn):
+    """Starts a child process for a new connection.
+
+    """
+    pid = os.fork()
+    if pid == 0:
+      status = constants.EXIT_FAILURE
+      try:
+        self._socket.close()
+
+        for signum in (signal.SIGCHLD, signal.SIGHUP, signal.SIGINT,
+                       signal.SIGTERM):
+          signal.signal(signum, signal.SIG_DFL)
+
+        status = self._Serve(conn)
+      except errors.BrokerError as err:
+        logging.error("Can't serve connection: %s", err)
+      except Exception:
+        logging.exception("Error while serving connection")
+      finally:
+        utils.FlushLogging()
+        os._exit(status)
+
+    self._children.add(pid)
+
+    logging.debug("Started connection handler %s", pid)
+
+  def _Serve(self, conn):
+    """Serves one connection in the child process.
+
+    """
+    peer_uid = GetPeerUid(conn)
+    if peer_uid != self._uid:
+      logging.error("Rejecting connection from user ID %s", peer_uid)
+      return constants.EXIT_FAILURE
+
+    start = time.time()
+
+    (fds, env) = ReceiveRequest(conn)
+
+    _ReplaceStdio(fds)
+
+    os.environ.clear()
+    os.environ.update(env)
+
+    logging.debug("Received request in %.6f seconds", time.time() - start)
+
+    status = _CallHandler(self._handler_fn)
+
+    try:
+      sys.stdout.flush()
+      conn.sendall(struct.pack("B", status))
+    except EnvironmentError:
+      logging.debug("Client went away before exit status was sent",
+                    exc_info=True)
+
+    return status
@@ -31,6 +31,10 @@ from quicknx import constants
 from quicknx import utils
 
 
+# Number of modules listed by --import-profile
+_IMPORT_PROFILE_LINES = 30
+
+
 class GenericProgram(object):
   def __init__(self, logsetup):
     self.logsetup = logsetup
@@ -45,7 +49,11 @@ class GenericProgram(object):
     logtostderr_opt = optparse.make_option("--logtostderr", default=False,
                                            action="store_true",
                                            help="Log to stderr")
-    return [debug_opt, logtostderr_opt]
+    import_profile_opt = \
+      optparse.make_option("--import-profile", default=False,
+                           action="store_true",
+                           help="Print time needed to import modules and exit")
+    return [debug_opt, logtostderr_opt, import_profile_opt]
 
   def Main(self):
     self.logsetup.Init()
@@ -55,9 +63,11 @@ class GenericProgram(object):
     try:
       (self.options, self.args) = self.ParseArgs()
 
-      self.cfg = config.Config(constants.CONFIG_FILE)
+      if self.options.import_profile:
+        self.PrintImportProfile()
+        return
 
-      self._ConfigLogging()
+      self.LoadConfig()
 
       self.Run()
 
@@ -73,6 +83,36 @@ class GenericProgram(object):
                                    formatter=optparse.TitledHelpFormatter())
     return parser.parse_args()
 
+  def LoadConfig(self):
+    """(Re)loads the configuration and applies its logging options.
+
+    """
+    self.cfg = config.LoadConfig(constants.CONFIG_FILE)
+
+    self._ConfigLogging()
+
+  def PrintImportProfile(self):
+    """Prints the modules loaded when starting this program.
+
+    Modules are sorted by their import time, including their own imports.
+
+    """
+    module = self.__class__.__module__
+    profile = utils.ProfileImports(module)
+
+    columns = [
+      ("Module", 40, lambda item: item[0]),
+      ("Self (ms)", -10, lambda item: "%.1f" % (item[1] / 1000.0)),
+      ("Total (ms)", -10, lambda item: "%.1f" % (item[2] / 1000.0)),
+      ]
+
+    data = sorted(profile, key=lambda item: item[2], reverse=True)
+
+    print("\n".join(utils.FormatTable(data[:_IMPORT_PROFILE_LINES],
+                                      columns)))
+    print("%d modules, %.1f ms for %s" %
+          (len(profile), sum(i[1] for i in profile) / 1000.0, module))
+
   def _ConfigLogging(self):
     """Configures the logging module.
 
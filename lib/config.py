@@ -22,17 +22,38 @@
 """Module for config functions"""
 
 
-import configparser
+import errno
+import logging
+import marshal
 import os
 import socket
 
 from quicknx import constants
+from quicknx import errors
 from quicknx import utils
 
 
+# Only needed if there's no up-to-date snapshot
+configparser = utils.LazyModule("configparser")
+
+
 VAR_AUTH_METHOD = "auth-method"
 VAR_AUTH_SSH_HOST = "auth-ssh-host"
 VAR_AUTH_SSH_PORT = "auth-ssh-port"
+VAR_AUTH_PAM_SERVICE = "auth-pam-service"
+VAR_AUTH_CACHE_TTL = "auth-cache-ttl"
+VAR_AUTH_FAILURE_TTL = "auth-failure-ttl"
+VAR_AUTH_MAX_FAILURES = "auth-max-failures"
+VAR_AUTH_RELAY = "auth-relay"
+VAR_AUTH_SSH_POOL_SIZE = "auth-ssh-pool-size"
+VAR_AUTH_SSH_POOL_IDLE = "auth-ssh-pool-idle"
+VAR_LOGIN_MAX_CONCURRENT = "login-max-concurrent"
+VAR_LOGIN_MAX_QUEUED = "login-max-queued"
+VAR_LOGIN_QUEUE_TIMEOUT = "login-queue-timeout"
+VAR_LOGIN_READ_TIMEOUT = "login-read-timeout"
+VAR_SERVER_READ_TIMEOUT = "server-read-timeout"
+VAR_SESSION_PROXY = "session-proxy"
+VAR_SESSION_PROXY_BUFFER_SIZE = "session-proxy-buffer-size"
 VAR_LOGLEVEL = "loglevel"
 VAR_START_KDE_COMMAND = "start-kde-command"
 VAR_START_GNOME_COMMAND = "start-gnome-command"
@@ -47,11 +68,19 @@ VAR_XAUTH = "xauth-path"
 VAR_XSESSION = "xsession-path"
 VAR_NXAGENT = "nxagent-path"
 VAR_USE_XSESSION = "use-xsession"
+VAR_METRICS_INTERVAL = "metrics-interval"
+VAR_HOSTNAME = "hostname"
+VAR_HOSTNAME_CACHE_TTL = "hostname-cache-ttl"
+VAR_HOSTNAME_RESOLVE_TIMEOUT = "hostname-resolve-timeout"
+VAR_USER_CACHE_TTL = "user-cache-ttl"
 
 _LOGLEVEL_DEBUG = "debug"
 
 _GLOBAL_SECTION = "global"
 
+# Increase when the attributes of Config change
+_SNAPSHOT_VERSION = 4
+
 
 def _ReadConfig(filename):
   cfg = configparser.RawConfigParser()
@@ -65,9 +94,29 @@ def __GetDefault(func):
     return default
   return wrapped
 
-_GetOption = __GetDefault(configparser.RawConfigParser.get)
-_GetBoolOption = __GetDefault(configparser.RawConfigParser.getboolean)
-_GetIntOption = __GetDefault(configparser.RawConfigParser.getint)
+_GetOption = __GetDefault(lambda cfg, section, name: cfg.get(section, name))
+_GetBoolOption = \
+  __GetDefault(lambda cfg, section, name: cfg.getboolean(section, name))
+_GetIntOption = \
+  __GetDefault(lambda cfg, section, name: cfg.getint(section, name))
+
+
+def _GetChoiceOption(cfg, section, name, default, choices):
+  """Returns an option which must have one of the given values.
+
+  @type choices: frozenset
+  @param choices: Allowed values
+  @raise errors.ConfigurationError: When the value isn't allowed
+
+  """
+  value = _GetOption(cfg, section, name, default)
+
+  if value not in choices:
+    raise errors.ConfigurationError("Invalid value %r for %s, must be one of"
+                                    " %s" % (value, name,
+                                             ", ".join(sorted(choices))))
+
+  return value
 
 
 def _GetSshPort():
@@ -126,6 +175,53 @@ class Config(object):
                                     _hostname)
     self.auth_ssh_port = _GetIntOption(cfg, section, VAR_AUTH_SSH_PORT,
                                        _GetSshPort())
+    self.auth_pam_service = _GetOption(cfg, section, VAR_AUTH_PAM_SERVICE,
+                                       constants.AUTH_PAM_SERVICE_DEFAULT)
+
+    self.auth_cache_ttl = \
+      _GetIntOption(cfg, section, VAR_AUTH_CACHE_TTL,
+                    constants.DEFAULT_AUTH_CACHE_TTL)
+    self.auth_failure_ttl = \
+      _GetIntOption(cfg, section, VAR_AUTH_FAILURE_TTL,
+                    constants.DEFAULT_AUTH_FAILURE_TTL)
+    self.auth_max_failures = \
+      _GetIntOption(cfg, section, VAR_AUTH_MAX_FAILURES,
+                    constants.DEFAULT_AUTH_MAX_FAILURES)
+
+    self.auth_relay = _GetChoiceOption(cfg, section, VAR_AUTH_RELAY,
+                                       constants.AUTH_RELAY_DEFAULT,
+                                       constants.VALID_AUTH_RELAYS)
+
+    self.auth_ssh_pool_size = \
+      _GetIntOption(cfg, section, VAR_AUTH_SSH_POOL_SIZE,
+                    constants.DEFAULT_AUTH_SSH_POOL_SIZE)
+    self.auth_ssh_pool_idle = \
+      _GetIntOption(cfg, section, VAR_AUTH_SSH_POOL_IDLE,
+                    constants.DEFAULT_AUTH_SSH_POOL_IDLE)
+
+    self.login_max_concurrent = \
+      _GetIntOption(cfg, section, VAR_LOGIN_MAX_CONCURRENT,
+                    constants.DEFAULT_LOGIN_MAX_CONCURRENT)
+    self.login_max_queued = \
+      _GetIntOption(cfg, section, VAR_LOGIN_MAX_QUEUED,
+                    constants.DEFAULT_LOGIN_MAX_QUEUED)
+    self.login_queue_timeout = \
+      _GetIntOption(cfg, section, VAR_LOGIN_QUEUE_TIMEOUT,
+                    constants.DEFAULT_LOGIN_QUEUE_TIMEOUT)
+
+    self.login_read_timeout = \
+      _GetIntOption(cfg, section, VAR_LOGIN_READ_TIMEOUT,
+                    constants.DEFAULT_LOGIN_READ_TIMEOUT)
+    self.server_read_timeout = \
+      _GetIntOption(cfg, section, VAR_SERVER_READ_TIMEOUT,
+                    constants.DEFAULT_SERVER_READ_TIMEOUT)
+
+    self.session_proxy = _GetChoiceOption(cfg, section, VAR_SESSION_PROXY,
+                                          constants.SESSION_PROXY_DEFAULT,
+                                          constants.VALID_SESSION_PROXIES)
+    self.session_proxy_buffer_size = \
+      _GetIntOption(cfg, section, VAR_SESSION_PROXY_BUFFER_SIZE,
+                    constants.DEFAULT_SESSION_PROXY_BUFFER_SIZE)
 
     ver_string = _GetOption(cfg, section, VAR_NX_PROTOCOL_VERSION,
                             constants.DEFAULT_NX_PROTOCOL_VERSION)
@@ -169,8 +265,113 @@ class Config(object):
       _GetBoolOption(cfg, section, VAR_USE_XSESSION,
                      constants.USE_XSESSION)
 
+    self.metrics_interval = \
+      _GetIntOption(cfg, section, VAR_METRICS_INTERVAL,
+                    constants.DEFAULT_METRICS_INTERVAL)
+
+    self.hostname = \
+      _GetOption(cfg, section, VAR_HOSTNAME, None)
+
+    self.hostname_cache_ttl = \
+      _GetIntOption(cfg, section, VAR_HOSTNAME_CACHE_TTL,
+                    constants.DEFAULT_HOSTNAME_CACHE_TTL)
+
+    self.hostname_resolve_timeout = \
+      _GetIntOption(cfg, section, VAR_HOSTNAME_RESOLVE_TIMEOUT,
+                    constants.DEFAULT_HOSTNAME_RESOLVE_TIMEOUT)
+
+    self.user_cache_ttl = \
+      _GetIntOption(cfg, section, VAR_USER_CACHE_TTL,
+                    constants.DEFAULT_USER_CACHE_TTL)
+
     if self.use_xsession:
       self.start_kde_command = "%s %s" % \
           (self.xsession, self.start_kde_command)
       self.start_gnome_command = "%s %s" % \
           (self.xsession, self.start_gnome_command)
+
+
+def _GetSnapshotKey(filename, section, hostname):
+  """Returns the values a snapshot of the configuration depends on.
+
+  """
+  try:
+    st = os.stat(filename)
+  except EnvironmentError as err:
+    if err.errno != errno.ENOENT:
+      raise
+    # Defaults are used for a missing file
+    fileinfo = None
+  else:
+    fileinfo = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+  return (_SNAPSHOT_VERSION, os.path.abspath(filename), section, hostname,
+          fileinfo)
+
+
+def _ReadSnapshot(path, key):
+  """Reads a configuration snapshot.
+
+  @rtype: dict or None
+  @return: Configuration attributes, or None if the snapshot isn't usable
+
+  """
+  data = utils.ReadOwnFile(path)
+  if data is None:
+    return None
+
+  try:
+    (snapshot_key, attrs) = marshal.loads(data)
+  except (EOFError, ValueError, TypeError):
+    logging.debug("Invalid configuration snapshot %s", path)
+    return None
+
+  if snapshot_key != key:
+    return None
+
+  return attrs
+
+
+def _WriteSnapshot(path, key, cfg):
+  """Writes a configuration snapshot.
+
+  """
+  data = marshal.dumps((key, cfg.__dict__))
+  utils.WriteFile(path, fn=lambda fd: os.write(fd, data), mode=0o600)
+
+
+def LoadConfig(filename, section=_GLOBAL_SECTION,
+               _snapshot_dir=constants.CONFIG_SNAPSHOT_DIR, _hostname=None):
+  """Returns the configuration, using a snapshot if possible.
+
+  Parsing the configuration file also queries the hostname and the services
+  database. The resulting values are saved per user and reused while the
+  configuration file and hostname don't change.
+
+  @type filename: str
+  @param filename: Path to configuration file
+  @rtype: L{Config}
+
+  """
+  if _hostname is None:
+    _hostname = socket.gethostname()
+
+  key = _GetSnapshotKey(filename, section, _hostname)
+
+  path = os.path.join(_snapshot_dir, "config-%s" % os.getuid())
+
+  attrs = _ReadSnapshot(path, key)
+  if attrs is not None:
+    cfg = Config.__new__(Config)
+    cfg.__dict__.update(attrs)
+    return cfg
+
+  cfg = Config(filename, section=section, _hostname=_hostname)
+
+  try:
+    _WriteSnapshot(path, key, cfg)
+  except (EnvironmentError, ValueError) as err:
+    # ValueError is raised by marshal for unsupported attribute types
+    logging.debug("Can't write configuration snapshot %s: %s", path, err)
+
+  return cfg
@@ -40,6 +40,7 @@ START_KDE_COMMAND = "startkde"
 START_GNOME_COMMAND = "/usr/bin/gnome-session"
 
 NXUSER = "nx"
+ROOTUSER = "root"
 NXSERVER = _autoconf.PKGLIBDIR + "/nxserver"
 NXNODE = _autoconf.PKGLIBDIR + "/nxnode"
 NXNODE_WRAPPER = _autoconf.PKGLIBDIR + "/nxnode-wrapper"
@@ -58,8 +59,28 @@ CONFIG_FILE = _autoconf.SYSCONFDIR + "/quicknx.conf"
 DATA_DIR = _autoconf.LOCALSTATEDIR + "/lib/quicknx"
 SESSIONS_DIR = DATA_DIR + "/sessions"
 SESSION_DATA_FILE_NAME = "quicknx.data"
+METRICS_DIR = DATA_DIR + "/metrics"
+AUTH_CACHE_DIR = DATA_DIR + "/authcache"
+AUTH_SSH_POOL_DIR = DATA_DIR + "/sshpool"
+LOGIN_SLOTS_DIR = DATA_DIR + "/loginslots"
+CONFIG_SNAPSHOT_DIR = DATA_DIR + "/configcache"
+HOSTNAME_CACHE_DIR = DATA_DIR + "/hostcache"
+USER_CACHE_DIR = DATA_DIR + "/usercache"
+BROKER_DIR = DATA_DIR + "/broker"
+BROKER_SOCKET = BROKER_DIR + "/broker.sock"
 
 NODE_SOCKET_NAME = "nxnode.sock"
+NODE_METRICS_FILE_NAME = "metrics.prom"
+
+# Seconds between writes of nxnode's metrics file
+DEFAULT_METRICS_INTERVAL = 60
+
+# Seconds a resolved hostname is cached and the longest time to wait for it
+DEFAULT_HOSTNAME_CACHE_TTL = 3600
+DEFAULT_HOSTNAME_RESOLVE_TIMEOUT = 2
+
+# Seconds user profiles are cached across processes
+DEFAULT_USER_CACHE_TTL = 300
 
 DISPLAY_CHECK_PATHS = frozenset([
   "/tmp/.X%s-lock",
@@ -85,7 +106,58 @@ STDERR_FILENO = 2
 
 AUTH_METHOD_SU = "su"
 AUTH_METHOD_SSH = "ssh"
+AUTH_METHOD_PAM = "pam"
 AUTH_METHOD_DEFAULT = AUTH_METHOD_SSH
+AUTH_PAM_SERVICE_DEFAULT = "quicknx"
+
+# How to copy data between client and authenticated program
+AUTH_RELAY_FDCOPY = "fdcopy"
+AUTH_RELAY_SPLICE = "splice"
+AUTH_RELAY_DEFAULT = AUTH_RELAY_FDCOPY
+
+VALID_AUTH_RELAYS = frozenset([
+  AUTH_RELAY_FDCOPY,
+  AUTH_RELAY_SPLICE,
+  ])
+
+# How nxserver connects the client to the session
+SESSION_PROXY_NETCAT = "netcat"
+SESSION_PROXY_BUILTIN = "builtin"
+SESSION_PROXY_HANDOFF = "handoff"
+SESSION_PROXY_DEFAULT = SESSION_PROXY_NETCAT
+
+VALID_SESSION_PROXIES = frozenset([
+  SESSION_PROXY_NETCAT,
+  SESSION_PROXY_BUILTIN,
+  SESSION_PROXY_HANDOFF,
+  ])
+
+# Socket buffer size for the builtin session proxy, 0 for system default
+DEFAULT_SESSION_PROXY_BUFFER_SIZE = 0
+
+# Seconds for which verified passwords are remembered, 0 to disable
+DEFAULT_AUTH_CACHE_TTL = 0
+# Seconds for which failed passwords are remembered, 0 to disable
+DEFAULT_AUTH_FAILURE_TTL = 30
+# Failures within the failure TTL after which a user is rejected, 0 to disable
+DEFAULT_AUTH_MAX_FAILURES = 0
+
+# Number of pooled SSH master connections, 0 to disable
+DEFAULT_AUTH_SSH_POOL_SIZE = 0
+# Seconds for which an unused SSH master connection is kept
+DEFAULT_AUTH_SSH_POOL_IDLE = 300
+
+# Number of logins authenticating at the same time, 0 for no limit
+DEFAULT_LOGIN_MAX_CONCURRENT = 0
+# Number of logins waiting for their turn, further logins are rejected
+DEFAULT_LOGIN_MAX_QUEUED = 100
+# Seconds a login waits for its turn at most
+DEFAULT_LOGIN_QUEUE_TIMEOUT = 60
+
+# Seconds to wait for a line from the client before and after login, 0 to
+# wait forever. After login users may be choosing a session.
+DEFAULT_LOGIN_READ_TIMEOUT = 60
+DEFAULT_SERVER_READ_TIMEOUT = 1800
 
 SESS_STATE_CREATED = "created"
 SESS_STATE_STARTING = "starting"
@@ -127,6 +199,16 @@ VALID_SESS_TYPES = frozenset([
   SESS_TYPE_XDM,
   ])
 
+PHASE_LOGIN_START = "login-start"
+PHASE_LOGIN = "login"
+PHASE_NODE_DAEMON = "node-daemon"
+PHASE_NODE_CONNECT = "node-connect"
+PHASE_XAUTH = "xauth"
+PHASE_NXAGENT_SPAWN = "nxagent-spawn"
+PHASE_SESSION_STARTING = "session-starting"
+PHASE_SESSION_WAITING = "session-waiting"
+PHASE_USERAPP = "userapp"
+
 DLG_TYPE_ERROR = "error"
 DLG_TYPE_OK = "ok"
 DLG_TYPE_PANIC = "panic"
@@ -27,9 +27,37 @@
 import gobject
 import logging
 import os
+import time
+
+from quicknx import metrics
+from quicknx import utils
 
 _PROCESS_EXIT_IO_TIMEOUT = 1
 
+_CALLBACK_SECONDS = \
+  metrics.REGISTRY.GetHistogram("quicknx_mainloop_callback_seconds",
+                                "Time spent in mainloop callbacks")
+_CHILD_SECONDS = \
+  metrics.REGISTRY.GetHistogram("quicknx_child_seconds",
+                                "Time from starting a child program until"
+                                " it exited")
+_IO_BYTES = \
+  metrics.REGISTRY.GetCounter("quicknx_iochannel_bytes_total",
+                              "Bytes transferred through I/O channels")
+
+
+def ObserveCallback(source, start):
+  """Records the duration of a mainloop callback.
+
+  @type source: str
+  @param source: Kind of callback
+  @type start: float
+  @param start: Time at which the callback was entered
+
+  """
+  _CALLBACK_SECONDS.Observe(time.time() - start,
+                            labels={"source": source})
+
 
 class SignalRegistration:
   def __init__(self, emitter, handle):
@@ -190,6 +218,7 @@ class IOChannel(gobject.GObject, object):
       #data = data +"\x00"
     if data:
       #logging.debug("%r read %r bytes, %r", self, len(data), data)
+      _IO_BYTES.Inc(len(data), labels={"direction": "read"})
       self.__EmitAfterRead(data)
       return True
     #logging.debug("%r read no data", self)
@@ -225,6 +254,7 @@ class IOChannel(gobject.GObject, object):
       self.__Close()
       return False
     #logging.debug("%r wrote %r bytes",self, n)
+    _IO_BYTES.Inc(n, labels={"direction": "write"})
     self.__writepos += n
 
     assert self.__writepos <= len(self.__writebuf)
@@ -244,6 +274,13 @@ class IOChannel(gobject.GObject, object):
     """Triages I/O events.
 
     """
+    start = time.time()
+    try:
+      return self.__HandleIOInner(channel, cond)
+    finally:
+      ObserveCallback("io", start)
+
+  def __HandleIOInner(self, channel, cond):
     assert channel == self.__channel
 
     if cond & (gobject.IO_IN | gobject.IO_OUT):
@@ -440,6 +477,7 @@ class Program(gobject.GObject, object):
     self.__progname = args[0]
 
     self.__pid = None
+    self.__start_time = None
     self.__exitcode = None
     self.__child_watch_handle = None
 
@@ -547,6 +585,7 @@ class Program(gobject.GObject, object):
 
     logging.info("Child %s[%d] started", self.__progname, pid)
     self.__pid = pid
+    self.__start_time = time.time()
 
     self.stdin.Attach(stdin_fd)
     self.__stdin_fd = stdin_fd
@@ -558,6 +597,25 @@ class Program(gobject.GObject, object):
 
     return self.pid
 
+  def Wait(self, timeout=None):
+    """Waits for the program to exit.
+
+    The exit status is not collected, the L{EXITED_SIGNAL} signal is still
+    emitted from the mainloop.
+
+    @type timeout: float or None
+    @param timeout: Seconds to wait at most, None to wait forever
+    @rtype: bool
+    @return: Whether the program exited (False on timeout)
+
+    """
+    assert self.__pid is not None, "Program wasn't started"
+
+    if self.__exitcode is not None:
+      return True
+
+    return utils.WaitForChild(self.__pid, timeout=timeout)
+
   def __HandleExit(self, pid, exitcode):
     """Called when program exits.
 
@@ -570,6 +628,10 @@ class Program(gobject.GObject, object):
     assert pid == self.__pid
     assert self.__exitcode is None
 
+    progname = os.path.basename(self.__progname)
+    _CHILD_SECONDS.Observe(time.time() - self.__start_time,
+                           labels={"program": progname})
+
     self.__exitcode = exitcode
     self.__CheckExit()
 
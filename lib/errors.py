@@ -87,6 +87,18 @@ class IllegalCharacterError(GenericError):
   """
 
 
+class BrokerError(GenericError):
+  """Error in connection broker.
+
+  """
+
+
+class ConfigurationError(GenericError):
+  """Invalid value in configuration file.
+
+  """
+
+
 # Exception classes should be added above
 
 def GetErrorClass(name):
@@ -0,0 +1,538 @@
+#
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Module for latency tracing and metrics"""
+
+
+import bisect
+import time
+
+from quicknx import constants
+from quicknx import errors
+
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0)
+"""Default histogram bucket boundaries for latencies in seconds."""
+
+PHASE_TOTAL = "total"
+
+
+def MarkPhase(phases, name, _time=time):
+  """Records the time at which a phase was reached.
+
+  Only the first time is kept, e.g. the "waiting" state is reached again on
+  every session restore.
+
+  @type phases: dict
+  @param phases: Phase timestamps, modified in place
+  @type name: str
+  @param name: Phase name
+  @rtype: bool
+  @return: Whether the phase was recorded
+
+  """
+  if name in phases:
+    return False
+
+  phases[name] = _time.time()
+
+  return True
+
+
+def GetPhaseDurations(phases):
+  """Calculates how long each phase took.
+
+  A phase's duration is the time between the previous phase and itself. The
+  first phase only marks the beginning.
+
+  @type phases: dict
+  @param phases: Phase timestamps as recorded by L{MarkPhase}
+  @rtype: list of tuples
+  @return: List of (name, seconds) in chronological order, followed by
+    L{PHASE_TOTAL}
+
+  """
+  ordered = sorted(list(phases.items()), key=lambda item: item[1])
+
+  result = []
+  for idx in range(1, len(ordered)):
+    (name, timestamp) = ordered[idx]
+    result.append((name, timestamp - ordered[idx - 1][1]))
+
+  if ordered:
+    result.append((PHASE_TOTAL, ordered[-1][1] - ordered[0][1]))
+
+  return result
+
+
+class Histogram(object):
+  """Cumulative histogram with fixed bucket boundaries.
+
+  """
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    """Initializes this class.
+
+    @type buckets: sequence
+    @param buckets: Sorted upper bucket boundaries
+
+    """
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def Observe(self, value):
+    """Adds a value to the histogram.
+
+    """
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def GetCumulativeCounts(self):
+    """Returns the number of values less than or equal to each boundary.
+
+    @rtype: list of tuples
+    @return: List of (boundary, count), the last boundary is C{None} (+Inf)
+
+    """
+    result = []
+    total = 0
+
+    for (boundary, count) in zip(list(self.buckets) + [None], self.counts):
+      total += count
+      result.append((boundary, total))
+
+    return result
+
+  def Serialize(self):
+    return {
+      "buckets": list(self.buckets),
+      "counts": self.counts,
+      "sum": self.sum,
+      }
+
+  @classmethod
+  def Restore(cls, state):
+    """Restores a histogram from serialized state.
+
+    A state with different buckets is discarded.
+
+    """
+    obj = cls()
+
+    if (isinstance(state, dict) and
+        tuple(state.get("buckets", [])) == obj.buckets and
+        len(state.get("counts", [])) == len(obj.counts)):
+      obj.counts = [int(i) for i in state["counts"]]
+      obj.count = sum(obj.counts)
+      obj.sum = float(state.get("sum", 0.0))
+
+    return obj
+
+
+class PhaseLatencies(object):
+  """Latency histograms per phase and per session type.
+
+  """
+  def __init__(self):
+    # Indexed by (phase, session type)
+    self._histograms = {}
+
+  def Observe(self, sesstype, durations):
+    """Adds phase durations of one session.
+
+    @type sesstype: str
+    @param sesstype: Session type
+    @type durations: list of tuples
+    @param durations: As returned by L{GetPhaseDurations}
+
+    """
+    for (phase, seconds) in durations:
+      key = (phase, sesstype)
+      try:
+        hist = self._histograms[key]
+      except KeyError:
+        hist = self._histograms[key] = Histogram()
+      hist.Observe(seconds)
+
+  def GetHistograms(self):
+    """Returns all histograms.
+
+    @rtype: list of tuples
+    @return: Sorted list of (phase, session type, L{Histogram})
+
+    """
+    return [(phase, sesstype, hist)
+            for ((phase, sesstype), hist) in sorted(self._histograms.items())]
+
+  def Serialize(self):
+    return [[phase, sesstype, hist.Serialize()]
+            for (phase, sesstype, hist) in self.GetHistograms()]
+
+  @classmethod
+  def Restore(cls, state):
+    obj = cls()
+
+    if isinstance(state, list):
+      for item in state:
+        if isinstance(item, list) and len(item) == 3:
+          (phase, sesstype, hist) = item
+          obj._histograms[(phase, sesstype)] = Histogram.Restore(hist)
+
+    return obj
+
+
+def GetPhaseLatencyFile(username):
+  """Returns the path of the per-user phase latency file.
+
+  """
+  return "%s/latency-%s.json" % (constants.METRICS_DIR, username)
+
+
+def _EscapeLabelValue(value):
+  """Escapes a label value for the text format.
+
+  """
+  return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+          .replace("\"", "\\\""))
+
+
+def _FormatLabels(labels, extra=None):
+  """Formats labels for the text format.
+
+  @type labels: tuple
+  @param labels: Tuple of (name, value) pairs
+  @type extra: tuple
+  @param extra: Additional (name, value) pair
+
+  """
+  items = list(labels)
+  if extra is not None:
+    items.append(extra)
+
+  if not items:
+    return ""
+
+  return "{%s}" % ",".join(["%s=\"%s\"" % (name, _EscapeLabelValue(value))
+                            for (name, value) in items])
+
+
+def _FormatValue(value):
+  """Formats a sample value for the text format.
+
+  """
+  if isinstance(value, float) and value == int(value):
+    return str(int(value))
+  return str(value)
+
+
+def _GetLabelKey(labels):
+  """Converts a label dictionary to a hashable key.
+
+  @type labels: dict or None
+  @param labels: Label names and values
+
+  """
+  if not labels:
+    return ()
+  return tuple(sorted(labels.items()))
+
+
+class _Metric(object):
+  """Base class for named metrics with optional labels.
+
+  """
+  TYPE = None
+
+  def __init__(self, name, description):
+    """Initializes this class.
+
+    @type name: str
+    @param name: Metric name
+    @type description: str
+    @param description: Help text
+
+    """
+    self.name = name
+    self.description = description
+    self._values = {}
+
+  def GetLabelKeys(self):
+    """Returns the label keys for which values are known.
+
+    """
+    return sorted(self._values.keys())
+
+  def FormatText(self):
+    """Formats this metric in the Prometheus text format.
+
+    @rtype: list
+    @return: List of lines
+
+    """
+    lines = [
+      "# HELP %s %s" % (self.name, self.description),
+      "# TYPE %s %s" % (self.name, self.TYPE),
+      ]
+
+    for key in self.GetLabelKeys():
+      lines.extend(self._FormatSamples(key, self._values[key]))
+
+    return lines
+
+  def _FormatSamples(self, key, value):
+    return ["%s%s %s" % (self.name, _FormatLabels(key), _FormatValue(value))]
+
+  def Serialize(self):
+    return {
+      "type": self.TYPE,
+      "help": self.description,
+      "values": [[dict(key), self._SerializeValue(self._values[key])]
+                 for key in self.GetLabelKeys()],
+      }
+
+  def _SerializeValue(self, value):
+    return value
+
+  def Restore(self, state):
+    """Restores values from serialized state.
+
+    """
+    for (labels, value) in state.get("values", []):
+      self._values[_GetLabelKey(labels)] = self._RestoreValue(value)
+
+  def _RestoreValue(self, value):
+    return float(value)
+
+  def Merge(self, other):
+    """Merges values of another metric of the same type into this one.
+
+    """
+    raise NotImplementedError()
+
+
+class Counter(_Metric):
+  """Monotonically increasing value.
+
+  """
+  TYPE = "counter"
+
+  def Inc(self, amount=1, labels=None):
+    key = _GetLabelKey(labels)
+    self._values[key] = self._values.get(key, 0) + amount
+
+  def Get(self, labels=None):
+    return self._values.get(_GetLabelKey(labels), 0)
+
+  def Merge(self, other):
+    for (key, value) in other._values.items():
+      self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+  """Value which can go up and down.
+
+  """
+  TYPE = "gauge"
+
+  def Set(self, value, labels=None):
+    self._values[_GetLabelKey(labels)] = value
+
+  def Inc(self, amount=1, labels=None):
+    key = _GetLabelKey(labels)
+    self._values[key] = self._values.get(key, 0) + amount
+
+  def Dec(self, amount=1, labels=None):
+    self.Inc(amount=-amount, labels=labels)
+
+  def Get(self, labels=None):
+    return self._values.get(_GetLabelKey(labels), 0)
+
+  def Merge(self, other):
+    # Gauges describe the current state, newer values replace older ones
+    self._values.update(other._values)
+
+
+class LatencyHistogram(_Metric):
+  """Histogram of durations in seconds.
+
+  """
+  TYPE = "histogram"
+
+  def Observe(self, value, labels=None):
+    key = _GetLabelKey(labels)
+    try:
+      hist = self._values[key]
+    except KeyError:
+      hist = self._values[key] = Histogram()
+    hist.Observe(value)
+
+  def Get(self, labels=None):
+    return self._values.get(_GetLabelKey(labels), None)
+
+  def _FormatSamples(self, key, hist):
+    lines = []
+
+    for (boundary, count) in hist.GetCumulativeCounts():
+      if boundary is None:
+        le = "+Inf"
+      else:
+        le = _FormatValue(boundary)
+      lines.append("%s_bucket%s %s" %
+                   (self.name, _FormatLabels(key, extra=("le", le)), count))
+
+    lines.append("%s_sum%s %s" % (self.name, _FormatLabels(key),
+                                  _FormatValue(hist.sum)))
+    lines.append("%s_count%s %s" % (self.name, _FormatLabels(key), hist.count))
+
+    return lines
+
+  def _SerializeValue(self, hist):
+    return hist.Serialize()
+
+  def _RestoreValue(self, value):
+    return Histogram.Restore(value)
+
+  def Merge(self, other):
+    for (key, hist) in other._values.items():
+      try:
+        own = self._values[key]
+      except KeyError:
+        own = self._values[key] = Histogram(buckets=hist.buckets)
+
+      if own.buckets != hist.buckets:
+        continue
+
+      own.counts = [a + b for (a, b) in zip(own.counts, hist.counts)]
+      own.count += hist.count
+      own.sum += hist.sum
+
+
+_METRIC_TYPES = dict([(cls.TYPE, cls)
+                      for cls in [Counter, Gauge, LatencyHistogram]])
+
+
+class Registry(object):
+  """Collection of metrics.
+
+  """
+  def __init__(self):
+    self._metrics = {}
+
+  def _Get(self, cls, name, description):
+    """Returns a metric, creating it if necessary.
+
+    """
+    try:
+      metric = self._metrics[name]
+    except KeyError:
+      metric = self._metrics[name] = cls(name, description)
+
+    if not isinstance(metric, cls):
+      raise errors.ProgrammerError("Metric %r registered with type %r" %
+                                   (name, metric.TYPE))
+
+    return metric
+
+  def GetCounter(self, name, description):
+    return self._Get(Counter, name, description)
+
+  def GetGauge(self, name, description):
+    return self._Get(Gauge, name, description)
+
+  def GetHistogram(self, name, description):
+    return self._Get(LatencyHistogram, name, description)
+
+  def GetMetrics(self):
+    """Returns all metrics sorted by name.
+
+    """
+    return [self._metrics[name] for name in sorted(self._metrics.keys())]
+
+  def FormatText(self):
+    """Formats all metrics in the Prometheus text format.
+
+    Metrics without any values are left out.
+
+    @rtype: str
+
+    """
+    lines = []
+
+    for metric in self.GetMetrics():
+      if metric.GetLabelKeys():
+        lines.extend(metric.FormatText())
+
+    return "".join(["%s\n" % line for line in lines])
+
+  def Serialize(self):
+    return dict([(metric.name, metric.Serialize())
+                 for metric in self.GetMetrics()])
+
+  @classmethod
+  def Restore(cls, state):
+    """Restores a registry from serialized state.
+
+    Metrics of unknown type are discarded.
+
+    """
+    obj = cls()
+
+    if isinstance(state, dict):
+      for (name, data) in state.items():
+        if not isinstance(data, dict):
+          continue
+
+        metric_cls = _METRIC_TYPES.get(data.get("type"), None)
+        if metric_cls is None:
+          continue
+
+        metric = obj._Get(metric_cls, name, data.get("help", ""))
+        metric.Restore(data)
+
+    return obj
+
+  def Merge(self, other):
+    """Merges all metrics from another registry into this one.
+
+    @type other: L{Registry}
+
+    """
+    for metric in other.GetMetrics():
+      self._Get(metric.__class__, metric.name, metric.description).Merge(metric)
+
+
+REGISTRY = Registry()
+"""Process-wide metrics registry."""
+
+
+def GetProgramMetricsPath(program, username):
+  """Returns the path, without extension, of the metrics files for a program.
+
+  @type program: str
+  @param program: Program name
+  @type username: str
+  @param username: User running the program
+
+  """
+  return "%s/%s-%s" % (constants.METRICS_DIR, program, username)
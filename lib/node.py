@@ -28,25 +28,32 @@ import collections
 import errno
 import logging
 import os
-import pwd
 import random
 import socket
 import sys
+import threading
+import time
 
 from io import StringIO
 
-from quicknx import agent
 from quicknx import constants
-from quicknx import daemon
 from quicknx import errors
+from quicknx import metrics
 from quicknx import protocol
 from quicknx import serializer
 from quicknx import session
+from quicknx import userdb
 from quicknx import utils
 
 
+# Only needed by the node daemon, their import loads gobject
+agent = utils.LazyModule("quicknx.agent")
+daemon = utils.LazyModule("quicknx.daemon")
+
+
 REQ_FIELD_CMD = "cmd"
 REQ_FIELD_ARGS = "args"
+REQ_FIELD_PHASES = "phases"
 
 RESP_FIELD_SUCCESS = "success"
 RESP_FIELD_RESULT = "result"
@@ -57,20 +64,154 @@ CMD_RESTORESESSION = "restore"
 CMD_TERMINATESESSION = "terminate"
 
 CMD_GET_SHADOW_COOKIE = "getshadowcookie"
+CMD_GET_METRICS = "getmetrics"
 
 PROTO_SEPARATOR = "\x00"
 
+_STEP_XAUTH = "xauth"
+_STEP_OPTIONS = "options"
+_STEP_ENVIRONMENT = "environment"
+_STEP_NXAGENT = "nxagent"
+_STEP_DISPLAY = "display"
+_STEP_XRDB = "xrdb"
+_STEP_USERAPP = "userapp"
+
+_DISPLAY_FAILURES = \
+  metrics.REGISTRY.GetCounter("quicknx_display_allocation_failures_total",
+                              "Failures to find an unused display number")
+_CLIENT_RPC_SECONDS = \
+  metrics.REGISTRY.GetHistogram("quicknx_node_client_rpc_seconds",
+                                "Duration of RPCs to nxnode as seen by the"
+                                " client")
+_HOSTNAME_LOOKUP_SECONDS = \
+  metrics.REGISTRY.GetHistogram("quicknx_hostname_lookup_seconds",
+                                "Duration of uncached hostname lookups")
+_HOSTNAME_LOOKUP_TIMEOUTS = \
+  metrics.REGISTRY.GetCounter("quicknx_hostname_lookup_timeouts_total",
+                              "Hostname lookups not finished in time")
+
+# Seconds the short hostname is used after a lookup timed out
+_HOSTNAME_FAILURE_TTL = 60
+
+# Lookup thread and its result list, kept while the lookup is running
+_hostname_lookup = None
+_hostname_lookup_lock = threading.Lock()
+
+
+def _ResolveHostname(timeout, _getfqdn=socket.getfqdn):
+  """Resolves the fully qualified hostname in a separate thread.
+
+  Only one lookup runs at a time. If a previous lookup timed out and is still
+  pending, it is waited for instead of starting another thread.
+
+  @type timeout: number
+  @param timeout: Seconds to wait for the lookup
+  @rtype: str or None
+  @return: Hostname, or None if the lookup didn't finish in time
+
+  """
+  global _hostname_lookup
+
+  with _hostname_lookup_lock:
+    if _hostname_lookup is None:
+      result = []
+      thread = threading.Thread(target=lambda: result.append(_getfqdn()))
+      thread.daemon = True
+      thread.start()
+      _hostname_lookup = (thread, result)
+
+    (thread, result) = _hostname_lookup
+
+  thread.join(timeout)
+
+  if thread.is_alive():
+    return None
+
+  with _hostname_lookup_lock:
+    if _hostname_lookup is not None and _hostname_lookup[0] is thread:
+      _hostname_lookup = None
+
+  if result:
+    return result[0]
+
+  return None
+
+
+def _ReadHostnameCache(path, shortname, now):
+  data = utils.ReadOwnFile(path)
+  if data is None:
+    return None
+
+  try:
+    cached = serializer.LoadJson(data.decode("utf-8"))
+    name = cached["name"]
+    expires = cached["expires"]
+    cached_shortname = cached["shortname"]
+  except (ValueError, TypeError, KeyError, UnicodeDecodeError):
+    logging.debug("Invalid hostname cache %s", path)
+    return None
+
+  if cached_shortname != shortname or expires <= now:
+    return None
+
+  return name
+
+
+def _WriteHostnameCache(path, shortname, name, expires):
+  data = serializer.DumpJson({
+    "name": name,
+    "shortname": shortname,
+    "expires": expires,
+    }, indent=False).encode("utf-8")
+
+  try:
+    utils.WriteFile(path, fn=lambda fd: os.write(fd, data), mode=0o600)
+  except EnvironmentError as err:
+    logging.debug("Can't write hostname cache %s: %s", path, err)
+
+
+def GetHostname(cfg, _cache_dir=constants.HOSTNAME_CACHE_DIR,
+                _resolve_fn=_ResolveHostname, _time=time):
+  """Returns the hostname shown to clients.
+
+  Uses the configured hostname if set. Otherwise the fully qualified hostname
+  is resolved and cached per user, as a slow or broken DNS server would
+  otherwise delay every login. If the lookup doesn't finish in time, the
+  short hostname is used and cached for a short time only.
+
+  @type cfg: L{config.Config}
+  @param cfg: Configuration
+  @rtype: str
+
+  """
+  if cfg.hostname:
+    return cfg.hostname
+
+  shortname = socket.gethostname()
+  path = os.path.join(_cache_dir, "hostname-%s" % os.getuid())
+  now = _time.time()
+
+  name = _ReadHostnameCache(path, shortname, now)
+  if name:
+    return name
 
-def GetHostname():
-  return socket.getfqdn()
+  name = _resolve_fn(cfg.hostname_resolve_timeout)
 
+  _HOSTNAME_LOOKUP_SECONDS.Observe(_time.time() - now)
 
-def _GetUserShell(username):
-  return pwd.getpwnam(username).pw_shell
+  if name:
+    ttl = cfg.hostname_cache_ttl
+  else:
+    logging.warning("Hostname lookup didn't finish within %s seconds, using"
+                    " %s", cfg.hostname_resolve_timeout, shortname)
+    _HOSTNAME_LOOKUP_TIMEOUTS.Inc()
+    name = shortname
+    ttl = min(_HOSTNAME_FAILURE_TTL, cfg.hostname_cache_ttl)
 
+  if ttl > 0:
+    _WriteHostnameCache(path, shortname, name, now + ttl)
 
-def _GetUserHomedir(username):
-  return pwd.getpwnam(username).pw_dir
+  return name
 
 
 def FindUnusedDisplay(_pool=None, _check_paths=None):
@@ -106,6 +247,8 @@ def FindUnusedDisplay(_pool=None, _check_paths=None):
       logging.debug("Display number %s appears to be unused", i)
       return i
 
+  _DISPLAY_FAILURES.Inc()
+
   raise errors.NoFreeDisplayNumberFound()
 
 
@@ -116,7 +259,7 @@ class NodeSession(session.SessionBase):
   def __init__(self, ctx, clientargs, _env=None):
     self._ctx = ctx
 
-    hostname = GetHostname()
+    hostname = GetHostname(ctx.cfg)
     display = FindUnusedDisplay()
 
     session.SessionBase.__init__(self, ctx.sessid, hostname, display,
@@ -154,6 +297,7 @@ class NodeSession(session.SessionBase):
     self.resize = False
     self.shadow_cookie = None
     self.shadow_display = None
+    self.phases = {}
 
     self._ParseClientargs(clientargs)
 
@@ -164,12 +308,16 @@ class NodeSession(session.SessionBase):
 
     env["NX_ROOT"] = self.sessdir
     env["XAUTHORITY"] = self.authorityfile
-    env["SHELL"] = _GetUserShell(self._ctx.username)
+    env["SHELL"] = self._GetUserProfile().shell
 
     self._env = env
 
     self.command = self._GetCommand(clientargs)
 
+  def _GetUserProfile(self):
+    return userdb.GetUserProfile(self._ctx.username,
+                                 ttl=self._ctx.cfg.user_cache_ttl)
+
   def _ParseClientargs(self, clientargs):
     self.client = clientargs.get("client", self.client)
     self.geometry = clientargs.get("geometry", self.geometry)
@@ -216,7 +364,7 @@ class NodeSession(session.SessionBase):
     """
     cfg = self._ctx.cfg
     sesstype = self.type
-    args = [_GetUserShell(self._ctx.username), "-c"]
+    args = [self._GetUserProfile().shell, "-c"]
 
     if sesstype == constants.SESS_TYPE_SHADOW:
       return None
@@ -260,6 +408,26 @@ class NodeSession(session.SessionBase):
   def GetSessionEnvVars(self):
     return self._env
 
+  def AddPhases(self, phases):
+    """Adds phase timestamps recorded by another process (e.g. nxserver).
+
+    @type phases: dict
+    @param phases: Phase names and timestamps
+
+    """
+    for (name, timestamp) in list(phases.items()):
+      if isinstance(timestamp, (int, float)):
+        self.phases.setdefault(name, timestamp)
+
+  def MarkPhase(self, name):
+    """Records the time at which a startup phase was reached.
+
+    See L{metrics.MarkPhase}.
+
+    """
+    if metrics.MarkPhase(self.phases, name):
+      logging.debug("Session reached phase %s", name)
+
   def Save(self):
     self._ctx.sessmgr.SaveSession(self)
 
@@ -267,15 +435,81 @@ class NodeSession(session.SessionBase):
 class SessionRunner(object):
   """Manages the various parts of a session lifetime.
 
+  Session startup is a graph of steps (see L{utils.StepGraph}). Steps not
+  depending on each other overlap, e.g. the nxagent options file is written
+  while xauth is still running and the user application is started together
+  with xrdb.
+
   """
   def __init__(self, ctx):
     self.__ctx = ctx
 
+    self.__steps = None
+    self.__prepared_nxagent = None
+    self.__xprogram_env = None
+    self.__userapp_cwd = None
+    self.__userapp_lang = None
+
     self.__nxagent = None
     self.__nxagent_exited_reg = None
     self.__nxagent_display_ready_reg = None
 
   def Start(self):
+    steps = utils.StepGraph(done_fn=self.__StartupDone)
+    steps.AddStep(_STEP_XAUTH, self.__StartXAuth, wait=True)
+    steps.AddStep(_STEP_OPTIONS, self.__PrepareNxAgent)
+    steps.AddStep(_STEP_ENVIRONMENT, self.__PrepareEnvironment)
+    steps.AddStep(_STEP_NXAGENT, self.__StartNxAgent,
+                  deps=[_STEP_XAUTH, _STEP_OPTIONS])
+    steps.AddStep(_STEP_DISPLAY, self.__WaitForDisplay,
+                  deps=[_STEP_NXAGENT], wait=True)
+    steps.AddStep(_STEP_XRDB, self.__StartXRdb,
+                  deps=[_STEP_DISPLAY, _STEP_ENVIRONMENT], wait=True)
+    steps.AddStep(_STEP_USERAPP, self.__StartUserApp,
+                  deps=[_STEP_DISPLAY, _STEP_ENVIRONMENT])
+
+    self.__steps = steps
+
+    steps.Start()
+
+  def Restore(self):
+    if not self.__nxagent:
+      raise errors.GenericError("nxagent not yet started")
+    self.__nxagent.Restore()
+
+  def __StartupDone(self):
+    """Called once all startup steps are done.
+
+    """
+    timings = self.__steps.GetTimings()
+    if not timings:
+      return
+
+    begin = min([start for (_, start, _) in timings])
+
+    for (name, start, end) in timings:
+      logging.info("Startup step %s started at +%.3fs, took %.3fs",
+                   name, start - begin, end - start)
+
+    logging.info("Startup critical path: %s",
+                 " -> ".join(self.__steps.GetCriticalPath()))
+
+    sess = self.__ctx.session
+    sess.Save()
+
+    durations = metrics.GetPhaseDurations(sess.phases)
+    for (phase, seconds) in durations:
+      logging.info("Session phase %s took %.3fs", phase, seconds)
+
+    try:
+      _RecordPhaseLatencies(sess.username, sess.type, durations)
+    except EnvironmentError:
+      logging.exception("Failed to record phase latencies")
+
+  def __StartXAuth(self):
+    """Starts xauth to write the session's authority file.
+
+    """
     sess = self.__ctx.session
 
     cookies = []
@@ -292,11 +526,6 @@ class SessionRunner(object):
     xauth.Start()
     logging.debug("Xauth started")
 
-  def Restore(self):
-    if not self.__nxagent:
-      raise errors.GenericError("nxagent not yet started")
-    self.__nxagent.Restore()
-
   def __XAuthDone(self, _, exitstatus, signum):
     """Called when xauth exits.
 
@@ -306,7 +535,8 @@ class SessionRunner(object):
       self.__Quit()
       return
 
-    self.__StartNxAgent()
+    self.__ctx.session.MarkPhase(constants.PHASE_XAUTH)
+    self.__steps.Finish(_STEP_XAUTH)
 
   def __GetHostDisplays(self, display):
     return [":%s" % display,
@@ -318,12 +548,30 @@ class SessionRunner(object):
     env["DISPLAY"] = ":%s.0" % sess.display
     return env
 
+  def __PrepareEnvironment(self):
+    """Builds environment and working directory for X programs.
+
+    """
+    self.__xprogram_env = self.__GetXProgramEnv()
+    profile = userdb.GetUserProfile(self.__ctx.username,
+                                    ttl=self.__ctx.cfg.user_cache_ttl)
+    self.__userapp_cwd = profile.homedir
+    self.__userapp_lang = profile.lang
+
+  def __PrepareNxAgent(self):
+    """Builds the nxagent program and writes its options file.
+
+    """
+    self.__prepared_nxagent = agent.NxAgentProgram(self.__ctx)
+    self.__prepared_nxagent.PrepareStart()
+
   def __StartNxAgent(self):
     """Starts the nxagent program.
 
     """
     logging.info("Starting nxagent")
-    self.__nxagent = agent.NxAgentProgram(self.__ctx)
+    self.__nxagent = self.__prepared_nxagent
+    self.__prepared_nxagent = None
 
     signal_name = agent.NxAgentProgram.EXITED_SIGNAL
     self.__nxagent_exited_reg = \
@@ -338,6 +586,7 @@ class SessionRunner(object):
                                                        self.__DisplayReady))
 
     self.__nxagent.Start()
+    self.__ctx.session.MarkPhase(constants.PHASE_NXAGENT_SPAWN)
 
   def __NxAgentDone(self, prog, exitstatus, signum):
     assert prog == self.__nxagent
@@ -354,10 +603,13 @@ class SessionRunner(object):
 
     self.__Quit()
 
+  def __WaitForDisplay(self):
+    logging.debug("Waiting for nxagent display to become ready")
+
   def __DisplayReady(self, prog):
     assert prog == self.__nxagent
 
-    self.__StartXRdb()
+    self.__steps.Finish(_STEP_DISPLAY)
 
   def __StartXRdb(self):
     """Starts the xrdb program.
@@ -367,14 +619,14 @@ class SessionRunner(object):
 
     settings = "Xft.dpi: 96"
 
-    xrdb = agent.XRdbProgram(self.__GetXProgramEnv(), settings, self.__ctx.cfg)
+    xrdb = agent.XRdbProgram(self.__xprogram_env, settings, self.__ctx.cfg)
     xrdb.connect(agent.XRdbProgram.EXITED_SIGNAL, self.__XRdbDone)
     xrdb.Start()
 
   def __XRdbDone(self, _, exitstatus, signum):
     # Ignoring xrdb errors
 
-    self.__StartUserApp()
+    self.__steps.Finish(_STEP_XRDB)
 
   def __StartUserApp(self):
     """Starts the user-defined or user-requested application.
@@ -388,13 +640,14 @@ class SessionRunner(object):
     if sess.command is None:
       return
 
-    cwd = _GetUserHomedir(self.__ctx.username)
-
-    userapp = agent.UserApplication(self.__GetXProgramEnv(), cwd, sess.command,
-                                    sess.applogfile, login=True)
+    userapp = agent.UserApplication(self.__xprogram_env.copy(),
+                                    self.__userapp_cwd, sess.command,
+                                    sess.applogfile, login=True,
+                                    lang=self.__userapp_lang)
     userapp.connect(agent.UserApplication.EXITED_SIGNAL,
                     self.__UserAppDone)
     userapp.Start()
+    sess.MarkPhase(constants.PHASE_USERAPP)
 
   def __UserAppDone(self, _, exitstatus, signum):
     """Called when user application terminated.
@@ -450,12 +703,66 @@ class SessionRunner(object):
     """
     self.__nxagent = None
 
+    WriteNodeMetrics(self.__ctx)
+
     # Quit nxnode
     sys.exit(0)
 
 
+def WriteNodeMetrics(ctx):
+  """Writes the metrics of this nxnode to the session directory.
+
+  Errors are logged, but not raised.
+
+  @rtype: bool
+  @return: Always C{True} to be usable as a periodic mainloop callback
+
+  """
+  filename = os.path.join(ctx.sessmgr.GetSessionDir(ctx.sessid),
+                          constants.NODE_METRICS_FILE_NAME)
+
+  try:
+    utils.WriteFile(filename, data=metrics.REGISTRY.FormatText(), mode=0o644)
+  except EnvironmentError:
+    logging.exception("Failed to write metrics to %r", filename)
+
+  return True
+
+
+def _RecordPhaseLatencies(username, sesstype, durations):
+  """Adds phase durations to the per-user latency histograms.
+
+  @type username: str
+  @param username: Session owner
+  @type sesstype: str
+  @param sesstype: Session type
+  @type durations: list of tuples
+  @param durations: As returned by L{metrics.GetPhaseDurations}
+
+  """
+  filename = metrics.GetPhaseLatencyFile(username)
+
+  lock = utils.FileLock(filename + ".lock")
+  try:
+    lock.Exclusive()
+
+    try:
+      latencies = metrics.PhaseLatencies.Restore(
+        serializer.LoadJson(open(filename).read()))
+    except (IOError, ValueError):
+      latencies = metrics.PhaseLatencies()
+
+    latencies.Observe(sesstype, durations)
+
+    utils.WriteFile(filename, data=serializer.DumpJson(latencies.Serialize()),
+                    mode=0o644)
+  finally:
+    lock.Close()
+
+
 def StartNodeDaemon(username, sessid):
   def _StartNxNode():
+    utils.FlushLogging()
     os.execl(constants.NXNODE_WRAPPER, "--", username, sessid)
 
   utils.StartDaemon(_StartNxNode)
@@ -482,11 +789,13 @@ class NodeClient(object):
 
     """
     self._address = address
+    self._attempts = 0
     self._sock = None
     self._inbuf = ""
     self._inmsg = collections.deque()
 
   def _InnerConnect(self, sock, retry):
+    self._attempts += 1
     sock.settimeout(self._CONNECT_TIMEOUT)
 
     try:
@@ -527,18 +836,22 @@ class NodeClient(object):
     else:
       self._InnerConnect(sock, False)
 
+    logging.debug("Connected after %s attempt(s)", self._attempts)
+
     self._sock = sock
 
   def Close(self):
     self._sock.close()
 
-  def _SendRequest(self, cmd, args):
+  def _SendRequest(self, cmd, args, phases=None):
     """Sends a request and handles the response.
 
     @type cmd: str
     @param cmd: Procedure name
     @type args: built-in type
     @param args: Arguments
+    @type phases: dict
+    @param phases: Startup phase timestamps recorded by the caller
     @return: Value returned by the procedure call
 
     """
@@ -548,8 +861,13 @@ class NodeClient(object):
       REQ_FIELD_ARGS: args,
       }
 
+    if phases:
+      req[REQ_FIELD_PHASES] = phases
+
     logging.debug("Sending request: %r", req)
 
+    start = time.time()
+
     # TODO: sendall doesn't report errors properly
 
     req2 = serializer.DumpJson(req) + PROTO_SEPARATOR
@@ -564,6 +882,8 @@ class NodeClient(object):
     resp = serializer.LoadJson(self._ReadResponse())
     logging.debug("Received response: %r", resp)
 
+    _CLIENT_RPC_SECONDS.Observe(time.time() - start, labels={"cmd": cmd})
+
     # Check whether we received a valid response
     if (not isinstance(resp, dict) or
         RESP_FIELD_SUCCESS not in resp or
@@ -610,11 +930,12 @@ class NodeClient(object):
     self._sock.settimeout(timeout_tmp)
     return self._inmsg.popleft()
 
-  def StartSession(self, args):
-    return self._SendRequest(CMD_STARTSESSION, args)
+  def StartSession(self, args, phases=None):
+    return self._SendRequest(CMD_STARTSESSION, args, phases=phases)
 
-  def AttachSession(self, args, shadowcookie):
-    return self._SendRequest(CMD_ATTACHSESSION, [args, shadowcookie])
+  def AttachSession(self, args, shadowcookie, phases=None):
+    return self._SendRequest(CMD_ATTACHSESSION, [args, shadowcookie],
+                             phases=phases)
 
   def RestoreSession(self, args):
     return self._SendRequest(CMD_RESTORESESSION, args)
@@ -624,3 +945,6 @@ class NodeClient(object):
 
   def GetShadowCookie(self, args):
     return self._SendRequest(CMD_GET_SHADOW_COOKIE, args)
+
+  def GetMetrics(self):
+    return self._SendRequest(CMD_GET_METRICS, None)
@@ -25,11 +25,14 @@
 
 
 import logging
+import os
 import re
-import urllib.request, urllib.parse, urllib.error
+import select
+import time
+import urllib.parse
 
+from quicknx import metrics
 from quicknx import utils
-import collections
 
 
 NX_PROMPT = "NX>"
@@ -95,6 +98,12 @@ class NxUnsupportedProtocol(NxProtocolError):
                              True)
 
 
+class NxReadTimeout(NxProtocolError):
+  def __init__(self, timeout):
+    message = "ERROR: No input received within %s seconds" % timeout
+    NxProtocolError.__init__(self, 500, message, True)
+
+
 class NxUnencryptedSessionsNotAllowed(NxProtocolError):
   def __init__(self, x):
     message = "ERROR: Unencrypted sessions are not allowed on this server"
@@ -108,11 +117,27 @@ class NxParameterParsingError(NxProtocolError):
     NxProtocolError.__init__(self, 597, message)
 
 
+_OUTPUT_FLUSHES = \
+  metrics.REGISTRY.GetCounter("quicknx_protocol_flushes_total",
+                              "Writes of buffered protocol output to the"
+                              " client")
+_OUTPUT_BYTES = \
+  metrics.REGISTRY.GetCounter("quicknx_protocol_sent_bytes_total",
+                              "Protocol output sent to the client in bytes")
+_READ_TIMEOUTS = \
+  metrics.REGISTRY.GetCounter("quicknx_protocol_read_timeouts_total",
+                              "Connections closed because the client didn't"
+                              " send a line in time")
+
+
 class NxServerBase(object):
   """Base class for NX protocol servers.
 
+  Output is buffered until the server reads from the client or L{Flush} is
+  called, so that all responses to a command reach the client in one write.
+
   """
-  def __init__(self, input, output, handler):
+  def __init__(self, input, output, handler, read_timeout=0):
     """Instance initialization.
 
     @type input: file
@@ -121,18 +146,30 @@ class NxServerBase(object):
     @param output: Output file handle
     @type handler: callable
     @param handler: Called for received lines
+    @type read_timeout: int or float
+    @param read_timeout: Seconds within which a complete line must be
+      received, 0 to wait forever
 
     """
-    assert isinstance(handler, collections.Callable)
+    assert callable(handler)
 
     self._input = input
     self._output = output
     self._handler = handler
+    self._read_timeout = read_timeout
+    self._pending = []
+    self._inbuf = b""
 
   def Start(self):
     """Start responding to requests.
 
     """
+    try:
+      self._Serve()
+    finally:
+      self.Flush()
+
+  def _Serve(self):
     self.SendBanner()
 
     while True:
@@ -167,15 +204,34 @@ class NxServerBase(object):
       raise NxProtocolError(500, "Internal error", fatal=True)
 
   def _Write(self, data):
-    """Write to output after logging.
+    """Adds data to output buffer after logging.
 
     """
     logging.debug(">>> %r", data)
+    self._pending.append(data)
+
+  def Flush(self):
+    """Writes buffered output to the client.
+
+    Must be called before anything else writes to the output file descriptor
+    or if the client should receive output before the next read, e.g. for
+    keepalive messages.
+
+    """
+    if not self._pending:
+      return
+
+    data = "".join(self._pending)
+    self._pending = []
+
     try:
       self._output.write(data)
     finally:
       self._output.flush()
 
+    _OUTPUT_FLUSHES.Inc()
+    _OUTPUT_BYTES.Inc(amount=len(data))
+
   def Write(self, code, message=None, newline=None):
     """Write prompt to output.
 
@@ -219,8 +275,13 @@ class NxServerBase(object):
     @param hide: Whether to hide line read from log output
 
     """
-    # TODO: Timeout (poll, etc.)
-    line = self._input.readline()
+    # The client can only answer what it has received
+    self.Flush()
+
+    if self._read_timeout > 0:
+      line = self._ReadLineWithTimeout()
+    else:
+      line = self._input.readline()
 
     if hide:
       logging.debug("<<< [hidden]")
@@ -233,6 +294,48 @@ class NxServerBase(object):
 
     return line.rstrip(NX_EOL_CHARS)
 
+  def _ReadLineWithTimeout(self):
+    """Reads a line from the input file descriptor.
+
+    The input's own buffer can't be used as poll(2) doesn't know about it.
+    The whole line must be received within the timeout, so a client can't
+    keep the connection open by sending single bytes.
+
+    @rtype: str
+    @return: Line including newline, empty string at end of file
+
+    """
+    fd = self._input.fileno()
+    deadline = time.time() + self._read_timeout
+
+    poller = select.poll()
+    poller.register(fd, select.POLLIN)
+
+    while True:
+      pos = self._inbuf.find(NX_EOL.encode("ascii"))
+      if pos >= 0:
+        line = self._inbuf[:pos + 1]
+        self._inbuf = self._inbuf[pos + 1:]
+        break
+
+      remaining = deadline - time.time()
+      if remaining <= 0 or not poller.poll(remaining * 1000):
+        logging.warning("No line received from client within %s seconds",
+                        self._read_timeout)
+        _READ_TIMEOUTS.Inc()
+        raise NxReadTimeout(self._read_timeout)
+
+      data = os.read(fd, 4096)
+      if not data:
+        (line, self._inbuf) = (self._inbuf, b"")
+        break
+
+      self._inbuf += data
+
+    encoding = getattr(self._input, "encoding", None) or "utf-8"
+
+    return line.decode(encoding, "replace")
+
   def WithoutTerminalEcho(self, fn, *args, **kwargs):
     """Calls function with ECHO flag disabled.
 
@@ -267,30 +370,31 @@ def SplitCommand(command):
   return (parts[0].lower(), args)
 
 
+# A single parameter, e.g. --name="value"
+_PARAM = r"--([a-z][a-z0-9_-]*)=\"([^\"]*)\""
+
+_PARAM_RE = re.compile(_PARAM, re.I)
+_PARAMS_RE = re.compile(r"(?:\s*%s)*\s*" % _PARAM, re.I)
+
+
 def ParseParameters(params, _logging=logging):
   """Parse parameters sent by client.
 
+  The whole string is checked with a single match before the parameters are
+  extracted, both in one pass.
+
   @type params: string
   @param params: Parameter string
+  @rtype: dict
+  @return: Parameter values by name; if a name is given more than once, the
+    last value is used
 
   """
-  param_re = re.compile((r"^\s*--(?P<name>[a-z][a-z0-9_-]*)="
-                         "\"(?P<value>[^\"]*)\"\\s*"), re.I)
-  result = []
-  work = params.strip()
-
-  while work:
-    m = param_re.search(work)
-    if not m:
-      _logging.warning("Failed to parse parameter string %r", params)
-      raise NxParameterParsingError(params)
-
-    result.append((m.group("name"), m.group("value")))
-    work = work[m.end():]
-
-  assert not work
+  if not _PARAMS_RE.fullmatch(params):
+    _logging.warning("Failed to parse parameter string %r", params)
+    raise NxParameterParsingError(params)
 
-  return result
+  return dict(_PARAM_RE.findall(params))
 
 
 def UnquoteParameterValue(value):
@@ -0,0 +1,438 @@
+#
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Module for relaying data between file descriptors.
+
+This is an in-process replacement for the C{fdcopy} helper. On Linux data is
+moved using C{splice(2)} through a pipe, so it isn't copied to userspace.
+Descriptors not supporting splice (e.g. some ptys) fall back to read/write.
+
+"""
+
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import socket
+
+
+_BLOCKSIZE = 16 * 1024
+
+# Pipe capacity used for splicing
+_PIPE_SIZE = 64 * 1024
+
+# Linux-specific fcntl, not exported by Python before 3.10
+_F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+
+def HaveSplice():
+  """Returns whether C{splice(2)} is available.
+
+  """
+  return hasattr(os, "splice") and hasattr(select, "epoll")
+
+
+def _SetBlocking(fd, blocking):
+  """Sets or clears O_NONBLOCK on a file descriptor.
+
+  @rtype: int
+  @return: Previous file status flags
+
+  """
+  old_flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+
+  if blocking:
+    flags = old_flags & ~os.O_NONBLOCK
+  else:
+    flags = old_flags | os.O_NONBLOCK
+
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+  return old_flags
+
+
+# Results of L{_Channel.Copy}
+_COPY_OK = 0
+_COPY_EOF = 1
+_COPY_WRITE_FAILED = 2
+
+
+def _WaitWritable(fd):
+  """Waits until a file descriptor can be written to.
+
+  """
+  poller = select.poll()
+  poller.register(fd, select.POLLOUT)
+  try:
+    poller.poll()
+  except (IOError, OSError) as err:
+    if err.errno != errno.EINTR:
+      raise
+
+
+def _WriteAll(fd, data):
+  """Writes all data to a file descriptor, waiting if it's non-blocking.
+
+  @rtype: bool
+  @return: Whether all data was written
+
+  """
+  pos = 0
+  while pos < len(data):
+    try:
+      pos += os.write(fd, data[pos:])
+    except OSError as err:
+      if err.errno == errno.EINTR:
+        continue
+      if err.errno == errno.EAGAIN:
+        _WaitWritable(fd)
+        continue
+      if err.errno != errno.EPIPE:
+        logging.error("Error while writing to fd %s: %s", fd, err)
+      return False
+
+  return True
+
+
+class _Channel(object):
+  """One direction of the relay.
+
+  """
+  def __init__(self, from_fd, to_fd, use_splice):
+    self.from_fd = from_fd
+    self.to_fd = to_fd
+    self.enabled = True
+    self.bytes = 0
+    self._pipe = None
+
+    if use_splice:
+      self._pipe = os.pipe()
+      try:
+        fcntl.fcntl(self._pipe[1], _F_SETPIPE_SZ, _PIPE_SIZE)
+      except (IOError, OSError):
+        # Keep default size
+        pass
+
+  def Close(self):
+    self.enabled = False
+    self._ClosePipe()
+
+  def _ClosePipe(self):
+    if self._pipe is not None:
+      for fd in self._pipe:
+        os.close(fd)
+      self._pipe = None
+
+  def _DisableSplice(self):
+    logging.debug("Splicing from fd %s to fd %s not supported, using"
+                  " read/write", self.from_fd, self.to_fd)
+    self._ClosePipe()
+
+  def Copy(self):
+    """Copies available data.
+
+    @rtype: int
+    @return: One of C{_COPY_*}
+
+    """
+    if self._pipe is not None:
+      return self._Splice()
+
+    return self._ReadWrite()
+
+  def _Splice(self):
+    (pipe_r, pipe_w) = self._pipe
+
+    try:
+      n = os.splice(self.from_fd, pipe_w, _PIPE_SIZE,
+                    flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+    except OSError as err:
+      if err.errno in (errno.EAGAIN, errno.EINTR):
+        return _COPY_OK
+      if err.errno == errno.EIO:
+        # PTY closed
+        return _COPY_EOF
+      if err.errno in (errno.EINVAL, errno.ENOSYS):
+        # Input doesn't support splice, nothing was moved yet
+        self._DisableSplice()
+        return self._ReadWrite()
+      raise
+
+    if n == 0:
+      return _COPY_EOF
+
+    # Drain pipe completely
+    remaining = n
+    while remaining > 0:
+      try:
+        remaining -= os.splice(pipe_r, self.to_fd, remaining,
+                               flags=os.SPLICE_F_MOVE)
+      except OSError as err:
+        if err.errno == errno.EINTR:
+          continue
+        if err.errno == errno.EAGAIN:
+          _WaitWritable(self.to_fd)
+          continue
+
+        if err.errno in (errno.EINVAL, errno.ENOSYS):
+          # Output doesn't support splice, write what's left in the pipe
+          data = os.read(pipe_r, remaining)
+          self._DisableSplice()
+          if not _WriteAll(self.to_fd, data):
+            return _COPY_WRITE_FAILED
+          break
+
+        if err.errno != errno.EPIPE:
+          logging.error("Error while writing to fd %s: %s", self.to_fd, err)
+        return _COPY_WRITE_FAILED
+
+    self.bytes += n
+
+    return _COPY_OK
+
+  def _ReadWrite(self):
+    try:
+      data = os.read(self.from_fd, _BLOCKSIZE)
+    except OSError as err:
+      if err.errno in (errno.EAGAIN, errno.EINTR):
+        return _COPY_OK
+      if err.errno == errno.EIO:
+        # PTY closed
+        return _COPY_EOF
+      raise
+
+    if not data:
+      return _COPY_EOF
+
+    if not _WriteAll(self.to_fd, data):
+      return _COPY_WRITE_FAILED
+
+    self.bytes += len(data)
+
+    return _COPY_OK
+
+
+class Relay(object):
+  """Copies data between pairs of file descriptors until all are closed.
+
+  File descriptors are not closed, that's left to the caller.
+
+  """
+  def __init__(self, channels, use_splice=None, closed_fn=None):
+    """Initializes this class.
+
+    @type channels: list of tuples
+    @param channels: List of (from_fd, to_fd); each descriptor can only be
+      read by one channel
+    @type use_splice: bool
+    @param use_splice: Whether to use splice, defaults to L{HaveSplice}
+    @type closed_fn: callable
+    @param closed_fn: Called with (from_fd, to_fd) when a channel was closed
+
+    """
+    if use_splice is None:
+      use_splice = HaveSplice()
+
+    readers = [from_fd for (from_fd, _) in channels]
+    if len(readers) != len(set(readers)):
+      raise ValueError("More than one channel reading from a file descriptor")
+
+    self._use_splice = use_splice
+    self._channel_defs = channels
+    self._closed_fn = closed_fn
+    self._stop = False
+
+  def Stop(self):
+    """Stops relaying, e.g. from C{closed_fn}.
+
+    """
+    self._stop = True
+
+  def Run(self):
+    """Relays data until all channels are closed.
+
+    @rtype: list
+    @return: Number of bytes copied per channel
+
+    """
+    channels = [_Channel(from_fd, to_fd, self._use_splice)
+                for (from_fd, to_fd) in self._channel_defs]
+
+    by_fd = dict([(ch.from_fd, ch) for ch in channels])
+
+    # Regular files can't be polled, but are always readable
+    always_ready = set()
+
+    # File status flags are shared with every other user of the same open
+    # file description (e.g. the caller's stdin), so they're restored when
+    # done
+    old_flags = {}
+
+    poller = select.epoll()
+    old_sigpipe = signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+    try:
+      # Only inputs are made non-blocking. A descriptor can be input of one
+      # channel and output of another (e.g. a socket or pty), so writes wait
+      # for the output to become writable instead.
+      for ch in channels:
+        old_flags[ch.from_fd] = _SetBlocking(ch.from_fd, False)
+
+      for ch in channels:
+        try:
+          poller.register(ch.from_fd, select.EPOLLIN)
+        except (IOError, OSError) as err:
+          if err.errno != errno.EPERM:
+            raise
+          always_ready.add(ch.from_fd)
+
+      while by_fd and not self._stop:
+        if always_ready:
+          timeout = 0
+        else:
+          timeout = -1
+
+        try:
+          events = poller.poll(timeout)
+        except (IOError, OSError) as err:
+          if err.errno == errno.EINTR:
+            continue
+          raise
+
+        ready = [fd for (fd, _) in events] + list(always_ready)
+
+        for fd in ready:
+          ch = by_fd.get(fd, None)
+          if ch is None or self._stop:
+            continue
+
+          result = ch.Copy()
+          if result == _COPY_OK:
+            continue
+
+          # Closed while reading or writing
+          closed = [ch]
+
+          if result == _COPY_WRITE_FAILED:
+            # Close other channels writing to the same descriptor
+            closed.extend([i for i in by_fd.values()
+                           if i is not ch and i.to_fd == ch.to_fd])
+
+          for i in closed:
+            logging.debug("Closing channel from fd %s to fd %s", i.from_fd,
+                          i.to_fd)
+            if i.from_fd in always_ready:
+              always_ready.remove(i.from_fd)
+            else:
+              poller.unregister(i.from_fd)
+            del by_fd[i.from_fd]
+            i.Close()
+
+            if self._closed_fn:
+              self._closed_fn(i.from_fd, i.to_fd)
+    finally:
+      signal.signal(signal.SIGPIPE, old_sigpipe)
+      poller.close()
+      for ch in channels:
+        if ch.enabled:
+          ch.Close()
+      for (fd, flags) in old_flags.items():
+        try:
+          fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+        except EnvironmentError as err:
+          # Closed by closed_fn
+          if err.errno != errno.EBADF:
+            raise
+
+    return [ch.bytes for ch in channels]
+
+
+def ConnectTcp(address, buffer_size=0):
+  """Connects to a TCP port for relaying interactive traffic.
+
+  @type address: tuple
+  @param address: (host, port)
+  @type buffer_size: int
+  @param buffer_size: Socket send and receive buffer size, 0 for default
+  @rtype: socket.socket
+  @return: Connected socket
+
+  """
+  sock = socket.create_connection(address)
+  try:
+    # NX traffic is interactive, don't delay small writes
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    if buffer_size > 0:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+  except:
+    sock.close()
+    raise
+
+  return sock
+
+
+def RunTcpProxy(address, in_fd, out_fd, buffer_size=0, use_splice=None):
+  """Connects to a TCP port and relays data between it and two descriptors.
+
+  Returns once the connection was closed by the peer or writing to
+  C{out_fd} failed. When C{in_fd} is closed, the connection is shut down for
+  writing.
+
+  @type address: tuple
+  @param address: (host, port)
+  @type in_fd: int
+  @param in_fd: Descriptor to read data for peer from
+  @type out_fd: int
+  @param out_fd: Descriptor to write data from peer to
+  @type buffer_size: int
+  @param buffer_size: Socket send and receive buffer size, 0 for default
+  @type use_splice: bool
+  @param use_splice: Whether to use splice, defaults to L{HaveSplice}
+  @rtype: tuple
+  @return: Bytes sent to and received from peer
+
+  """
+  sock = ConnectTcp(address, buffer_size=buffer_size)
+  try:
+    def _Closed(from_fd, _):
+      if from_fd == in_fd:
+        # Let peer know there's no more data
+        try:
+          sock.shutdown(socket.SHUT_WR)
+        except socket.error as err:
+          if err.errno != errno.ENOTCONN:
+            raise
+      else:
+        relay.Stop()
+
+    relay = Relay([(in_fd, sock.fileno()), (sock.fileno(), out_fd)],
+                  use_splice=use_splice, closed_fn=_Closed)
+
+    (sent, received) = relay.Run()
+  finally:
+    sock.close()
+
+  return (sent, received)
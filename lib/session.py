@@ -66,6 +66,7 @@ class SessionBase(object):
     "id",
     "name",
     "options",
+    "phases",
     "port",
     "rootless",
     "screeninfo",
@@ -209,16 +210,28 @@ class NxSessionManager(object):
       database. If none are found, the list is empty.
 
     """
-    result = []
+    return list(self.IterSessionsWithFilter(username, filter_fn))
 
+  def IterSessionsWithFilter(self, username, filter_fn):
+    """Find sessions filtered by a function, loading them one at a time.
+
+    Like L{FindSessionsWithFilter}, but sessions are only loaded as the
+    result is iterated, and only one of them needs to be kept in memory.
+
+    @type username: str or None
+    @param username: Wanted session owner
+    @type filter_fn: callable or None
+    @param filter_fn: Filter function
+    @rtype: generator
+    @return: L{NxSession} instances for matching sessions
+
+    """
     for sessid in utils.ListVisibleFiles(self._path):
       sess = self.LoadSession(sessid)
       if (sess is not None and
           (username is None or sess.username == username) and
           (filter_fn is None or filter_fn(sess))):
-        result.append(sess)
-
-    return result
+        yield sess
 
   def GetSessionDir(self, sessid):
     """Get absolute path for a session.
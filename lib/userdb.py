@@ -0,0 +1,191 @@
+#
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Module for looking up users.
+
+Users may come from a network directory (e.g. LDAP via NSS), where every
+lookup can take a round trip. Profiles are therefore looked up once per
+process and can be kept in a per-user cache file for some time.
+
+"""
+
+
+import logging
+import os
+import pwd
+import re
+import time
+
+from quicknx import constants
+from quicknx import serializer
+from quicknx import utils
+
+
+_DMRC_LANGUAGE_RE = re.compile(r"^\s*Language\s*=\s*(?P<lang>\S+)\s*$", re.M)
+
+# Profiles looked up by this process, by username
+_profiles = {}
+
+
+class UserProfile(object):
+  """Information about a user.
+
+  """
+  __slots__ = [
+    "name",
+    "uid",
+    "gid",
+    "homedir",
+    "shell",
+    "lang",
+    ]
+
+  def __init__(self, name, uid, gid, homedir, shell, lang):
+    """Initializes this class.
+
+    @type lang: str or None
+    @param lang: Language from the user's ~/.dmrc
+
+    """
+    self.name = name
+    self.uid = uid
+    self.gid = gid
+    self.homedir = homedir
+    self.shell = shell
+    self.lang = lang
+
+  def Serialize(self):
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
+  @classmethod
+  def Restore(cls, data):
+    return cls(**data)
+
+
+def _ReadLanguage(homedir):
+  """Reads the language setting from ~/.dmrc.
+
+  @rtype: str or None
+
+  """
+  dmrc_path = os.path.join(homedir, ".dmrc")
+
+  try:
+    contents = open(dmrc_path).read()
+  except IOError as err:
+    logging.debug("Can't read %r: %r", dmrc_path, err.strerror)
+    return None
+
+  m = _DMRC_LANGUAGE_RE.search(contents)
+  if not m:
+    logging.debug("Dmrc doesn't contain Language setting")
+    return None
+
+  lang = m.group("lang")
+  logging.debug("Dmrc language setting %r", lang)
+  return lang
+
+
+def _LookupUser(username):
+  """Looks up a user in the user database.
+
+  The language is only read for the user running this process, whose home
+  directory is readable.
+
+  """
+  pw = pwd.getpwnam(username)
+
+  if pw.pw_uid == os.getuid():
+    lang = _ReadLanguage(pw.pw_dir)
+  else:
+    lang = None
+
+  return UserProfile(pw.pw_name, pw.pw_uid, pw.pw_gid, pw.pw_dir,
+                     pw.pw_shell, lang)
+
+
+def _ReadCache(path, now):
+  """Reads the profile cache, dropping expired entries.
+
+  @rtype: dict
+  @return: (expiry time, serialized profile) by username
+
+  """
+  data = utils.ReadOwnFile(path)
+  if data is None:
+    return {}
+
+  try:
+    entries = serializer.LoadJson(data.decode("utf-8"))
+    return dict((name, (expires, profile))
+                for (name, (expires, profile)) in entries.items()
+                if expires > now)
+  except (ValueError, TypeError, AttributeError, UnicodeDecodeError):
+    logging.debug("Invalid user profile cache %s", path)
+    return {}
+
+
+def _WriteCache(path, entries):
+  data = serializer.DumpJson(entries, indent=False).encode("utf-8")
+
+  try:
+    utils.WriteFile(path, fn=lambda fd: os.write(fd, data), mode=0o600)
+  except EnvironmentError as err:
+    logging.debug("Can't write user profile cache %s: %s", path, err)
+
+
+def GetUserProfile(username, ttl=0, _cache_dir=constants.USER_CACHE_DIR,
+                   _lookup_fn=_LookupUser, _time=time):
+  """Returns a user's profile.
+
+  @type username: str
+  @param username: Username
+  @type ttl: int
+  @param ttl: Seconds the profile is kept in the cache file of the user
+    running this process, 0 to only keep it in memory
+  @rtype: L{UserProfile}
+  @raise KeyError: If the user doesn't exist
+
+  """
+  profile = _profiles.get(username)
+  if profile:
+    return profile
+
+  if ttl > 0:
+    path = os.path.join(_cache_dir, "users-%s" % os.getuid())
+    now = _time.time()
+    entries = _ReadCache(path, now)
+  else:
+    entries = {}
+
+  if username in entries:
+    profile = UserProfile.Restore(entries[username][1])
+  else:
+    profile = _lookup_fn(username)
+
+    if ttl > 0:
+      entries[username] = (now + ttl, profile.Serialize())
+      _WriteCache(path, entries)
+
+  _profiles[username] = profile
+
+  return profile
@@ -24,25 +24,78 @@
 
 import errno
 import fcntl
+import importlib
 import logging
 import logging.handlers
 import os
 import os.path
 import pwd
+import random
 import resource
 import re
+import select
 import signal
+import stat
 import sys
 import syslog
-import tempfile
 import termios
+import threading
 import time
 
 from quicknx import constants
 from quicknx import errors
+from quicknx import metrics
+from quicknx import serializer
 import collections
 
 
+class LazyModule(object):
+  """Module imported on first attribute access.
+
+  Used for heavy dependencies only needed on some code paths, e.g.:
+
+    >>> pexpect = utils.LazyModule("pexpect")
+
+  Modules whose classes are subclassed at import time can't be loaded lazily
+  by the module defining the subclass.
+
+  """
+  def __init__(self, name):
+    """Initializes this class.
+
+    @type name: str
+    @param name: Absolute module name
+
+    """
+    self.__dict__["_LazyModule__name"] = name
+    self.__dict__["_LazyModule__module"] = None
+
+  def __GetModule(self):
+    module = self.__module
+    if module is None:
+      module = importlib.import_module(self.__name)
+      self.__dict__["_LazyModule__module"] = module
+    return module
+
+  def __getattr__(self, name):
+    return getattr(self.__GetModule(), name)
+
+  def __setattr__(self, name, value):
+    # Tests replace module attributes
+    setattr(self.__GetModule(), name, value)
+
+  def __repr__(self):
+    if self.__module is None:
+      return "<lazy module %r (not loaded)>" % self.__name
+    return "<lazy module %r>" % self.__name
+
+
+socket = LazyModule("socket")
+subprocess = LazyModule("subprocess")
+sysconfig = LazyModule("sysconfig")
+tempfile = LazyModule("tempfile")
+
+
 _SHELL_UNQUOTED_RE = re.compile('^[-.,=:/_+@A-Za-z0-9]+$')
 
 try:
@@ -50,14 +103,24 @@ try:
 except AttributeError:
   DEV_NULL = "/dev/null"
 
+_WRITEFILE_SECONDS = \
+  metrics.REGISTRY.GetHistogram("quicknx_writefile_seconds",
+                                "Time needed to write a file atomically")
 
-class CustomSyslogHandler(logging.Handler):
-  """Custom syslog handler.
+_LOG_MESSAGES_DROPPED = \
+  metrics.REGISTRY.GetCounter("quicknx_log_messages_dropped_total",
+                              "Log messages dropped because the syslog queue"
+                              " was full or syslog wasn't reachable")
 
-  logging.handlers.SysLogHandler doesn't support splitting exceptions into
-  several lines.
 
-  This class should only be used once per process.
+class AsyncSyslogHandler(logging.Handler):
+  """Syslog handler sending messages from a background thread.
+
+  Records are only formatted and queued by the logging caller, so a slow or
+  unreachable syslog daemon can't delay the program. A writer thread sends
+  all queued messages to the syslog socket whenever woken up. If the queue is
+  full, messages are dropped and counted. Exceptions are split into one
+  message per line, as syslog daemons don't handle multi-line messages well.
 
   """
   _LEVEL_MAP = {
@@ -68,19 +131,46 @@ class CustomSyslogHandler(logging.Handler):
     logging.DEBUG: syslog.LOG_DEBUG,
     }
 
-  def __init__(self, ident):
+  # Longer messages are truncated
+  _MAX_MESSAGE_SIZE = 8192
+
+  # Messages are dropped if syslog doesn't accept them within this time
+  _SEND_TIMEOUT = 1.0
+
+  def __init__(self, ident, address="/dev/log", max_queued=10000,
+               _start=True):
     """Initializes instances.
 
     @type ident: string
     @param ident: String prepended to every message
+    @type address: string
+    @param address: Path of syslog socket
+    @type max_queued: int
+    @param max_queued: Maximum number of queued messages
 
     """
     logging.Handler.__init__(self)
 
-    syslog.openlog(ident, syslog.LOG_PID, syslog.LOG_USER)
+    self._ident = ident
+    self._address = address
+    self._max_queued = max_queued
+    self._start = _start
 
-  def close(self):
-    syslog.closelog()
+    self.dropped = 0
+
+    self._lock = threading.Lock()
+    self._queue = collections.deque()
+    self._wakeup = threading.Event()
+    self._idle = threading.Event()
+    self._idle.set()
+    self._stop = False
+    self._writer = None
+    self._writer_pid = None
+    self._sock = None
+    self._reported_drops = 0
+
+    if hasattr(os, "register_at_fork"):
+      os.register_at_fork(after_in_child=self._AfterFork)
 
   def _MapLogLevel(self, levelno):
     """Maps log level to syslog.
@@ -93,8 +183,56 @@ class CustomSyslogHandler(logging.Handler):
     """
     return self._LEVEL_MAP.get(levelno, syslog.LOG_DEBUG)
 
+  def _Drop(self, count):
+    self.dropped += count
+    _LOG_MESSAGES_DROPPED.Inc(amount=count)
+
+  def _AfterFork(self):
+    """Resets state inherited from the parent process.
+
+    The writer thread doesn't survive fork(2) and its lock may have been held
+    while forking. Messages queued by the parent are its to send.
+
+    """
+    if self._sock is not None:
+      self._sock.close()
+
+    self._lock = threading.Lock()
+    self._queue.clear()
+    self._wakeup = threading.Event()
+    self._idle = threading.Event()
+    self._idle.set()
+    self._writer = None
+    self._writer_pid = None
+    self._sock = None
+    self._reported_drops = self.dropped
+
+  def _EnsureWriter(self):
+    """Starts the writer thread if needed.
+
+    Must be called with the lock held.
+
+    """
+    pid = os.getpid()
+    if self._writer_pid == pid:
+      return
+
+    if self._writer_pid is not None:
+      # Forked without running the fork handlers
+      self._queue.clear()
+      self._sock = None
+      self._wakeup = threading.Event()
+      self._reported_drops = self.dropped
+
+    self._writer_pid = pid
+
+    self._writer = threading.Thread(target=self._Run,
+                                    name="syslog-writer")
+    self._writer.daemon = True
+    self._writer.start()
+
   def emit(self, record):
-    """Send a log record to syslog.
+    """Queues a log record for syslog.
 
     @type record: logging.LogRecord
     @param record: Log record
@@ -107,10 +245,128 @@ class CustomSyslogHandler(logging.Handler):
     else:
       messages = [msg]
 
-    priority = self._MapLogLevel(record.levelno)
+    priority = syslog.LOG_USER | self._MapLogLevel(record.levelno)
+
+    with self._lock:
+      # Cleared together with adding messages, so the writer can't declare
+      # itself idle in between
+      self._idle.clear()
+
+      for msg in messages:
+        if len(self._queue) >= self._max_queued:
+          self._Drop(1)
+        else:
+          self._queue.append((priority, record.created, msg))
+
+      if self._start:
+        self._EnsureWriter()
+      else:
+        self._idle.set()
+
+    self._wakeup.set()
 
-    for msg in messages:
-      syslog.syslog(priority, msg)
+  def _FormatMessage(self, priority, created, msg):
+    """Formats a message like syslog(3).
+
+    """
+    timestamp = time.strftime("%b %e %H:%M:%S", time.localtime(created))
+    data = ("<%d>%s %s[%d]: %s" %
+            (priority, timestamp, self._ident, self._writer_pid, msg))
+    return data.encode("utf-8", "replace")[:self._MAX_MESSAGE_SIZE]
+
+  def _Connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.settimeout(self._SEND_TIMEOUT)
+    try:
+      sock.connect(self._address)
+    except EnvironmentError:
+      sock.close()
+      raise
+    self._sock = sock
+
+  def _Send(self, batch):
+    """Sends a batch of messages, reconnecting once if needed.
+
+    @rtype: int
+    @return: Number of messages not sent
+
+    """
+    for attempt in (0, 1):
+      try:
+        if self._sock is None:
+          self._Connect()
+
+        while batch:
+          self._sock.send(self._FormatMessage(*batch[0]))
+          batch.pop(0)
+
+        return 0
+      except EnvironmentError:
+        if self._sock is not None:
+          self._sock.close()
+          self._sock = None
+
+    return len(batch)
+
+  def _Run(self):
+    """Main function of writer thread.
+
+    """
+    wakeup = self._wakeup
+
+    while not self._stop:
+      wakeup.wait()
+      wakeup.clear()
+
+      while True:
+        with self._lock:
+          batch = []
+          while self._queue and len(batch) < 100:
+            batch.append(self._queue.popleft())
+
+          if not batch:
+            # Everything queued so far has been sent
+            self._idle.set()
+            break
+
+        failed = self._Send(batch)
+        if failed:
+          self._Drop(failed)
+
+        dropped = self.dropped - self._reported_drops
+        if dropped and self._sock is not None:
+          self._reported_drops += dropped
+          self._Send([(syslog.LOG_USER | syslog.LOG_WARNING, time.time(),
+                       "%d log messages dropped" % dropped)])
+
+  def flush(self, timeout=1.0):
+    """Waits until all queued messages have been sent.
+
+    @type timeout: float
+    @param timeout: Seconds to wait at most
+
+    """
+    if self._writer_pid == os.getpid():
+      self._idle.wait(timeout)
+
+  def close(self):
+    self.flush()
+
+    self._stop = True
+    self._wakeup.set()
+
+    logging.Handler.close(self)
+
+
+def FlushLogging():
+  """Sends log messages still queued by the root logger's handlers.
+
+  Must be called before exec'ing or leaving a process using C{os._exit}, as
+  neither runs the handlers' cleanup at exit.
+
+  """
+  for handler in logging.getLogger("").handlers:
+    handler.flush()
 
 
 class LoggingSetupOptions(object):
@@ -161,7 +417,7 @@ class LoggingSetup(object):
     self._stderr_handler = logging.StreamHandler(sys.stderr)
 
     # Create syslog handler
-    self._syslog_handler = CustomSyslogHandler(self._program)
+    self._syslog_handler = AsyncSyslogHandler(self._program)
 
     self._ConfigureHandlers()
 
@@ -265,7 +521,7 @@ def WithoutTerminalEcho(fd, fn, *args, **kwargs):
   @param fn: Called function
 
   """
-  assert isinstance(fn, collections.Callable)
+  assert callable(fn)
 
   # Keep old terminal settings
   try:
@@ -405,6 +661,8 @@ def WriteFile(file_name, fn=None, data=None,
   if [fn, data].count(None) != 1:
     raise errors.ProgrammerError("fn or data required")
 
+  start = time.time()
+
   dir_name, base_name = os.path.split(file_name)
   fd, new_name = tempfile.mkstemp(prefix=".tmp", suffix=base_name,
                                   dir=dir_name)
@@ -423,6 +681,331 @@ def WriteFile(file_name, fn=None, data=None,
     os.close(fd)
     # Make sure temporary file is removed in any case
     RemoveFile(new_name)
+    _WRITEFILE_SECONDS.Observe(time.time() - start)
+
+
+def ReadOwnFile(path):
+  """Reads a file only if it was written by the current user.
+
+  Used for caches kept in directories writable by all users. Symlinks and
+  files writable by the group or others are rejected.
+
+  @type path: str
+  @param path: File path
+  @rtype: str or None
+  @return: File contents, or None if the file doesn't exist or can't be
+    trusted
+
+  """
+  try:
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+  except EnvironmentError as err:
+    if err.errno not in (errno.ENOENT, errno.ELOOP):
+      logging.debug("Can't open %s: %s", path, err)
+    return None
+
+  try:
+    st = os.fstat(fd)
+
+    if (st.st_uid != os.getuid() or
+        st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+      logging.warning("Ignoring %s with wrong owner or mode", path)
+      return None
+
+    data = []
+    while True:
+      buf = os.read(fd, 64 * 1024)
+      if not buf:
+        break
+      data.append(buf)
+  finally:
+    os.close(fd)
+
+  return b"".join(data)
+
+
+class FileLock(object):
+  """Advisory lock using flock(2) on a separate lock file.
+
+  Files replaced with L{WriteFile} can't be locked themselves since renaming
+  replaces the inode.
+
+  """
+  def __init__(self, filename, mode=0o600):
+    """Opens (and if necessary creates) the lock file.
+
+    @type filename: str
+    @param filename: Path to lock file
+    @type mode: int
+    @param mode: File mode used when creating the lock file
+
+    """
+    self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, mode)
+    SetCloseOnExecFlag(self._fd, True)
+
+  def Exclusive(self, blocking=True):
+    """Acquires the lock in exclusive mode.
+
+    @type blocking: bool
+    @param blocking: Whether to wait for the lock
+    @rtype: bool
+    @return: Whether the lock was acquired
+
+    """
+    flags = fcntl.LOCK_EX
+
+    if not blocking:
+      flags |= fcntl.LOCK_NB
+
+    try:
+      fcntl.flock(self._fd, flags)
+    except IOError as err:
+      if not blocking and err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return False
+      raise
+
+    return True
+
+  def Unlock(self):
+    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+  def Close(self):
+    """Closes the lock file, releasing the lock.
+
+    """
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+
+
+class SlotSemaphore(object):
+  """Counting semaphore shared between processes.
+
+  Every slot is a lock file and held using an exclusive L{FileLock}. Slots are
+  released when the holding process exits, even if it crashed.
+
+  """
+  def __init__(self, directory, name, count):
+    """Initializes this class.
+
+    @type directory: str
+    @param directory: Directory for lock files
+    @type name: str
+    @param name: Prefix for lock file names
+    @type count: int
+    @param count: Number of slots
+
+    """
+    assert count > 0
+
+    self._paths = [os.path.join(directory, "%s-%d.lock" % (name, i))
+                   for i in range(count)]
+    self._lock = None
+    self._held_path = None
+
+  def TryAcquire(self):
+    """Tries to acquire a slot without waiting.
+
+    @rtype: bool
+    @return: Whether a slot was acquired
+
+    """
+    assert self._lock is None, "Slot already acquired"
+
+    # Start at a random slot to avoid all processes contending for the first
+    offset = random.randrange(len(self._paths))
+
+    for i in range(len(self._paths)):
+      path = self._paths[(offset + i) % len(self._paths)]
+      lock = FileLock(path)
+      if lock.Exclusive(blocking=False):
+        self._lock = lock
+        self._held_path = path
+        return True
+      lock.Close()
+
+    return False
+
+  def Release(self):
+    """Releases the slot, if any.
+
+    """
+    if self._lock is not None:
+      self._lock.Close()
+      self._lock = None
+      self._held_path = None
+
+  def GetPaths(self):
+    """Returns the paths of all slot files.
+
+    """
+    return self._paths[:]
+
+  def GetHeldPath(self):
+    """Returns the path of the slot file held, if any.
+
+    """
+    return self._held_path
+
+
+class TicketQueue(object):
+  """Bounded first-in, first-out queue shared between processes.
+
+  Every waiter holds a slot of a L{SlotSemaphore} while queued and records a
+  ticket number in the slot file. Tickets are handed out in order under a
+  lock. A waiter is first once no other held slot has a lower ticket. Slots
+  of exited processes are no longer locked, so crashed waiters leave the
+  queue by themselves.
+
+  """
+  def __init__(self, directory, name, count):
+    """Initializes this class.
+
+    @type directory: str
+    @param directory: Directory for lock and ticket files
+    @type name: str
+    @param name: Prefix for file names
+    @type count: int
+    @param count: Maximum number of waiters
+
+    """
+    self._slots = SlotSemaphore(directory, name, count)
+    self._lock_path = os.path.join(directory, "%s.lock" % name)
+    self._counter_path = os.path.join(directory, "%s.next" % name)
+    self._ticket = None
+
+  @staticmethod
+  def _ReadTicket(path):
+    try:
+      fh = open(path)
+      try:
+        return int(fh.read())
+      finally:
+        fh.close()
+    except (EnvironmentError, ValueError):
+      return None
+
+  def _WriteSlot(self, data):
+    # Replacing the file would lose the lock held on it
+    fh = open(self._slots.GetHeldPath(), "w")
+    try:
+      fh.write(data)
+    finally:
+      fh.close()
+
+  def _GetWaiters(self, before=None):
+    """Returns the tickets of other processes in the queue.
+
+    @type before: int or None
+    @param before: Only return tickets lower than this
+
+    """
+    own = self._slots.GetHeldPath()
+    result = []
+
+    for path in self._slots.GetPaths():
+      if path == own:
+        continue
+
+      ticket = self._ReadTicket(path)
+      if ticket is None or (before is not None and ticket >= before):
+        continue
+
+      # The ticket is stale if nobody holds the slot
+      probe = FileLock(path)
+      try:
+        if probe.Exclusive(blocking=False):
+          continue
+      finally:
+        probe.Close()
+
+      result.append(ticket)
+
+    return result
+
+  def TryEnter(self):
+    """Enters the queue at its end.
+
+    @rtype: bool
+    @return: Whether there was room in the queue
+
+    """
+    assert self._ticket is None, "Already queued"
+
+    if not self._slots.TryAcquire():
+      return False
+
+    lock = FileLock(self._lock_path)
+    try:
+      lock.Exclusive()
+
+      ticket = self._ReadTicket(self._counter_path) or 0
+      WriteFile(self._counter_path, data="%d\n" % (ticket + 1))
+
+      # Recorded before the lock is released so that everybody getting a
+      # later ticket sees this one
+      self._WriteSlot("%d\n" % ticket)
+    finally:
+      lock.Close()
+
+    self._ticket = ticket
+
+    return True
+
+  def IsEmpty(self):
+    """Returns whether other processes are waiting.
+
+    """
+    return not self._GetWaiters()
+
+  def IsFirst(self):
+    """Returns whether this process is first in the queue.
+
+    """
+    assert self._ticket is not None, "Not queued"
+    return not self._GetWaiters(before=self._ticket)
+
+  def Leave(self):
+    """Leaves the queue, if queued.
+
+    """
+    if self._ticket is not None:
+      self._WriteSlot("")
+      self._ticket = None
+
+    self._slots.Release()
+
+
+def ExportMetrics(program, _registry=metrics.REGISTRY):
+  """Adds the metrics of a short-lived program to its metrics file.
+
+  Counters and histograms are accumulated over all runs of the program by the
+  current user and written in the text format.
+
+  @type program: str
+  @param program: Program name
+
+  """
+  path = metrics.GetProgramMetricsPath(program, GetCurrentUserName())
+  state_file = path + ".json"
+
+  lock = FileLock(path + ".lock")
+  try:
+    lock.Exclusive()
+
+    try:
+      registry = metrics.Registry.Restore(
+        serializer.LoadJson(open(state_file).read()))
+    except (IOError, ValueError):
+      registry = metrics.Registry()
+
+    registry.Merge(_registry)
+
+    WriteFile(state_file, data=serializer.DumpJson(registry.Serialize()),
+              mode=0o644)
+    WriteFile(path + ".prom", data=registry.FormatText(), mode=0o644)
+  finally:
+    lock.Close()
 
 
 def FormatTable(data, columns):
@@ -453,6 +1036,24 @@ def FormatTable(data, columns):
   @rtype: list of strings
   @return: Rows as strings
 
+  """
+  return list(IterTable(data, columns))
+
+
+def IterTable(data, columns):
+  """Formats input data as a table, one row at a time.
+
+  Like L{FormatTable}, but C{data} can be any iterable and is only consumed
+  as rows are requested. As column widths are fixed, every row can be
+  formatted as soon as its item is available.
+
+  @type data: iterable
+  @param data: Input data
+  @type columns: list of tuples
+  @param columns: Column definitions
+  @rtype: generator
+  @return: Rows as strings, starting with the header and a row of dashes
+
   """
   col_width = []
   header_row = []
@@ -482,16 +1083,16 @@ def FormatTable(data, columns):
 
   format = " ".join(format_fields)
 
-  rows = [header_row, dashes_row]
+  yield format % tuple(header_row)
+  yield format % tuple(dashes_row)
+
   for item in data:
     row = []
     for idx, (_, width, fn) in enumerate(columns):
       if col_width[idx] is not None:
         row.append(col_width[idx])
       row.append(fn(item))
-    rows.append(row)
-
-  return [format % tuple(row) for row in rows]
+    yield format % tuple(row)
 
 
 class RetryTimeout(Exception):
@@ -549,6 +1150,267 @@ def Retry(fn, start, factor, limit, timeout, _time=time):
       delay *= factor
 
 
+def _HasChildExited(pid):
+  """Checks whether a child process has exited, without reaping it.
+
+  """
+  try:
+    result = os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+  except OSError as err:
+    if err.errno == errno.ECHILD:
+      # Already reaped
+      return True
+    raise
+
+  return result is not None
+
+
+def _WaitForChildPidfd(pid, timeout):
+  """Waits for a child process using a pidfd.
+
+  @rtype: bool or None
+  @return: Whether the child exited, None if pidfds are not supported
+
+  """
+  try:
+    pidfd = os.pidfd_open(pid)
+  except AttributeError:
+    return None
+  except OSError as err:
+    if err.errno == errno.ESRCH:
+      # Already reaped
+      return True
+    if err.errno in (errno.ENOSYS, errno.EINVAL):
+      return None
+    raise
+
+  try:
+    poller = select.poll()
+    poller.register(pidfd, select.POLLIN)
+
+    if timeout is None:
+      poll_timeout = None
+    else:
+      poll_timeout = int(timeout * 1000)
+
+    # Python retries poll(2) on EINTR with the remaining timeout
+    return bool(poller.poll(poll_timeout))
+  finally:
+    os.close(pidfd)
+
+
+# Delays between checks when polling for a child to exit
+_CHILD_POLL_START = 0.001
+_CHILD_POLL_LIMIT = 0.1
+
+
+def _WaitForChildPoll(pid, timeout, _time=time):
+  """Waits for a child process by polling it.
+
+  Waiting for SIGCHLD isn't reliable in threaded programs. Blocking a signal
+  only affects the calling thread, so another thread (e.g. the syslog writer)
+  can receive and discard it.
+
+  """
+  if timeout is None:
+    end_time = None
+  else:
+    end_time = _time.time() + timeout
+
+  delay = _CHILD_POLL_START
+
+  while not _HasChildExited(pid):
+    if end_time is not None:
+      remaining = end_time - _time.time()
+      if remaining <= 0:
+        return False
+      delay = min(delay, remaining)
+
+    _time.sleep(delay)
+
+    delay = min(delay * 2, _CHILD_POLL_LIMIT)
+
+  return True
+
+
+def WaitForChild(pid, timeout=None, _use_pidfd=True):
+  """Waits for a child process to exit.
+
+  Returns as soon as the child has exited. Uses a pidfd where available and
+  polls the child otherwise. The child is not reaped, its exit status must
+  still be collected by the caller (e.g. using C{waitpid(2)} or a mainloop
+  child watch).
+
+  @type pid: int
+  @param pid: Process ID of child
+  @type timeout: float or None
+  @param timeout: Seconds to wait at most, None to wait forever
+  @rtype: bool
+  @return: Whether the child exited (False on timeout)
+
+  """
+  if _use_pidfd:
+    result = _WaitForChildPidfd(pid, timeout)
+    if result is not None:
+      return result
+
+  return _WaitForChildPoll(pid, timeout)
+
+
+class StepGraph(object):
+  """Runs named steps as soon as all their dependencies are done.
+
+  Steps without a dependency between each other overlap. A step is done when
+  its function returns, or, if it was added with C{wait=True}, once L{Finish}
+  is called for it (e.g. from the exit handler of a program it started).
+
+  Start and end time of every step are recorded, see L{GetTimings} and
+  L{GetCriticalPath}.
+
+  """
+  def __init__(self, done_fn=None, _time=time):
+    """Initializes this class.
+
+    @type done_fn: callable
+    @param done_fn: Called without arguments once all steps are done
+
+    """
+    self._done_fn = done_fn
+    self._time = _time
+    self._order = []
+    self._steps = {}
+    self._start_times = {}
+    self._end_times = {}
+    self._running = False
+
+  def AddStep(self, name, fn, deps=None, wait=False):
+    """Adds a step.
+
+    @type name: str
+    @param name: Step name
+    @type fn: callable
+    @param fn: Called without arguments to run the step
+    @type deps: list
+    @param deps: Names of steps which must be done before this one starts
+    @type wait: bool
+    @param wait: Whether the step is only done once L{Finish} is called
+
+    """
+    if name in self._steps:
+      raise errors.ProgrammerError("Duplicate step %r" % name)
+
+    if deps is None:
+      deps = []
+
+    self._order.append(name)
+    self._steps[name] = (fn, frozenset(deps), wait)
+
+  def Start(self):
+    """Starts all steps without dependencies.
+
+    """
+    for name in self._order:
+      for dep in self._steps[name][1]:
+        if dep not in self._steps:
+          raise errors.ProgrammerError("Step %r depends on unknown step %r" %
+                                       (name, dep))
+
+    self._RunReadySteps()
+
+  def Finish(self, name):
+    """Marks a step as done and starts the steps depending on it.
+
+    @type name: str
+    @param name: Step name
+
+    """
+    assert name in self._start_times
+    assert name not in self._end_times
+
+    self._end_times[name] = self._time.time()
+
+    logging.debug("Step %s done after %.3f seconds", name,
+                  self._end_times[name] - self._start_times[name])
+
+    self._RunReadySteps()
+
+  def _RunReadySteps(self):
+    """Starts steps whose dependencies are done.
+
+    Steps finishing synchronously are handled in the same loop instead of
+    recursing.
+
+    """
+    if self._running:
+      return
+
+    self._running = True
+    try:
+      while True:
+        ready = [name for name in self._order
+                 if (name not in self._start_times and
+                     self._steps[name][1].issubset(self._end_times))]
+        if not ready:
+          break
+
+        for name in ready:
+          (fn, _, wait) = self._steps[name]
+
+          self._start_times[name] = self._time.time()
+          fn()
+
+          if not wait:
+            self._end_times[name] = self._time.time()
+    finally:
+      self._running = False
+
+    if (self._done_fn is not None and
+        len(self._end_times) == len(self._order)):
+      done_fn = self._done_fn
+      self._done_fn = None
+      done_fn()
+
+  def GetTimings(self):
+    """Returns start and end time of every started step.
+
+    @rtype: list of tuples
+    @return: List of (name, start, end) in order of addition; end is None for
+      unfinished steps
+
+    """
+    return [(name, self._start_times[name], self._end_times.get(name))
+            for name in self._order
+            if name in self._start_times]
+
+  def GetCriticalPath(self):
+    """Returns the chain of steps which determined the total duration.
+
+    Starting at the step finishing last, the dependency finishing last is
+    followed until a step without dependencies is reached.
+
+    @rtype: list
+    @return: Step names, first step first
+
+    """
+    if not self._end_times:
+      return []
+
+    path = []
+    name = max(self._end_times, key=self._end_times.get)
+
+    while name is not None:
+      path.append(name)
+      deps = [dep for dep in self._steps[name][1] if dep in self._end_times]
+      if deps:
+        name = max(deps, key=self._end_times.get)
+      else:
+        name = None
+
+    path.reverse()
+
+    return path
+
+
 def ShellQuote(value):
   """Quotes shell argument according to POSIX.
 
@@ -619,6 +1481,74 @@ def GetMaxFd():
   return maxfd
 
 
+def _HaveCloseRange():
+  """Whether os.closerange uses close_range(2).
+
+  Python 3.10 and later use the system call if it was available at build
+  time. Without it, os.closerange calls close(2) for every descriptor.
+
+  """
+  return (sys.version_info >= (3, 10) and
+          bool(sysconfig.get_config_var("HAVE_CLOSE_RANGE")))
+
+
+def _ListOpenFds(proc_fd_dir):
+  """Returns the open file descriptors of the current process.
+
+  @rtype: list or None
+  @return: File descriptors, or None if L{proc_fd_dir} can't be read
+
+  """
+  try:
+    names = os.listdir(proc_fd_dir)
+  except EnvironmentError:
+    return None
+
+  # The descriptor used for reading the directory is included, but already
+  # closed
+  return [int(name) for name in names if name.isdigit()]
+
+
+def CloseFds(keep=None, _have_close_range=None,
+             _proc_fd_dir="/proc/self/fd"):
+  """Closes all file descriptors except the ones listed.
+
+  With a high RLIMIT_NOFILE, calling close(2) for every possible descriptor
+  takes very long. Only the descriptors listed in /proc/self/fd are closed
+  if it's available, otherwise close_range(2) is used if possible.
+
+  @type keep: list or None
+  @param keep: File descriptors to keep open
+
+  """
+  if keep:
+    keep = frozenset(keep)
+  else:
+    keep = frozenset()
+
+  fds = _ListOpenFds(_proc_fd_dir)
+
+  if fds is None:
+    # Checking for close_range(2) loads sysconfig, which takes longer than
+    # reading /proc/self/fd
+    if _have_close_range is None:
+      _have_close_range = _HaveCloseRange()
+
+    if _have_close_range:
+      start = 0
+      for fd in sorted(keep) + [GetMaxFd()]:
+        if fd > start:
+          os.closerange(start, fd)
+        start = max(start, fd + 1)
+      return
+
+    fds = range(GetMaxFd())
+
+  for fd in fds:
+    if fd not in keep:
+      CloseFd(fd)
+
+
 def StartDaemon(fn):
   """Start a daemon process.
 
@@ -646,6 +1576,7 @@ def StartDaemon(fn):
   pid = os.fork()
   if pid != 0:
     # Second parent process
+    FlushLogging()
     os._exit(0)
 
   # Second child process
@@ -653,8 +1584,7 @@ def StartDaemon(fn):
   os.umask(0o000)
 
   # Close all file descriptors
-  for fd in range(GetMaxFd()):
-    CloseFd(fd)
+  CloseFds()
 
   # Open /dev/null
   fd = os.open(DEV_NULL, os.O_RDWR)
@@ -667,10 +1597,12 @@ def StartDaemon(fn):
   try:
     # Call function starting daemon
     fn()
+    FlushLogging()
     os._exit(0)
   except (SystemExit, KeyboardInterrupt):
     raise
   except:
+    FlushLogging()
     os._exit(1)
 
 
@@ -872,8 +1804,57 @@ def GetExitcodeSignal(status):
     return (status, None)
 
 
+# Usernames by user ID, looked up once per process
+_usernames = {}
+
+
 def GetCurrentUserName():
   """Returns the name of the user that owns the current process.
 
   """
-  return pwd.getpwuid(os.getuid())[0]
+  uid = os.getuid()
+
+  name = _usernames.get(uid)
+  if name is None:
+    name = _usernames[uid] = pwd.getpwuid(uid)[0]
+
+  return name
+
+
+# Format of lines written by "python -X importtime"
+_IMPORT_TIME_RE = re.compile(r"^import time:\s*(?P<self>\d+)\s*\|"
+                             r"\s*(?P<cumulative>\d+)\s*\|(?P<name>.*)$")
+
+
+def ProfileImports(module):
+  """Measures the import time of a module and its dependencies.
+
+  The module is imported by a new Python interpreter using C{-X importtime}.
+
+  @type module: str
+  @param module: Module name
+  @rtype: list
+  @return: List of tuples containing the module name, the time needed for the
+    module itself and the time including its imports (in microseconds), in
+    import order
+
+  """
+  proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c",
+                           "import %s" % module],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+  (_, stderr) = proc.communicate()
+
+  if proc.returncode != 0:
+    raise errors.GenericError("Importing %s failed: %s" %
+                              (module, stderr.strip().splitlines()[-1:]))
+
+  result = []
+
+  for line in stderr.splitlines():
+    m = _IMPORT_TIME_RE.match(line)
+    if m:
+      result.append((m.group("name").strip(), int(m.group("self")),
+                     int(m.group("cumulative"))))
+
+  return result
@@ -0,0 +1,194 @@
+/*
+ * Copyright (C) 2009 Google Inc.
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 2 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program; if not, write to the Free Software
+ * Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+ * 02110-1301, USA.
+ */
+
+/*
+ * Login shell for the nx user handing the connection to nxbroker.
+ *
+ * Passes stdin and stdout to the broker using SCM_RIGHTS, followed by the
+ * environment, and waits for the broker to report the exit status. If the
+ * broker isn't running, nxserver-login is started instead. See lib/broker.py
+ * for the request format.
+ */
+
+#define _GNU_SOURCE
+
+#ifdef HAVE_CONFIG_H
+#include "../config.h"
+#endif
+
+#include <sys/socket.h>
+#include <sys/types.h>
+#include <sys/un.h>
+
+#include <errno.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+#define BROKER_SOCKET LOCALSTATEDIR "/lib/quicknx/broker/broker.sock"
+#define FALLBACK_PROGRAM PKGLIBDIR "/nxserver-login-wrapper"
+
+#define REQUEST_MAGIC "QNXBROKER1\n"
+#define FD_COUNT 2
+
+extern char **environ;
+
+static int connect_broker(void)
+{
+  struct sockaddr_un addr;
+  struct ucred cred;
+  socklen_t len;
+  int fd;
+
+  fd = socket(AF_UNIX, SOCK_STREAM, 0);
+  if (fd < 0)
+    return -1;
+
+  memset(&addr, 0, sizeof(addr));
+  addr.sun_family = AF_UNIX;
+  strncpy(addr.sun_path, BROKER_SOCKET, sizeof(addr.sun_path) - 1);
+
+  if (connect(fd, (struct sockaddr *)&addr, sizeof(addr)) < 0)
+    goto error;
+
+  /* Only hand the connection to a broker running as the same user */
+  len = sizeof(cred);
+  if (getsockopt(fd, SOL_SOCKET, SO_PEERCRED, &cred, &len) < 0)
+    goto error;
+
+  if (cred.uid != getuid()) {
+    fprintf(stderr, "Broker runs as user ID %d, ignoring it\n",
+            (int)cred.uid);
+    goto error;
+  }
+
+  return fd;
+
+error:
+  close(fd);
+  return -1;
+}
+
+static int send_data(const int sock, const char *buf, const size_t len)
+{
+  size_t pos = 0;
+  ssize_t n;
+
+  while (pos < len) {
+    /* No SIGPIPE if the broker went away */
+    n = send(sock, buf + pos, len - pos, MSG_NOSIGNAL);
+    if (n < 0) {
+      if (errno == EINTR)
+        continue;
+
+      return -1;
+    }
+
+    pos += n;
+  }
+
+  return 0;
+}
+
+static int send_fds(const int sock)
+{
+  char control[CMSG_SPACE(sizeof(int) * FD_COUNT)];
+  struct cmsghdr *cmsg;
+  struct msghdr msg;
+  struct iovec iov;
+  int fds[FD_COUNT] = { STDIN_FILENO, STDOUT_FILENO };
+  ssize_t n;
+
+  memset(&msg, 0, sizeof(msg));
+  memset(control, 0, sizeof(control));
+
+  iov.iov_base = REQUEST_MAGIC;
+  iov.iov_len = strlen(REQUEST_MAGIC);
+
+  msg.msg_iov = &iov;
+  msg.msg_iovlen = 1;
+  msg.msg_control = control;
+  msg.msg_controllen = sizeof(control);
+
+  cmsg = CMSG_FIRSTHDR(&msg);
+  cmsg->cmsg_level = SOL_SOCKET;
+  cmsg->cmsg_type = SCM_RIGHTS;
+  cmsg->cmsg_len = CMSG_LEN(sizeof(fds));
+  memcpy(CMSG_DATA(cmsg), fds, sizeof(fds));
+
+  do {
+    n = sendmsg(sock, &msg, MSG_NOSIGNAL);
+  } while (n < 0 && errno == EINTR);
+
+  if (n != (ssize_t)iov.iov_len)
+    return -1;
+
+  return 0;
+}
+
+static int send_environment(const int sock)
+{
+  char **var;
+
+  for (var = environ; *var != NULL; ++var) {
+    /* Including the terminating NUL */
+    if (send_data(sock, *var, strlen(*var) + 1) < 0)
+      return -1;
+  }
+
+  return send_data(sock, "", 1);
+}
+
+static int read_status(const int sock)
+{
+  unsigned char status;
+  ssize_t n;
+
+  while (1) {
+    n = read(sock, &status, 1);
+    if (n < 0 && errno == EINTR)
+      continue;
+
+    if (n == 1)
+      return status;
+
+    return EXIT_FAILURE;
+  }
+}
+
+int main(int argc, char **argv)
+{
+  int sock;
+
+  sock = connect_broker();
+  if (sock >= 0) {
+    if (send_fds(sock) == 0 && send_environment(sock) == 0)
+      exit(read_status(sock));
+
+    /* Broker doesn't start the login before receiving the whole request */
+    close(sock);
+  }
+
+  argv[0] = FALLBACK_PROGRAM;
+  execv(argv[0], argv);
+
+  perror("execv");
+  exit(EXIT_FAILURE);
+}
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Benchmark for closing file descriptors before starting a daemon.
+
+Raises RLIMIT_NOFILE (which usually requires root privileges for more than
+the hard limit) and measures how long a forked child takes to close all
+descriptors, once by calling close(2) for every possible descriptor (as
+utils.StartDaemon used to) and once using utils.CloseFds. Run from the
+build directory:
+
+  PYTHONPATH=. test/benchmark/closefds_benchmark.py [--nofile=1048576]
+
+"""
+
+
+import optparse
+import os
+import resource
+import struct
+import sys
+import time
+
+from quicknx import utils
+
+
+def _CloseEach():
+  for fd in range(utils.GetMaxFd() - 1):
+    utils.CloseFd(fd)
+
+
+def _Measure(fn, count):
+  """Runs a function in forked children and returns the median duration.
+
+  """
+  durations = []
+
+  for _ in range(count):
+    (read_fd, write_fd) = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+      try:
+        # Move the pipe to the last descriptor, which all methods keep open
+        fd = os.dup2(write_fd, utils.GetMaxFd() - 1)
+        start = time.time()
+        fn()
+        os.write(fd, struct.pack("d", time.time() - start))
+      finally:
+        os._exit(0)
+
+    os.close(write_fd)
+    try:
+      data = os.read(read_fd, 8)
+    finally:
+      os.close(read_fd)
+      os.waitpid(pid, 0)
+
+    durations.append(struct.unpack("d", data)[0])
+
+  durations.sort()
+
+  return durations[len(durations) // 2]
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--nofile", dest="nofile", type="int", default=1048576,
+                    help="File descriptor limit")
+  parser.add_option("--count", dest="count", type="int", default=5,
+                    help="Runs per method")
+  (options, _) = parser.parse_args()
+
+  try:
+    resource.setrlimit(resource.RLIMIT_NOFILE,
+                       (options.nofile, options.nofile))
+  except (ValueError, EnvironmentError) as err:
+    print("Can't raise file descriptor limit to %s: %s" %
+          (options.nofile, err), file=sys.stderr)
+
+  print("Descriptor limit: %s" % utils.GetMaxFd())
+  print("%-20s %10s" % ("Method", "Time (ms)"))
+
+  # The last descriptor is used to report the result
+  methods = [
+    ("close each", _CloseEach),
+    ("closefds", lambda: utils.CloseFds(keep=[utils.GetMaxFd() - 1])),
+    ("closefds (no procfs)",
+     lambda: utils.CloseFds(keep=[utils.GetMaxFd() - 1],
+                            _proc_fd_dir="/does/not/exist")),
+    ]
+
+  for (name, fn) in methods:
+    print("%-20s %10.2f" % (name, _Measure(fn, options.count) * 1000))
+
+
+if __name__ == "__main__":
+  main()
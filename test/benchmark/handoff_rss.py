@@ -0,0 +1,122 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Memory used per connected session by the session proxy modes.
+
+Measures the resident set size of a Python process with nxserver's modules
+loaded, of fdcopy and of netcat while relaying an idle connection. Run from
+the build directory:
+
+  PYTHONPATH=. test/benchmark/handoff_rss.py [--fdcopy=src/fdcopy]
+
+"""
+
+
+import optparse
+import os
+import socket
+import sys
+import time
+
+
+_NXSERVER_MODULES = ["cli", "constants", "errors", "metrics", "node",
+                     "protocol", "relay", "session", "utils"]
+
+# Modules which can't be imported (e.g. missing PyGTK on a build host) are
+# skipped and reported on stderr
+_PROGRAM = r'''
+import sys, time
+for name in sys.argv[1:]:
+  try:
+    __import__("quicknx." + name)
+  except ImportError as err:
+    sys.stderr.write("Skipping quicknx.%s: %s\n" % (name, err))
+time.sleep(60)
+'''
+
+
+def _GetRss(pid):
+  """Returns the resident set size of a process in KiB.
+
+  """
+  for line in open("/proc/%d/status" % pid):
+    if line.startswith("VmRSS:"):
+      return int(line.split()[1])
+  raise RuntimeError("No VmRSS for process %s" % pid)
+
+
+def _Measure(args, fds):
+  """Starts a program, waits for it to settle and returns its RSS.
+
+  """
+  for fd in fds:
+    os.set_inheritable(fd, True)
+
+  pid = os.spawnv(os.P_NOWAIT, args[0], args)
+  try:
+    time.sleep(1)
+    return _GetRss(pid)
+  finally:
+    os.kill(pid, 15)
+    os.waitpid(pid, 0)
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--fdcopy", dest="fdcopy", default="src/fdcopy",
+                    help="Path to fdcopy")
+  parser.add_option("--netcat", dest="netcat", default="/bin/netcat",
+                    help="Path to netcat")
+  (options, _) = parser.parse_args()
+
+  listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listener.bind(("127.0.0.1", 0))
+  listener.listen(5)
+  (host, port) = listener.getsockname()
+
+  (a, b) = socket.socketpair()
+  (c, d) = socket.socketpair()
+
+  python_rss = _Measure([sys.executable, "-c", _PROGRAM] +
+                        _NXSERVER_MODULES, [])
+
+  fdcopy_rss = _Measure([options.fdcopy, "%s:%s" % (a.fileno(), c.fileno()),
+                         "%s:%s" % (c.fileno(), a.fileno())],
+                        [a.fileno(), c.fileno()])
+
+  print("%-10s %14s" % ("Mode", "RSS (KiB)"))
+
+  if os.path.exists(options.netcat):
+    netcat_rss = _Measure([options.netcat, host, str(port)], [])
+    print("%-10s %14d" % ("netcat", python_rss + netcat_rss))
+  else:
+    print("%s not found, skipping" % options.netcat, file=sys.stderr)
+
+  print("%-10s %14d" % ("builtin", python_rss))
+  print("%-10s %14d" % ("handoff", fdcopy_rss))
+
+  for sock in [listener, a, b, c, d]:
+    sock.close()
+
+
+if __name__ == "__main__":
+  main()
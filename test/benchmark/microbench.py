@@ -0,0 +1,324 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+"""Microbenchmarks for hot paths, compared against stored baselines.
+
+Every benchmark's time per operation is divided by the time of a fixed
+calibration loop, making results roughly comparable between machines. The
+relative cost is compared against test/benchmark/microbench_baseline.json and
+the script exits with a non-zero status if a benchmark got slower by more
+than the tolerance, so it can be run by "make check-microbench". Benchmarks
+whose dependencies (e.g. PyGObject) aren't installed are skipped. Run from
+the build directory:
+
+  PYTHONPATH=. test/benchmark/microbench.py [--tolerance=0.5] [--update]
+
+Use --update after an intended change to store new baselines.
+
+"""
+
+
+import optparse
+import os
+import sys
+import time
+
+from quicknx import serializer
+
+
+_BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "microbench_baseline.json")
+
+_REPEAT = 7
+_MIN_DURATION = 0.1
+
+# Number of sessions in the table formatting benchmark
+_TABLE_SESSIONS = 5000
+
+_START_PARAMS = " ".join([
+  "--backingstore=\"1\"",
+  "--cache=\"16M\"",
+  "--client=\"linux\"",
+  "--composite=\"1\"",
+  "--encryption=\"1\"",
+  "--fullscreen=\"0\"",
+  "--geometry=\"3840x1150\"",
+  "--images=\"64M\"",
+  "--keyboard=\"pc102/gb\"",
+  "--link=\"lan\"",
+  "--media=\"0\"",
+  "--rootless=\"0\"",
+  "--screeninfo=\"3840x1150x24+render\"",
+  "--session=\"localtest\"",
+  "--shmem=\"1\"",
+  "--shpix=\"1\"",
+  "--strict=\"0\"",
+  "--type=\"unix-gnome\"",
+  "--virtualdesktop=\"1\"",
+  "--resize=\"1\"",
+  ])
+
+_NXAGENT_OUTPUT = b"".join([
+  b"NXAGENT - Version 3.3.0\n",
+  b"Info: Agent running with pid '4242'.\n",
+  b"Session: Starting session at 'Mon Oct 18 12:00:00 2026'.\n",
+  b"Info: Proxy running in server mode with pid '4242'.\n",
+  b"Info: Waiting for connection from '127.0.0.1' on port '4001'.\n",
+  b"Info: Accepted connection from '127.0.0.1'.\n",
+  b"Info: Connection with remote proxy completed.\n",
+  b"Session: Session started at 'Mon Oct 18 12:00:01 2026'.\n",
+  b"Info: Screen [0] resized to geometry [800x600] fullscreen [0].\n",
+  ])
+
+
+def _MakeSessionState(num):
+  from quicknx import session
+
+  return {
+    "cookie": session.NewUniqueId(_data=num),
+    "display": 1000 + num,
+    "fullscreen": bool(num % 2),
+    "geometry": "1920x1200+0+0",
+    "hostname": "node%d.example.com" % (num % 10),
+    "id": session.NewUniqueId(_data=-num),
+    "name": "Session %d" % num,
+    "options": None,
+    "phases": {},
+    "port": 5000 + num,
+    "rootless": False,
+    "screeninfo": "1920x1200x24+render",
+    "ssl": True,
+    "state": ["running", "suspended", "terminated"][num % 3],
+    "subscription": "GPL",
+    "type": "unix-gnome",
+    "username": "user%d" % num,
+    "virtualdesktop": True,
+    }
+
+
+def _SetupCalibration():
+  data = list(range(1000))
+
+  def fn():
+    total = 0
+    for i in data:
+      total += i * i
+    return total
+
+  return fn
+
+
+def _SetupParseParameters():
+  from quicknx import protocol
+
+  return lambda: protocol.ParseParameters(_START_PARAMS)
+
+
+def _SetupFormatTable():
+  from quicknx import session
+  from quicknx import utils
+  from quicknx.app import nxserver
+
+  sessions = [session.NxSession.Restore(_MakeSessionState(i))
+              for i in range(_TABLE_SESSIONS)]
+
+  return lambda: list(utils.FormatTable(sessions,
+                                        nxserver.LISTSESSION_COLUMNS))
+
+
+def _SetupDumpJson():
+  state = _MakeSessionState(1)
+  return lambda: serializer.DumpJson(state)
+
+
+def _SetupLoadJson():
+  data = serializer.DumpJson(_MakeSessionState(1))
+  return lambda: serializer.LoadJson(data)
+
+
+def _SetupNewUniqueId():
+  from quicknx import session
+
+  return session.NewUniqueId
+
+
+def _SetupChopReader():
+  from quicknx import daemon
+
+  channel = object()
+  slices = []
+
+  reader = daemon.ChopReader("\n")
+  reader.connect(daemon.ChopReader.SLICE_COMPLETE_SIGNAL,
+                 lambda _, line: slices.append(line))
+  reader._ChopReader__channel = channel
+
+  received = reader._ChopReader__ReceivedData
+
+  # nxagent's output arrives in arbitrary pieces
+  chunks = [_NXAGENT_OUTPUT[i:i + 37]
+            for i in range(0, len(_NXAGENT_OUTPUT), 37)]
+
+  def fn():
+    for chunk in chunks:
+      received(channel, chunk)
+    del slices[:]
+
+  return fn
+
+
+def _SetupParseVersion():
+  from quicknx import utils
+
+  return lambda: utils.ParseVersion("3.3.0-12.el5", ".-", [2, 2, 2])
+
+
+_BENCHMARKS = [
+  ("protocol.ParseParameters", _SetupParseParameters),
+  ("utils.FormatTable", _SetupFormatTable),
+  ("serializer.DumpJson", _SetupDumpJson),
+  ("serializer.LoadJson", _SetupLoadJson),
+  ("session.NewUniqueId", _SetupNewUniqueId),
+  ("daemon.ChopReader", _SetupChopReader),
+  ("utils.ParseVersion", _SetupParseVersion),
+  ]
+
+
+def _Measure(fn):
+  """Returns the fastest time per call in seconds.
+
+  """
+  # Find number of calls taking long enough to be measured
+  number = 1
+  while True:
+    start = time.time()
+    for _ in range(number):
+      fn()
+    if time.time() - start >= _MIN_DURATION:
+      break
+    number *= 2
+
+  best = None
+
+  for _ in range(_REPEAT):
+    start = time.time()
+    for _ in range(number):
+      fn()
+    duration = (time.time() - start) / number
+
+    if best is None or duration < best:
+      best = duration
+
+  return best
+
+
+def _ReadBaselines(filename):
+  try:
+    fh = open(filename)
+  except IOError:
+    return {}
+
+  try:
+    return serializer.LoadJson(fh.read())
+  finally:
+    fh.close()
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--tolerance", dest="tolerance", type="float",
+                    default=0.5,
+                    help="Allowed slowdown relative to the baseline"
+                         " (0.5 = 50%)")
+  parser.add_option("--baseline", dest="baseline", default=_BASELINE_FILE,
+                    help="File with baselines")
+  parser.add_option("--update", dest="update", default=False,
+                    action="store_true",
+                    help="Store measured values as new baselines")
+  (options, _) = parser.parse_args()
+
+  baselines = _ReadBaselines(options.baseline)
+
+  calibration_fn = _SetupCalibration()
+  calibrations = [_Measure(calibration_fn)]
+
+  durations = []
+  for (name, setup_fn) in _BENCHMARKS:
+    try:
+      fn = setup_fn()
+    except (ImportError, SyntaxError) as err:
+      sys.stderr.write("Skipping %s: %s\n" % (name, err))
+      durations.append((name, None))
+      continue
+
+    durations.append((name, _Measure(fn)))
+
+  # Background load only makes the calibration slower, hence the fastest
+  # result of runs before and after the benchmarks is used
+  calibrations.append(_Measure(calibration_fn))
+  calibration = min(calibrations)
+
+  print("%-26s %12s %10s %10s %8s" % ("Benchmark", "Time (us)", "Relative",
+                                      "Baseline", "Result"))
+  print("%-26s %12.2f" % ("(calibration)", calibration * 1e6))
+
+  failed = False
+
+  for (name, duration) in durations:
+    if duration is None:
+      print("%-26s %12s %10s %10s %8s" % (name, "-", "-", "-", "skipped"))
+      continue
+
+    relative = duration / calibration
+    baseline = baselines.get(name)
+
+    if options.update:
+      baselines[name] = round(relative, 3)
+      result = "updated"
+    elif baseline is None:
+      result = "new"
+    elif relative > baseline * (1 + options.tolerance):
+      result = "FAILED"
+      failed = True
+    else:
+      result = "ok"
+
+    if baseline is None:
+      baseline_text = "-"
+    else:
+      baseline_text = "%.3f" % baseline
+
+    print("%-26s %12.2f %10.3f %10s %8s" %
+          (name, duration * 1e6, relative, baseline_text, result))
+
+  if options.update:
+    fh = open(options.baseline, "w")
+    try:
+      fh.write(serializer.DumpJson(baselines))
+    finally:
+      fh.close()
+
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Benchmark for prompt matching during authentication.
+
+Runs a program printing a large banner (e.g. a chatty message of the day)
+before its password prompt and the NX prompt. Compares matching with
+pexpect's expect against the incremental matcher used by _ExpectAuthBase.
+Run from the build directory:
+
+  PYTHONPATH=. test/benchmark/prompt_benchmark.py [--sizes=64,1024,8192]
+
+"""
+
+
+import optparse
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+import pexpect
+
+from quicknx import auth
+
+
+_PROGRAM = r'''
+import sys
+line = "Message of the day: please read the usage policy. " * 2 + "\n"
+size = int(sys.argv[1]) * 1024
+written = 0
+while written < size:
+  sys.stdout.write(line)
+  written += len(line)
+sys.stdout.write("Password: ")
+sys.stdout.flush()
+sys.stdin.readline()
+sys.stdout.write("\nNX> 105 Hello\n")
+sys.stdout.flush()
+'''
+
+_PATTERNS = [
+  re.compile(r"^(\S+\s)?Password:\s*", re.I | re.M),
+  re.compile(r"^NX> ", re.M),
+  ]
+
+
+def _Spawn(size_kb):
+  return pexpect.spawn(sys.executable, args=["-c", _PROGRAM, str(size_kb)],
+                       timeout=300, encoding="UTF-8")
+
+
+def _RunPexpect(child):
+  while True:
+    idx = child.expect(_PATTERNS)
+    if idx == 0:
+      child.sendline("secret")
+      child.expect(os.linesep)
+    else:
+      return
+
+
+def _RunReader(child):
+  reader = auth._PromptReader(child)
+  while True:
+    (idx, _) = reader.Expect(_PATTERNS, child.timeout)
+    if idx == 0:
+      child.sendline("secret")
+      reader.Expect([re.compile(re.escape(os.linesep))], child.timeout)
+    else:
+      return
+
+
+def _Measure(fn, size_kb):
+  child = _Spawn(size_kb)
+  try:
+    tracemalloc.start()
+    start = time.time()
+    fn(child)
+    duration = time.time() - start
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+  finally:
+    child.close(force=True)
+
+  return (duration, peak)
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--sizes", dest="sizes", default="64,1024,8192",
+                    help="Comma-separated banner sizes in KiB")
+  (options, _) = parser.parse_args()
+
+  print("%-10s %-10s %10s %12s" % ("Banner", "Matcher", "Time (ms)",
+                                   "Peak (KiB)"))
+
+  for size_kb in [int(i) for i in options.sizes.split(",")]:
+    for (name, fn) in [("pexpect", _RunPexpect), ("reader", _RunReader)]:
+      (duration, peak) = _Measure(fn, size_kb)
+      print("%-10s %-10s %10.1f %12.1f" %
+            ("%d KiB" % size_kb, name, duration * 1000, peak / 1024.0))
+
+
+if __name__ == "__main__":
+  main()
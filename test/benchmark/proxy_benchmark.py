@@ -0,0 +1,202 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Benchmark for connecting the client to the session.
+
+Compares netcat with the builtin session proxy of nxserver. The client talks
+to the proxy through a socket pair standing in for the SSH connection and the
+proxy connects to a TCP port standing in for nxagent. Run from the build
+directory:
+
+  PYTHONPATH=. test/benchmark/proxy_benchmark.py [--netcat=/bin/nc]
+
+"""
+
+
+import optparse
+import os
+import socket
+import sys
+import threading
+import time
+
+from quicknx import relay
+
+
+def _StartNetcat(path, address, fd):
+  """Starts netcat with stdin and stdout connected to C{fd}.
+
+  """
+  pid = os.fork()
+  if pid == 0:
+    try:
+      os.dup2(fd, 0)
+      os.dup2(fd, 1)
+      os.execv(path, [path, address[0], str(address[1])])
+    finally:
+      os._exit(1)
+  return pid
+
+
+def _StartProxy(address, fd, use_splice, buffer_size):
+  """Starts the builtin proxy in a child process.
+
+  """
+  pid = os.fork()
+  if pid == 0:
+    try:
+      os.dup2(fd, 0)
+      os.dup2(fd, 1)
+      relay.RunTcpProxy(address, 0, 1, buffer_size=buffer_size,
+                        use_splice=use_splice)
+    finally:
+      os._exit(0)
+  return pid
+
+
+class _Setup(object):
+  """Client socket pair, proxy and TCP server.
+
+  """
+  def __init__(self, start_fn):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    (self.client, client_peer) = socket.socketpair()
+
+    self.pid = start_fn(listener.getsockname(), client_peer.fileno())
+
+    # Only the proxy keeps the inner end open
+    client_peer.close()
+
+    (self.server, _) = listener.accept()
+    self.server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    listener.close()
+
+  def Close(self):
+    self.client.close()
+    self.server.close()
+    os.waitpid(self.pid, 0)
+
+
+def _Throughput(setup, size):
+  """Sends C{size} bytes from client to server.
+
+  @rtype: float
+  @return: Megabytes per second
+
+  """
+  block = b"\0" * (64 * 1024)
+
+  def _Send():
+    remaining = size
+    while remaining > 0:
+      remaining -= setup.client.send(block[:remaining])
+
+  start = time.time()
+
+  sender = threading.Thread(target=_Send)
+  sender.start()
+
+  received = 0
+  while received < size:
+    data = setup.server.recv(256 * 1024)
+    if not data:
+      break
+    received += len(data)
+
+  sender.join()
+
+  return (received / (1024.0 * 1024.0)) / (time.time() - start)
+
+
+def _Latency(setup, count):
+  """Sends small messages back and forth.
+
+  @rtype: float
+  @return: Average round-trip time in microseconds
+
+  """
+  msg = b"x" * 64
+
+  start = time.time()
+
+  for _ in range(count):
+    setup.client.sendall(msg)
+    data = b""
+    while len(data) < len(msg):
+      data += setup.server.recv(len(msg) - len(data))
+
+    setup.server.sendall(data)
+    data = b""
+    while len(data) < len(msg):
+      data += setup.client.recv(len(msg) - len(data))
+
+  return ((time.time() - start) / count) * 1000000.0
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--netcat", dest="netcat", default="/bin/netcat",
+                    help="Path to netcat")
+  parser.add_option("--buffer-size", dest="buffer_size", type="int",
+                    default=0, help="Socket buffer size for builtin proxy")
+  parser.add_option("--size", dest="size", type="int", default=256,
+                    help="Megabytes for throughput test")
+  parser.add_option("--count", dest="count", type="int", default=10000,
+                    help="Round trips for latency test")
+  (options, _) = parser.parse_args()
+
+  variants = [
+    ("builtin-readwrite",
+     lambda address, fd: _StartProxy(address, fd, False,
+                                     options.buffer_size)),
+    ]
+
+  if relay.HaveSplice():
+    variants.append(("builtin-splice",
+                     lambda address, fd: _StartProxy(address, fd, True,
+                                                     options.buffer_size)))
+
+  if os.path.exists(options.netcat):
+    variants.insert(0, ("netcat",
+                        lambda address, fd: _StartNetcat(options.netcat,
+                                                         address, fd)))
+  else:
+    print("%s not found, skipping" % options.netcat, file=sys.stderr)
+
+  print("%-18s %12s %14s" % ("Variant", "MB/s", "RTT (us)"))
+
+  for (name, start_fn) in variants:
+    setup = _Setup(start_fn)
+    try:
+      latency = _Latency(setup, options.count)
+      throughput = _Throughput(setup, options.size * 1024 * 1024)
+    finally:
+      setup.Close()
+
+    print("%-18s %12.1f %14.1f" % (name, throughput, latency))
+
+
+if __name__ == "__main__":
+  main()
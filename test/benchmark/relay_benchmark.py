@@ -0,0 +1,202 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Benchmark for relaying data between file descriptors.
+
+Compares the fdcopy helper with the in-process relay (splice and read/write)
+on socket pairs. Run from the build directory:
+
+  PYTHONPATH=. test/benchmark/relay_benchmark.py [--fdcopy=src/fdcopy]
+
+"""
+
+
+import optparse
+import os
+import socket
+import sys
+import threading
+import time
+
+from quicknx import relay
+
+
+def _StartFdCopy(path, channels):
+  """Starts fdcopy for the given channels.
+
+  """
+  fds = set()
+  args = [path]
+  for (from_fd, to_fd) in channels:
+    args.append("%s:%s" % (from_fd, to_fd))
+    fds.update([from_fd, to_fd])
+
+  for fd in fds:
+    os.set_inheritable(fd, True)
+
+  return os.spawnv(os.P_NOWAIT, path, args)
+
+
+def _StartRelay(channels, use_splice):
+  """Starts the in-process relay in a child process.
+
+  """
+  pid = os.fork()
+  if pid == 0:
+    try:
+      # Like fdcopy after exec, only keep the relayed descriptors open
+      keep = set()
+      for (from_fd, to_fd) in channels:
+        keep.update([from_fd, to_fd])
+
+      for fd in os.listdir("/proc/self/fd"):
+        fd = int(fd)
+        if fd > 2 and fd not in keep:
+          try:
+            os.close(fd)
+          except OSError:
+            pass
+
+      relay.Relay(channels, use_splice=use_splice).Run()
+    finally:
+      os._exit(0)
+  return pid
+
+
+class _Setup(object):
+  """Two socket pairs with a relay in between, in both directions.
+
+  """
+  def __init__(self, start_fn):
+    (self.client, client_peer) = socket.socketpair()
+    (server_peer, self.server) = socket.socketpair()
+
+    self.pid = start_fn([(client_peer.fileno(), server_peer.fileno()),
+                         (server_peer.fileno(), client_peer.fileno())])
+
+    # Only the relay keeps the inner ends open
+    client_peer.close()
+    server_peer.close()
+
+  def Close(self):
+    self.client.close()
+    self.server.close()
+    os.waitpid(self.pid, 0)
+
+
+def _Throughput(setup, size):
+  """Sends C{size} bytes from client to server.
+
+  @rtype: float
+  @return: Megabytes per second
+
+  """
+  block = b"\0" * (64 * 1024)
+
+  def _Send():
+    remaining = size
+    while remaining > 0:
+      remaining -= setup.client.send(block[:remaining])
+    setup.client.shutdown(socket.SHUT_WR)
+
+  start = time.time()
+
+  sender = threading.Thread(target=_Send)
+  sender.start()
+
+  received = 0
+  while received < size:
+    data = setup.server.recv(256 * 1024)
+    if not data:
+      break
+    received += len(data)
+
+  sender.join()
+
+  return (received / (1024.0 * 1024.0)) / (time.time() - start)
+
+
+def _Latency(setup, count):
+  """Sends small messages back and forth.
+
+  @rtype: float
+  @return: Average round-trip time in microseconds
+
+  """
+  msg = b"x" * 64
+
+  start = time.time()
+
+  for _ in range(count):
+    setup.client.sendall(msg)
+    data = b""
+    while len(data) < len(msg):
+      data += setup.server.recv(len(msg) - len(data))
+
+    setup.server.sendall(data)
+    data = b""
+    while len(data) < len(msg):
+      data += setup.client.recv(len(msg) - len(data))
+
+  return ((time.time() - start) / count) * 1000000.0
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--fdcopy", dest="fdcopy", default="src/fdcopy",
+                    help="Path to fdcopy")
+  parser.add_option("--size", dest="size", type="int", default=256,
+                    help="Megabytes for throughput test")
+  parser.add_option("--count", dest="count", type="int", default=10000,
+                    help="Round trips for latency test")
+  (options, _) = parser.parse_args()
+
+  variants = [
+    ("relay-readwrite", lambda channels: _StartRelay(channels, False)),
+    ]
+
+  if relay.HaveSplice():
+    variants.append(("relay-splice",
+                     lambda channels: _StartRelay(channels, True)))
+
+  if os.path.exists(options.fdcopy):
+    variants.insert(0, ("fdcopy",
+                        lambda channels: _StartFdCopy(options.fdcopy,
+                                                      channels)))
+  else:
+    print("%s not found, skipping" % options.fdcopy, file=sys.stderr)
+
+  print("%-16s %12s %14s" % ("Variant", "MB/s", "RTT (us)"))
+
+  for (name, start_fn) in variants:
+    setup = _Setup(start_fn)
+    try:
+      latency = _Latency(setup, options.count)
+      throughput = _Throughput(setup, options.size * 1024 * 1024)
+    finally:
+      setup.Close()
+
+    print("%-16s %12.1f %14.1f" % (name, throughput, latency))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Benchmark for the SSH connection pool of the ssh authentication method.
+
+Logs in repeatedly using SshAuth, once without and once with connection
+pooling. By default a stand-in for ssh and sshd is used, which simulates the
+connection setup by sleeping and implements enough of OpenSSH's connection
+multiplexing for the pool. Run from the build directory:
+
+  PYTHONPATH=. test/benchmark/ssh_pool_benchmark.py [--handshake-ms=80]
+
+To measure against a real sshd, pass its host, a test account and the ssh
+program:
+
+  PYTHONPATH=. test/benchmark/ssh_pool_benchmark.py --ssh=/usr/bin/ssh \\
+    --host=localhost --user=test --password=...
+
+"""
+
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from quicknx import auth
+from quicknx import constants
+
+
+_STANDIN = r'''#!%(python)s
+import os, select, socket, sys, time
+
+HANDSHAKE = %(handshake)f
+
+
+def _Master(sock, path, persist):
+  # Accept session and stop requests until idle for too long
+  while True:
+    (ready, _, _) = select.select([sock], [], [], persist)
+    if not ready:
+      break
+    (conn, _) = sock.accept()
+    request = conn.recv(16)
+    conn.close()
+    if request == b"stop":
+      break
+  os.unlink(path)
+  os._exit(0)
+
+
+def main(args):
+  options = {}
+  user = None
+  control = None
+  operation = None
+  while args and args[0].startswith("-") and args[0] != "--":
+    arg = args.pop(0)
+    if arg.startswith("-o"):
+      (key, value) = arg[2:].split("=", 1)
+      options[key] = value
+    elif arg == "-l":
+      user = args.pop(0)
+    elif arg == "-S":
+      control = args.pop(0)
+    elif arg in ("-p", "-O"):
+      value = args.pop(0)
+      if arg == "-O":
+        operation = value
+  host = args.pop(0)
+
+  if operation == "stop":
+    sock = socket.socket(socket.AF_UNIX)
+    sock.connect(control)
+    sock.sendall(b"stop")
+    return 0
+
+  cmd = args[-1]
+  path = options.get("ControlPath", "none")
+  mode = options.get("ControlMaster", "no")
+
+  if mode == "no" and path != "none":
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+      sock.connect(path)
+      sock.sendall(b"session")
+      sock.close()
+      os.execv("/bin/sh", ["sh", "-c", cmd])
+    except socket.error:
+      pass
+
+  # Key exchange and password authentication
+  time.sleep(HANDSHAKE)
+  sys.stdout.write("%%s@%%s's password: " %% (user, host))
+  sys.stdout.flush()
+  sys.stdin.readline()
+  sys.stdout.write("\r\n")
+  sys.stdout.flush()
+
+  if mode == "yes" and path != "none":
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(path)
+    sock.listen(5)
+    if os.fork() == 0:
+      # Detach from the terminal like ssh does
+      os.setsid()
+      devnull = os.open(os.devnull, os.O_RDWR)
+      for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+      _Master(sock, path, int(options.get("ControlPersist", "60")))
+    sock.close()
+
+  os.execv("/bin/sh", ["sh", "-c", cmd])
+
+
+sys.exit(main(sys.argv[1:]))
+'''
+
+
+class _Config(object):
+  def __init__(self, options, pool_size):
+    self.auth_method = constants.AUTH_METHOD_SSH
+    self.auth_ssh_host = options.host
+    self.auth_ssh_port = options.port
+    self.auth_ssh_pool_size = pool_size
+    self.auth_ssh_pool_idle = 60
+    self.auth_relay = constants.AUTH_RELAY_SPLICE
+    self.ssh = options.ssh
+
+
+class _BenchmarkSshAuth(auth.SshAuth):
+  def __init__(self, cfg, ttysetup, **kwargs):
+    auth.SshAuth.__init__(self, cfg, **kwargs)
+    self.__ttysetup = ttysetup
+
+  def _GetTtySetupPath(self):
+    return self.__ttysetup
+
+
+def _Run(options, pool):
+  """Logs in repeatedly.
+
+  @rtype: list
+  @return: Duration of every login in seconds
+
+  """
+  if pool is None:
+    cfg = _Config(options, 0)
+  else:
+    cfg = _Config(options, options.pool_size)
+
+  devnull = os.open(os.devnull, os.O_RDWR)
+  try:
+    durations = []
+    for _ in range(options.count):
+      authenticator = _BenchmarkSshAuth(cfg, options.ttysetup,
+                                        stdout_fileno=devnull,
+                                        stdin_fileno=devnull,
+                                        _pool=pool)
+      start = time.time()
+      authenticator.AuthenticateAndRun(options.user, options.password,
+                                       ["echo", "NX> 105"])
+      durations.append(time.time() - start)
+    return durations
+  finally:
+    os.close(devnull)
+
+
+def _StopMasters(options, pooldir):
+  for name in os.listdir(pooldir):
+    if name.endswith(".sock"):
+      os.spawnv(os.P_WAIT, options.ssh,
+                [options.ssh, "-S", os.path.join(pooldir, name),
+                 "-O", "stop", options.host])
+
+
+def _Report(name, durations):
+  durations = sorted(durations)
+  print("%-10s %10.1f %10.1f %10.1f" %
+        (name, durations[0] * 1000,
+         durations[len(durations) // 2] * 1000,
+         sum(durations) * 1000 / len(durations)))
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--ssh", dest="ssh", default=None,
+                    help="ssh program (default: built-in stand-in)")
+  parser.add_option("--handshake-ms", dest="handshake_ms", type="float",
+                    default=80.0,
+                    help="Connection setup time of the stand-in")
+  parser.add_option("--host", dest="host", default="localhost")
+  parser.add_option("--port", dest="port", type="int", default=22)
+  parser.add_option("--user", dest="user", default="nxbench")
+  parser.add_option("--password", dest="password", default="secret")
+  parser.add_option("--ttysetup", dest="ttysetup", default="src/ttysetup")
+  parser.add_option("--count", dest="count", type="int", default=20)
+  parser.add_option("--pool-size", dest="pool_size", type="int", default=4)
+  (options, _) = parser.parse_args()
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    if options.ssh is None:
+      options.ssh = os.path.join(tmpdir, "ssh")
+      fd = os.open(options.ssh, os.O_WRONLY | os.O_CREAT, 0o755)
+      try:
+        os.write(fd, (_STANDIN % {
+          "python": sys.executable,
+          "handshake": options.handshake_ms / 1000.0,
+          }).encode("UTF-8"))
+      finally:
+        os.close(fd)
+
+    pooldir = os.path.join(tmpdir, "pool")
+    pool = auth.SshConnectionPool(pooldir, options.pool_size,
+                                  60, options.ssh)
+
+    print("%-10s %10s %10s %10s" % ("Mode", "min (ms)", "median", "mean"))
+    try:
+      _Report("direct", _Run(options, None))
+      _Report("pooled", _Run(options, pool))
+    finally:
+      if os.path.isdir(pooldir):
+        _StopMasters(options, pooldir)
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+  main()
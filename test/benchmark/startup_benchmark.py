@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Benchmark for the start time of QuickNX programs.
+
+Starts a new interpreter importing each program's module and compares the
+median time against a budget. Exits with a non-zero status if a program
+exceeds its budget, so it can be run by "make check-startup". Programs whose
+dependencies (e.g. PyGTK) aren't installed are skipped. Run from the build
+directory:
+
+  PYTHONPATH=. test/benchmark/startup_benchmark.py [--count=10]
+
+Use --import-profile on a program to see where its start time goes.
+
+"""
+
+
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+
+# Program module and budget in milliseconds, excluding the interpreter's own
+# start time
+_PROGRAMS = [
+  ("quicknx.app.nxserver_login", 75),
+  ("quicknx.app.nxserver", 100),
+  ("quicknx.app.nxbroker", 100),
+  ("quicknx.app.nxnode", 200),
+  ("quicknx.app.nxdialog", 400),
+  ]
+
+
+def _Start(code):
+  """Runs Python code in a new interpreter.
+
+  @rtype: float
+  @return: Time in seconds, or None if the code failed
+
+  """
+  start = time.time()
+  status = subprocess.call([sys.executable, "-c", code],
+                           stdout=open(os.devnull, "w"),
+                           stderr=open(os.devnull, "w"))
+  duration = time.time() - start
+
+  if status != 0:
+    return None
+
+  return duration
+
+
+def _Median(code, count):
+  durations = []
+  for _ in range(count):
+    duration = _Start(code)
+    if duration is None:
+      return None
+    durations.append(duration)
+
+  durations.sort()
+
+  return durations[len(durations) // 2]
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--count", dest="count", type="int", default=10,
+                    help="Starts per program")
+  (options, _) = parser.parse_args()
+
+  baseline = _Median("pass", options.count)
+
+  print("%-28s %10s %10s %8s" % ("Program", "Time (ms)", "Budget", "Result"))
+  print("%-28s %10.1f %10s %8s" % ("(interpreter)", baseline * 1000, "", ""))
+
+  failed = False
+
+  for (module, budget) in _PROGRAMS:
+    median = _Median("import %s" % module, options.count)
+
+    if median is None:
+      print("%-28s %10s %10d %8s" % (module, "-", budget, "skipped"))
+      continue
+
+    duration = (median - baseline) * 1000
+
+    if duration > budget:
+      result = "FAILED"
+      failed = True
+    else:
+      result = "ok"
+
+    print("%-28s %10.1f %10d %8s" % (module, duration, budget, result))
+
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
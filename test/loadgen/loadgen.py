@@ -0,0 +1,394 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""End-to-end load generator for nxserver.
+
+Starts sessions by speaking the NX protocol to nxserver, as nxclient does
+after logging in, and reports session starts per second and start and restore
+latencies. Sessions are run by the stand-ins for nxagent, xauth, xrdb and
+netcat in this directory, so neither X nor NX needs to be installed.
+
+QuickNX must be installed, e.g. into a scratch prefix, and configured to use
+the stand-ins. --print-config prints the settings to merge into the global
+section of quicknx.conf. nxserver runs as the current user:
+
+  PYTHONPATH=$pythondir test/loadgen/loadgen.py --print-config
+  PYTHONPATH=$pythondir test/loadgen/loadgen.py --sessions=100 \\
+    --parallel=10 --restore
+
+All sessions are terminated at the end.
+
+"""
+
+
+import math
+import optparse
+import os
+import select
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from quicknx import constants
+from quicknx import utils
+
+
+_FAKE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Same as in fake-nxagent
+_GREETING = b"QNXFAKE\n"
+
+_START_PARAMS = " ".join([
+  "--session=\"%(name)s\"",
+  "--type=\"unix-console\"",
+  "--cache=\"16M\"",
+  "--images=\"64M\"",
+  "--link=\"lan\"",
+  "--geometry=\"800x600\"",
+  "--keyboard=\"pc105/us\"",
+  "--client=\"linux\"",
+  "--encryption=\"1\"",
+  "--rootless=\"0\"",
+  "--virtualdesktop=\"1\"",
+  "--screeninfo=\"800x600x24+render\"",
+  ])
+
+_RESTORE_PARAMS = _START_PARAMS + " --id=\"%(id)s\""
+
+_CONFIG = """\
+nxagent-path = %(dir)s/fake-nxagent
+xauth-path = %(dir)s/fake-xauth
+xrdb-path = %(dir)s/fake-xrdb
+netcat-path = %(dir)s/fake-netcat
+session-proxy = netcat
+use-xsession = false
+start-console-command = /bin/sleep 86400
+"""
+
+
+class LoadError(Exception):
+  """Failure of a single session.
+
+  """
+
+
+class NxClient(object):
+  """Talks to nxserver over pipes.
+
+  """
+  def __init__(self, args, env, timeout):
+    self._timeout = timeout
+    self._buf = b""
+    self._proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, env=env,
+                                  close_fds=True)
+
+  def _Read(self, deadline):
+    fd = self._proc.stdout.fileno()
+
+    remaining = deadline - time.time()
+    if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+      raise LoadError("Timeout while waiting for nxserver")
+
+    data = os.read(fd, 4096)
+    if not data:
+      raise LoadError("nxserver closed the connection")
+
+    self._buf += data
+
+  def WaitFor(self, code):
+    """Reads responses until a status code is received.
+
+    @type code: int
+    @param code: Status code
+    @rtype: dict
+    @return: Messages received by status code
+
+    """
+    deadline = time.time() + self._timeout
+    prompt = ("NX> %d " % code).encode("ascii")
+    messages = {}
+
+    while True:
+      while b"\n" in self._buf or self._buf == prompt:
+        if self._buf == prompt:
+          # Prompts aren't followed by a newline
+          self._buf = b""
+          return messages
+
+        (line, self._buf) = self._buf.split(b"\n", 1)
+        line = line.decode("utf-8", "replace")
+
+        if not line.startswith("NX> "):
+          continue
+
+        parts = line[len("NX> "):].split(" ", 1)
+        if not parts[0].isdigit():
+          continue
+
+        linecode = int(parts[0])
+        message = (parts[1:] or [""])[0].strip()
+
+        if 500 <= linecode <= 599:
+          raise LoadError("nxserver error: %s" % message)
+
+        messages[linecode] = message
+
+        if linecode == code:
+          return messages
+
+      self._Read(deadline)
+
+  def WaitForGreeting(self):
+    """Waits for the session to send its greeting through the proxy.
+
+    """
+    deadline = time.time() + self._timeout
+
+    while len(self._buf) < len(_GREETING):
+      self._Read(deadline)
+
+    if not self._buf.startswith(_GREETING):
+      raise LoadError("Unexpected data from session: %r" % self._buf[:100])
+
+    self._buf = self._buf[len(_GREETING):]
+
+  def Send(self, line):
+    self._proc.stdin.write(line.encode("utf-8") + b"\n")
+    self._proc.stdin.flush()
+
+  def Close(self):
+    """Disconnects, which suspends a connected session.
+
+    """
+    try:
+      self._proc.stdin.close()
+    except EnvironmentError:
+      pass
+
+    deadline = time.time() + self._timeout
+    while self._proc.poll() is None and time.time() < deadline:
+      time.sleep(0.01)
+
+    if self._proc.poll() is None:
+      self._proc.kill()
+      self._proc.wait()
+
+    self._proc.stdout.close()
+
+
+def _Connect(options, env, command, params):
+  """Sends a session command to a new nxserver and waits for the session.
+
+  @rtype: tuple
+  @return: L{NxClient} connected to the session and session ID
+
+  """
+  # Passed the same way as by nxserver-login
+  proto = utils.ParseVersion(constants.DEFAULT_NX_PROTOCOL_VERSION,
+                             constants.NXAGENT_VERSION_SEP,
+                             constants.PROTOCOL_VERSION_DIGITS)
+
+  client = NxClient([options.nxserver, "--proto=%s" % proto, options.user],
+                    env, options.timeout)
+  try:
+    client.WaitFor(105)
+    client.Send("%s %s" % (command, params))
+    messages = client.WaitFor(710)
+    client.WaitFor(105)
+    client.Send("bye")
+    client.WaitFor(999)
+    client.WaitForGreeting()
+  except:
+    client.Close()
+    raise
+
+  # "Session id: <hostname>-<display>-<id>"
+  sessid = messages.get(700, "").split(" ")[-1].split("-")[-1]
+
+  return (client, sessid)
+
+
+class _Results(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.start = []
+    self.restore = []
+    self.errors = []
+
+
+def _RunSession(options, env, num, results):
+  """Starts a session and optionally suspends and restores it.
+
+  """
+  params = {"name": "load%d" % num}
+
+  start = time.time()
+  (client, sessid) = _Connect(options, env, "startsession",
+                              _START_PARAMS % params)
+  duration = time.time() - start
+  client.Close()
+
+  with results.lock:
+    results.start.append(duration)
+
+  if not options.restore:
+    return
+
+  # Wait for the session to be suspended
+  time.sleep(options.suspend_wait)
+
+  params["id"] = sessid
+
+  start = time.time()
+  (client, _) = _Connect(options, env, "restoresession",
+                         _RESTORE_PARAMS % params)
+  duration = time.time() - start
+  client.Close()
+
+  with results.lock:
+    results.restore.append(duration)
+
+
+def _Worker(options, env, counter, results):
+  while True:
+    with results.lock:
+      num = next(counter, None)
+    if num is None:
+      break
+
+    try:
+      _RunSession(options, env, num, results)
+    except (LoadError, EnvironmentError) as err:
+      with results.lock:
+        results.errors.append(str(err))
+
+
+def _Percentile(values, percent):
+  """Returns a percentile using the nearest-rank method.
+
+  """
+  values = sorted(values)
+  rank = int(math.ceil(len(values) * percent / 100.0))
+  return values[max(rank, 1) - 1]
+
+
+def _TerminateSessions(piddir):
+  """Terminates all fake nxagent processes.
+
+  """
+  for name in utils.ListVisibleFiles(piddir):
+    try:
+      os.kill(int(name.split(".")[0]), signal.SIGTERM)
+    except (ValueError, OSError):
+      pass
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--print-config", dest="print_config", default=False,
+                    action="store_true",
+                    help="Print configuration using the stand-ins and exit")
+  parser.add_option("--nxserver", dest="nxserver", default=constants.NXSERVER,
+                    help="Path to nxserver")
+  parser.add_option("--user", dest="user",
+                    default=utils.GetCurrentUserName(),
+                    help="Username passed to nxserver")
+  parser.add_option("--sessions", dest="sessions", type="int", default=20,
+                    help="Number of sessions")
+  parser.add_option("--parallel", dest="parallel", type="int", default=5,
+                    help="Sessions started at the same time")
+  parser.add_option("--restore", dest="restore", default=False,
+                    action="store_true",
+                    help="Suspend and restore every session")
+  parser.add_option("--suspend-wait", dest="suspend_wait", type="float",
+                    default=1.0,
+                    help="Seconds between disconnecting and restoring")
+  parser.add_option("--timeout", dest="timeout", type="float", default=60,
+                    help="Seconds to wait for nxserver")
+  parser.add_option("--start-delay", dest="start_delay", type="float",
+                    default=0.5, help="Time nxagent takes to start")
+  parser.add_option("--connect-delay", dest="connect_delay", type="float",
+                    default=0.2, help="Time nxagent takes after connecting")
+  parser.add_option("--resume-delay", dest="resume_delay", type="float",
+                    default=0.2, help="Time nxagent takes to resume")
+  (options, _) = parser.parse_args()
+
+  if options.print_config:
+    sys.stdout.write(_CONFIG % {"dir": _FAKE_DIR})
+    return
+
+  piddir = tempfile.mkdtemp()
+  try:
+    # Passed through nxserver and nxnode to the stand-ins
+    env = os.environ.copy()
+    env.update({
+      "QNX_FAKE_NXAGENT_PIDDIR": piddir,
+      "QNX_FAKE_NXAGENT_START_DELAY": str(options.start_delay),
+      "QNX_FAKE_NXAGENT_CONNECT_DELAY": str(options.connect_delay),
+      "QNX_FAKE_NXAGENT_RESUME_DELAY": str(options.resume_delay),
+      })
+
+    results = _Results()
+    counter = iter(range(options.sessions))
+    threads = [threading.Thread(target=_Worker,
+                                args=(options, env, counter, results))
+               for _ in range(options.parallel)]
+
+    start = time.time()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    duration = time.time() - start
+  finally:
+    _TerminateSessions(piddir)
+    time.sleep(1)
+    shutil.rmtree(piddir, ignore_errors=True)
+
+  print("Sessions: %d started, %d restored, %d failed in %.1f s" %
+        (len(results.start), len(results.restore), len(results.errors),
+         duration))
+  print("Sessions per second: %.2f" % (len(results.start) / duration))
+
+  print("%-10s %10s %10s %10s" % ("Operation", "p50 (ms)", "p99 (ms)",
+                                  "max (ms)"))
+  for (name, values) in [("start", results.start),
+                         ("restore", results.restore)]:
+    if values:
+      print("%-10s %10.1f %10.1f %10.1f" %
+            (name, _Percentile(values, 50) * 1000,
+             _Percentile(values, 99) * 1000, max(values) * 1000))
+
+  for err in sorted(set(results.errors)):
+    print("Error: %s" % err, file=sys.stderr)
+
+  if results.errors:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -22,13 +22,18 @@
 """Script for unittesting the nxserver_login module"""
 
 
+import shutil
+import tempfile
 import unittest
 
 from quicknx import constants
 from quicknx import errors
 from quicknx import protocol
+from quicknx import utils
 from quicknx.app import nxserver_login
 
+import mocks
+
 
 class TestConstants(unittest.TestCase):
   """Tests for constants"""
@@ -38,5 +43,178 @@ class TestConstants(unittest.TestCase):
     self.failIf(dummy_password.startswith(protocol.NX_PROMPT))
 
 
+class _FakeAdmissionConfig:
+  def __init__(self, max_concurrent, max_queued, queue_timeout):
+    self.login_max_concurrent = max_concurrent
+    self.login_max_queued = max_queued
+    self.login_queue_timeout = queue_timeout
+
+
+class TestLoginAdmission(unittest.TestCase):
+  """Tests for LoginAdmission"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.faketime = mocks.FakeTime(seconds=1000)
+    self.keepalives = 0
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _NewAdmission(self, max_concurrent, max_queued, queue_timeout):
+    cfg = _FakeAdmissionConfig(max_concurrent, max_queued, queue_timeout)
+    return nxserver_login.LoginAdmission(cfg, _slots_dir=self.tmpdir,
+                                         _time=self.faketime)
+
+  def _Hold(self, name, count):
+    """Takes all slots from another login.
+
+    """
+    sem = utils.SlotSemaphore(self.tmpdir, name, count)
+    self.failUnless(sem.TryAcquire())
+    return sem
+
+  def _Keepalive(self):
+    self.keepalives += 1
+
+  def testAdmitted(self):
+    admission = self._NewAdmission(2, 10, 60)
+    self.failUnless(admission.Acquire(self._Keepalive))
+    self.failUnless(self._NewAdmission(2, 10, 60).Acquire(self._Keepalive))
+    self.failUnlessEqual(self.keepalives, 0)
+
+    # Releasing twice doesn't hurt
+    admission.Release()
+    admission.Release()
+    self.failUnless(self._NewAdmission(2, 10, 60).Acquire(self._Keepalive))
+
+  def testQueued(self):
+    other = self._Hold("login", 1)
+
+    def _Keepalive():
+      self.keepalives += 1
+      if self.keepalives == 3:
+        other.Release()
+
+    admission = self._NewAdmission(1, 10, 60)
+    self.failUnless(admission.Acquire(_Keepalive))
+    self.failUnlessEqual(self.keepalives, 3)
+    self.failUnless(self.faketime.time() >= 1010)
+
+    # The queue slot was released
+    self._Hold("queue", 10).Release()
+
+  def testOrder(self):
+    other = self._Hold("login", 1)
+
+    earlier = utils.TicketQueue(self.tmpdir, "queue", 10)
+    self.failUnless(earlier.TryEnter())
+
+    def _Keepalive():
+      self.keepalives += 1
+      if self.keepalives == 2:
+        # The slot isn't taken while an earlier login is waiting
+        other.Release()
+      elif self.keepalives == 4:
+        earlier.Leave()
+
+    try:
+      admission = self._NewAdmission(1, 10, 60)
+      self.failUnless(admission.Acquire(_Keepalive))
+      self.failUnlessEqual(self.keepalives, 4)
+    finally:
+      earlier.Leave()
+
+  def testNoQueueJumping(self):
+    earlier = utils.TicketQueue(self.tmpdir, "queue", 10)
+    self.failUnless(earlier.TryEnter())
+    try:
+      # A free slot isn't taken directly while others are waiting
+      self.failIf(self._NewAdmission(1, 10, 12).Acquire(self._Keepalive))
+      self.failUnlessEqual(self.keepalives, 3)
+    finally:
+      earlier.Leave()
+
+  def testTimeout(self):
+    other = self._Hold("login", 1)
+    try:
+      admission = self._NewAdmission(1, 10, 12)
+      self.failIf(admission.Acquire(self._Keepalive))
+      self.failUnlessEqual(self.keepalives, 3)
+      self.failUnless(self.faketime.time() >= 1012)
+    finally:
+      other.Release()
+
+  def testRejected(self):
+    other = self._Hold("login", 1)
+    queued = self._Hold("queue", 1)
+    try:
+      self.failIf(self._NewAdmission(1, 1, 60).Acquire(self._Keepalive))
+      self.failIf(self._NewAdmission(1, 0, 60).Acquire(self._Keepalive))
+      self.failUnlessEqual(self.keepalives, 0)
+      self.failUnlessEqual(self.faketime.time(), 1000)
+    finally:
+      other.Release()
+      queued.Release()
+
+
+class _FakeLoginServer:
+  def __init__(self, lines):
+    self.lines = lines
+    self.codes = []
+
+  def Write(self, code, message=None, newline=None):
+    self.codes.append(code)
+
+  def WriteLine(self, line):
+    pass
+
+  def ReadLine(self, hide=False):
+    return self.lines.pop(0)
+
+  def WithoutTerminalEcho(self, fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+
+class _FakeLoginConfig:
+  def __init__(self, auth_method):
+    self.auth_method = auth_method
+
+
+class TestLogin(unittest.TestCase):
+  """Tests for the login command"""
+
+  def _Login(self, current_user, auth_method):
+    server = _FakeLoginServer(["user1", "secret"])
+    handler = \
+      nxserver_login.LoginCommandHandler(server,
+                                         _FakeLoginConfig(auth_method),
+                                         _get_username=lambda: current_user)
+
+    calls = []
+    handler._TryLogin = lambda *args: calls.append(("login", ) + args)
+    handler._RunNxServer = lambda: calls.append(("run", ))
+
+    handler(protocol.NX_CMD_LOGIN)
+
+    return (server.codes, calls)
+
+  def testPrompts(self):
+    for (current_user, auth_method) in [
+      ("root", constants.AUTH_METHOD_PAM),
+      ("root", constants.AUTH_METHOD_SU),
+      (constants.NXUSER, constants.AUTH_METHOD_SU),
+      ("user1", constants.AUTH_METHOD_PAM),
+      ]:
+      (codes, calls) = self._Login(current_user, auth_method)
+      self.failUnlessEqual(codes, [101, 102])
+      self.failUnlessEqual(calls, [("login", "user1", "secret")])
+
+  def testAuthenticatedOverSsh(self):
+    (codes, calls) = self._Login("user1", constants.AUTH_METHOD_SU)
+    self.failUnlessEqual(codes, [])
+    self.failUnlessEqual(calls, [("run", )])
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -23,7 +23,10 @@
 
 
 import os
+import pexpect
 import re
+import shutil
+import socket
 import tempfile
 import unittest
 
@@ -32,6 +35,8 @@ from quicknx import constants
 from quicknx import errors
 from quicknx import utils
 
+import mocks
+
 
 DUMMY_USER = "dummyuser"
 DUMMY_USER2 = "anotheruser"
@@ -116,6 +121,17 @@ class _FakeAuthConfig:
     self.su = constants.SU
     self.ssh = constants.SSH
 
+    self.auth_pam_service = "quicknx-test"
+
+    self.auth_cache_ttl = 0
+    self.auth_failure_ttl = 0
+    self.auth_max_failures = 0
+
+    self.auth_relay = constants.AUTH_RELAY_FDCOPY
+
+    self.auth_ssh_pool_size = 0
+    self.auth_ssh_pool_idle = 300
+
 
 class TestGetAuthenticator(unittest.TestCase):
   """Tests for GetAuthenticator"""
@@ -197,10 +213,14 @@ class TestExpectAuthBase(unittest.TestCase):
            "  echo 'Hello World';"
            "done")
 
-    for confirmation in [False, True]:
+    for (confirmation, relay) in [(False, constants.AUTH_RELAY_FDCOPY),
+                                  (True, constants.AUTH_RELAY_FDCOPY),
+                                  (False, constants.AUTH_RELAY_SPLICE),
+                                  (True, constants.AUTH_RELAY_SPLICE)]:
       dummyout = tempfile.TemporaryFile()
       input = tempfile.TemporaryFile()
       cfg = _FakeAuthConfig("dummy")
+      cfg.auth_relay = relay
 
       authcmd = _WriteAuthScript(confirmation)
       try:
@@ -217,5 +237,506 @@ class TestExpectAuthBase(unittest.TestCase):
       self.failUnlessEqual(data, expected)
 
 
+class _FakeChild:
+  def __init__(self, chunks):
+    self.chunks = chunks
+
+  def read_nonblocking(self, size, timeout):
+    if not self.chunks:
+      raise pexpect.EOF("End of file")
+    return self.chunks.pop(0)
+
+
+class TestPromptReader(unittest.TestCase):
+  """Tests for _PromptReader"""
+
+  def setUp(self):
+    self.patterns = [re.compile(r"^Password:\s*", re.I),
+                     re.compile(r"^NX> ", re.M)]
+
+  def testSplitPrompt(self):
+    reader = auth._PromptReader(_FakeChild(["Welcome\nPass", "word: ",
+                                            "\nNX> 105 Hello\nmore"]))
+    self.failUnlessEqual(reader.Expect(self.patterns, 30),
+                         (0, "Password: "))
+    self.failUnlessEqual(reader.buffer, "")
+
+    self.failUnlessEqual(reader.Expect(self.patterns, 30), (1, "NX> "))
+    self.failUnlessEqual(reader.buffer, "105 Hello\nmore")
+    self.failUnlessEqual(reader.GetTranscript(),
+                         "Welcome\nPassword: \nNX> 105 Hello\nmore")
+
+  def testEarliestMatch(self):
+    reader = auth._PromptReader(_FakeChild(["a\nNX> Password: x"]))
+    self.failUnlessEqual(reader.Expect([re.compile("Password:"),
+                                        re.compile("^NX> ", re.M)], 30),
+                         (1, "NX> "))
+    self.failUnlessEqual(reader.buffer, "Password: x")
+
+    # The rest is searched by the next call
+    self.failUnlessEqual(reader.Expect([re.compile("Password:")], 30),
+                         (0, "Password:"))
+    self.failUnlessEqual(reader.buffer, " x")
+
+  def testLongLine(self):
+    chunks = 100 * [100 * "x"] + ["NX> "]
+    reader = auth._PromptReader(_FakeChild(chunks), window=512)
+    self.failUnlessRaises(pexpect.EOF, reader.Expect, self.patterns, 30)
+
+    chunks = 100 * [100 * "x"] + ["\nNX> "]
+    reader = auth._PromptReader(_FakeChild(chunks), window=512)
+    self.failUnlessEqual(reader.Expect(self.patterns, 30), (1, "NX> "))
+
+    # A match within the window is found
+    chunks = 100 * [100 * "x"] + ["Password: "]
+    reader = auth._PromptReader(_FakeChild(chunks), window=512)
+    self.failUnlessEqual(reader.Expect([re.compile("Password:")], 30),
+                         (0, "Password:"))
+
+  def testTranscript(self):
+    chunks = 1000 * ["Message of the day\n"]
+    reader = auth._PromptReader(_FakeChild(chunks), transcript_size=100)
+    self.failUnlessRaises(pexpect.EOF, reader.Expect, self.patterns, 30)
+
+    transcript = reader.GetTranscript()
+    self.failUnless(transcript.startswith("..."))
+    self.failUnless(transcript.endswith("Message of the day\n"))
+    self.failUnlessEqual(len(transcript), 103)
+
+
+class _FakePamTransaction:
+  def __init__(self, pam, service, username, password):
+    self.pam = pam
+    self.service = service
+    self.username = username
+    self.password = password
+
+  def Authenticate(self):
+    self.pam.calls.append((self.service, self.username))
+    if self.pam.users.get(self.username, None) != self.password:
+      raise errors.AuthFailedError("Authentication failure")
+
+  def CheckAccount(self):
+    if self.username not in self.pam.users:
+      raise errors.AuthFailedError("Unknown user")
+
+  def OpenSession(self):
+    self.pam.events.append(("open", self.username))
+
+  def CloseSession(self):
+    self.pam.events.append(("close", self.username))
+
+  def GetEnvironment(self):
+    return self.pam.env
+
+  def End(self):
+    self.pam.events.append(("end", self.username))
+
+
+class _FakePam:
+  def __init__(self, users):
+    self.users = users
+    self.calls = []
+    self.events = []
+    self.env = {}
+
+  def Start(self, service, username, password):
+    return _FakePamTransaction(self, service, username, password)
+
+
+class TestPamAuth(unittest.TestCase):
+  """Tests for PamAuth"""
+
+  def setUp(self):
+    self.pam = _FakePam({DUMMY_USER: DUMMY_PASSWORD})
+    self.started = []
+
+  def _Run(self, username, args, pam_env=None):
+    self.pam.events.append(("run", username))
+    self.started.append((username, args))
+    return 0
+
+  def _GetAuthenticator(self, run_fn=None):
+    if run_fn is None:
+      run_fn = self._Run
+    return auth.PamAuth(_FakeAuthConfig(constants.AUTH_METHOD_PAM),
+                        _pam=self.pam, _run_fn=run_fn, _geteuid=lambda: 0)
+
+  def test(self):
+    authenticator = self._GetAuthenticator()
+
+    authenticator.AuthenticateAndRun(DUMMY_USER, DUMMY_PASSWORD,
+                                     ["/bin/echo", "NX> 105"])
+    self.failUnlessEqual(self.started,
+                         [(DUMMY_USER, ["/bin/echo", "NX> 105"])])
+
+    for (username, password) in [(DUMMY_USER, DUMMY_PASSWORD2),
+                                 (DUMMY_USER2, DUMMY_PASSWORD)]:
+      self.failUnlessRaises(errors.AuthFailedError,
+                            authenticator.AuthenticateAndRun,
+                            username, password, ["/bin/echo", "NX> 105"])
+
+    self.failUnlessEqual(len(self.started), 1)
+    self.failUnlessEqual(self.pam.calls, [
+      ("quicknx-test", DUMMY_USER),
+      ("quicknx-test", DUMMY_USER),
+      ("quicknx-test", DUMMY_USER2),
+      ])
+
+  def testSession(self):
+    authenticator = self._GetAuthenticator()
+
+    authenticator.AuthenticateAndRun(DUMMY_USER, DUMMY_PASSWORD, ["/bin/true"])
+    self.failUnlessEqual(self.pam.events, [
+      ("open", DUMMY_USER),
+      ("run", DUMMY_USER),
+      ("close", DUMMY_USER),
+      ("end", DUMMY_USER),
+      ])
+
+    # No session without successful authentication
+    del self.pam.events[:]
+    self.failUnlessRaises(errors.AuthFailedError,
+                          authenticator.AuthenticateAndRun,
+                          DUMMY_USER, DUMMY_PASSWORD2, ["/bin/true"])
+    self.failUnlessEqual(self.pam.events, [("end", DUMMY_USER)])
+
+    # Runs without authentication still open a session
+    del self.pam.events[:]
+    authenticator.RunAuthenticated(DUMMY_USER, ["/bin/true"])
+    self.failUnlessEqual(len(self.pam.calls), 2)
+    self.failUnlessEqual([name for (name, _) in self.pam.events],
+                         ["open", "run", "close", "end"])
+
+  def testPamEnvironment(self):
+    self.pam.env = {"XDG_RUNTIME_DIR": "/run/user/1000"}
+    environments = []
+
+    def _Run(username, args, pam_env=None):
+      environments.append(pam_env)
+      return 0
+
+    self._GetAuthenticator(run_fn=_Run).AuthenticateAndRun(DUMMY_USER,
+                                                           DUMMY_PASSWORD,
+                                                           ["/bin/true"])
+    self.failUnlessEqual(environments,
+                         [{"XDG_RUNTIME_DIR": "/run/user/1000"}])
+
+  def testRunFailure(self):
+    def _Fail(username, args, pam_env=None):
+      raise OSError("No such file")
+
+    authenticator = self._GetAuthenticator(run_fn=_Fail)
+
+    self.failUnlessRaises(errors.AuthError, authenticator.AuthenticateAndRun,
+                          DUMMY_USER, DUMMY_PASSWORD, ["/nonexistent"])
+
+    # The session is closed even if the program couldn't be started
+    self.failUnlessEqual([name for (name, _) in self.pam.events],
+                         ["open", "close", "end"])
+
+  def testRequiresRoot(self):
+    cfg = _FakeAuthConfig(constants.AUTH_METHOD_PAM)
+
+    self.failUnlessRaises(errors.AuthError, auth.PamAuth, cfg,
+                          _pam=self.pam, _geteuid=lambda: 1000)
+    self.failUnlessRaises(errors.AuthError, auth.CheckPrivileges, cfg,
+                          _geteuid=lambda: 1000)
+    auth.CheckPrivileges(cfg, _geteuid=lambda: 0)
+
+    cfg = _FakeAuthConfig(constants.AUTH_METHOD_SU)
+    auth.CheckPrivileges(cfg, _geteuid=lambda: 1000)
+
+  def testGetPamResponses(self):
+    messages = [
+      (auth._PAM_TEXT_INFO, "Welcome"),
+      (auth._PAM_PROMPT_ECHO_OFF, "Password: "),
+      (auth._PAM_ERROR_MSG, "Password expires soon"),
+      (auth._PAM_PROMPT_ECHO_ON, "Token: "),
+      ]
+    self.failUnlessEqual(auth._GetPamResponses(messages, DUMMY_PASSWORD),
+                         [None, DUMMY_PASSWORD, None, ""])
+
+
+class TestAuthCache(unittest.TestCase):
+  """Tests for AuthCache"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.faketime = mocks.FakeTime(seconds=1000)
+    self.cache = auth.AuthCache(os.path.join(self.tmpdir, "cache.json"),
+                                _time=self.faketime)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testVerified(self):
+    cache = self.cache
+    self.failIf(cache.IsVerified(DUMMY_USER, DUMMY_PASSWORD, 60))
+
+    cache.AddVerified(DUMMY_USER, DUMMY_PASSWORD, 60)
+    self.failUnless(cache.IsVerified(DUMMY_USER, DUMMY_PASSWORD, 60))
+    self.failIf(cache.IsVerified(DUMMY_USER, DUMMY_PASSWORD2, 60))
+    self.failIf(cache.IsVerified(DUMMY_USER2, DUMMY_PASSWORD, 60))
+
+    # Only salted hashes are stored
+    self.failIf(DUMMY_PASSWORD in open(cache._filename).read())
+
+    self.faketime.AddSeconds(61)
+    self.failIf(cache.IsVerified(DUMMY_USER, DUMMY_PASSWORD, 60))
+
+  def testFailures(self):
+    cache = self.cache
+
+    cache.AddFailure(DUMMY_USER, DUMMY_PASSWORD2, 30)
+    self.faketime.AddSeconds(10)
+    cache.AddFailure(DUMMY_USER, DUMMY_PASSWORD, 30)
+
+    self.failUnless(cache.IsRecentFailure(DUMMY_USER, DUMMY_PASSWORD2, 30))
+    self.failIf(cache.IsRecentFailure(DUMMY_USER2, DUMMY_PASSWORD2, 30))
+    self.failUnlessEqual(cache.CountFailures(DUMMY_USER, 30), 2)
+
+    self.faketime.AddSeconds(25)
+    self.failIf(cache.IsRecentFailure(DUMMY_USER, DUMMY_PASSWORD2, 30))
+    self.failUnlessEqual(cache.CountFailures(DUMMY_USER, 30), 1)
+
+    cache.AddVerified(DUMMY_USER, DUMMY_PASSWORD2, 30)
+    self.failUnlessEqual(cache.CountFailures(DUMMY_USER, 30), 0)
+
+    cache.AddFailure(DUMMY_USER, DUMMY_PASSWORD, 30)
+    cache.ResetFailures(DUMMY_USER, 30)
+    self.failUnlessEqual(cache.CountFailures(DUMMY_USER, 30), 0)
+
+
+class _FakeMaster(object):
+  """Listens on a control socket like an SSH master connection.
+
+  """
+  def __init__(self, path):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.bind(path)
+    self.sock.listen(5)
+
+  def Close(self):
+    self.sock.close()
+
+
+class TestSshConnectionPool(unittest.TestCase):
+  """Tests for SshConnectionPool"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.pooldir = os.path.join(self.tmpdir, "pool")
+    self.faketime = mocks.FakeTime(seconds=1000)
+    self.commands = []
+    self.masters = []
+    self.pool = auth.SshConnectionPool(self.pooldir, 2, 300, "/bin/ssh",
+                                       _time=self.faketime,
+                                       _run_fn=self.commands.append)
+
+  def tearDown(self):
+    for master in self.masters:
+      master.Close()
+    shutil.rmtree(self.tmpdir)
+
+  def _Login(self, username, password):
+    """Simulates a successful login.
+
+    """
+    (options, new_master) = self.pool.GetOptions(username, "host", 22,
+                                                 password)
+    if new_master:
+      sockpath = [i for i in options
+                  if i.startswith("-oControlPath=")][0].split("=", 1)[1]
+      self.masters.append(_FakeMaster(sockpath))
+      self.pool.Add(username, "host", 22, password)
+
+    return (options, new_master)
+
+  def testReuse(self):
+    (options, new_master) = self._Login(DUMMY_USER, DUMMY_PASSWORD)
+    self.failUnless(new_master)
+    self.failUnless("-oControlMaster=yes" in options)
+    self.failUnless("-oControlPersist=300" in options)
+    self.failUnlessEqual(os.stat(self.pooldir).st_mode & 0o777, 0o700)
+
+    # Only salted hashes are stored
+    for name in os.listdir(self.pooldir):
+      if name.endswith(".verifier"):
+        self.failIf(DUMMY_PASSWORD in
+                    open(os.path.join(self.pooldir, name)).read())
+
+    (options2, new_master) = self._Login(DUMMY_USER, DUMMY_PASSWORD)
+    self.failIf(new_master)
+    self.failUnless("-oControlMaster=no" in options2)
+    self.failUnless([i for i in options2 if i.startswith("-oControlPath=")] ==
+                    [i for i in options if i.startswith("-oControlPath=")])
+
+    # Another password must be checked by the server
+    (options, new_master) = self._Login(DUMMY_USER, DUMMY_PASSWORD2)
+    self.failIf(new_master)
+    self.failUnlessEqual(options, ["-oControlMaster=no", "-oControlPath=none"])
+
+    self.failUnlessEqual(self.commands, [])
+
+  def testStale(self):
+    self._Login(DUMMY_USER, DUMMY_PASSWORD)
+    self.masters.pop().Close()
+
+    (_, new_master) = self._Login(DUMMY_USER, DUMMY_PASSWORD)
+    self.failUnless(new_master)
+    self.failUnlessEqual(self.commands, [])
+
+  def testMaxAge(self):
+    self._Login(DUMMY_USER, DUMMY_PASSWORD)
+    self.faketime.AddSeconds(auth._SSH_POOL_MAX_AGE + 1)
+
+    # The old connection is stopped, even though it's still alive
+    (_, new_master) = self.pool.GetOptions(DUMMY_USER, "host", 22,
+                                           DUMMY_PASSWORD)
+    self.failUnless(new_master)
+    self.failUnlessEqual(len(self.commands), 1)
+    self.failUnlessEqual(self.commands[0][3:5], ["-O", "stop"])
+
+  def testEvict(self):
+    self._Login(DUMMY_USER, DUMMY_PASSWORD)
+    self.faketime.AddSeconds(10)
+    self._Login(DUMMY_USER2, DUMMY_PASSWORD)
+    self.faketime.AddSeconds(10)
+
+    # Mark first connection as recently used
+    self._Login(DUMMY_USER, DUMMY_PASSWORD)
+    self.faketime.AddSeconds(10)
+    self.failUnlessEqual(self.commands, [])
+
+    self._Login("user3", DUMMY_PASSWORD)
+    self.failUnlessEqual(len(self.commands), 1)
+    self.failUnlessEqual(self.commands[0][:2], ["/bin/ssh", "-S"])
+    self.failUnlessEqual(self.commands[0][3:5], ["-O", "stop"])
+
+    (_, new_master) = self.pool.GetOptions(DUMMY_USER, "host", 22,
+                                           DUMMY_PASSWORD)
+    self.failIf(new_master)
+    (_, new_master) = self.pool.GetOptions(DUMMY_USER2, "host", 22,
+                                           DUMMY_PASSWORD)
+    self.failUnless(new_master)
+
+  def testSshAuthOptions(self):
+    cfg = _FakeAuthConfig(constants.AUTH_METHOD_SSH)
+    authenticator = auth.SshAuth(cfg, _pool=self.pool)
+    self.failIf([i for i in authenticator.GetCommand(DUMMY_USER, ["true"])
+                 if i.startswith("-oControl")])
+
+    (authenticator._pool_options, _) = \
+      self.pool.GetOptions(DUMMY_USER, "host", 22, DUMMY_PASSWORD)
+    self.failUnless("-oControlMaster=yes" in
+                    authenticator.GetCommand(DUMMY_USER, ["true"]))
+
+
+class TestCachingAuthenticator(unittest.TestCase):
+  """Tests for CachingAuthenticator"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.faketime = mocks.FakeTime(seconds=1000)
+    self.cache = auth.AuthCache(os.path.join(self.tmpdir, "cache.json"),
+                                _time=self.faketime)
+    self.cfg = _FakeAuthConfig(constants.AUTH_METHOD_PAM)
+    self.pam = _FakePam({DUMMY_USER: DUMMY_PASSWORD})
+    self.started = []
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _Run(self, username, args, pam_env=None):
+    self.started.append(username)
+    return 0
+
+  def _GetAuthenticator(self):
+    return auth.CachingAuthenticator(self.cfg,
+                                     auth.PamAuth(self.cfg, _pam=self.pam,
+                                                  _run_fn=self._Run,
+                                                  _geteuid=lambda: 0),
+                                     self.cache)
+
+  def testPositive(self):
+    self.cfg.auth_cache_ttl = 60
+
+    results = []
+
+    for _ in range(3):
+      authenticator = self._GetAuthenticator()
+      authenticator.result_fn = results.append
+      authenticator.AuthenticateAndRun(DUMMY_USER, DUMMY_PASSWORD,
+                                       ["/bin/true"])
+
+    self.failUnlessEqual(self.started, 3 * [DUMMY_USER])
+    self.failUnlessEqual(len(self.pam.calls), 1)
+
+    # Results are reported for cache hits, too
+    self.failUnlessEqual(results, 3 * [auth._AUTH_RESULT_SUCCESS])
+
+    self.faketime.AddSeconds(61)
+    self._GetAuthenticator().AuthenticateAndRun(DUMMY_USER, DUMMY_PASSWORD,
+                                                ["/bin/true"])
+    self.failUnlessEqual(len(self.pam.calls), 2)
+
+  def testNegative(self):
+    self.cfg.auth_failure_ttl = 30
+
+    for _ in range(3):
+      self.failUnlessRaises(errors.AuthFailedError,
+                            self._GetAuthenticator().AuthenticateAndRun,
+                            DUMMY_USER, DUMMY_PASSWORD2, ["/bin/true"])
+
+    self.failUnlessEqual(len(self.pam.calls), 1)
+
+    # Other passwords are still checked
+    self._GetAuthenticator().AuthenticateAndRun(DUMMY_USER, DUMMY_PASSWORD,
+                                                ["/bin/true"])
+    self.failUnlessEqual(len(self.pam.calls), 2)
+    self.failUnlessEqual(self.started, [DUMMY_USER])
+
+  def testMaxFailures(self):
+    self.cfg.auth_failure_ttl = 30
+    self.cfg.auth_max_failures = 2
+
+    for password in ["a", "b", DUMMY_PASSWORD]:
+      self.failUnlessRaises(errors.AuthFailedError,
+                            self._GetAuthenticator().AuthenticateAndRun,
+                            DUMMY_USER, password, ["/bin/true"])
+
+    self.failUnlessEqual(len(self.pam.calls), 2)
+    self.failIf(self.started)
+
+    self.faketime.AddSeconds(31)
+    self._GetAuthenticator().AuthenticateAndRun(DUMMY_USER, DUMMY_PASSWORD,
+                                                ["/bin/true"])
+    self.failUnlessEqual(self.started, [DUMMY_USER])
+
+  def testSingleRead(self):
+    self.cfg.auth_cache_ttl = 60
+    self.cfg.auth_failure_ttl = 30
+    self.cfg.auth_max_failures = 5
+
+    self._GetAuthenticator().AuthenticateAndRun(DUMMY_USER, DUMMY_PASSWORD,
+                                                ["/bin/true"])
+
+    loads = []
+    orig_load = self.cache._Load
+
+    def _CountingLoad():
+      loads.append(None)
+      return orig_load()
+
+    self.cache._Load = _CountingLoad
+
+    # All checks on a cache hit use one read of the cache file
+    self._GetAuthenticator().AuthenticateAndRun(DUMMY_USER, DUMMY_PASSWORD,
+                                                ["/bin/true"])
+    self.failUnlessEqual(len(self.pam.calls), 1)
+    self.failUnlessEqual(len(loads), 1)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Script for unittesting the broker module"""
+
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+from quicknx import broker
+from quicknx import errors
+
+
+class TestRequest(unittest.TestCase):
+  """Tests for SendRequest and ReceiveRequest"""
+
+  def testRoundTrip(self):
+    (client, server) = socket.socketpair()
+    (read_fd, write_fd) = os.pipe()
+    try:
+      env = {
+        "SSH_CONNECTION": "192.0.2.1 4242 192.0.2.2 22",
+        "EMPTY": "",
+        "WITH_EQUALS": "a=b",
+        }
+
+      broker.SendRequest(client, [read_fd, write_fd], env)
+
+      (fds, received_env) = broker.ReceiveRequest(server)
+      try:
+        self.failUnlessEqual(len(fds), 2)
+        self.failUnlessEqual(received_env, env)
+
+        # The passed descriptors refer to the same pipe
+        os.write(fds[1], b"data")
+        self.failUnlessEqual(os.read(read_fd, 100), b"data")
+      finally:
+        for fd in fds:
+          os.close(fd)
+    finally:
+      for fd in [read_fd, write_fd]:
+        os.close(fd)
+      client.close()
+      server.close()
+
+  def testEmptyEnvironment(self):
+    (client, server) = socket.socketpair()
+    try:
+      broker.SendRequest(client, [0, 1], {})
+      (fds, env) = broker.ReceiveRequest(server)
+      for fd in fds:
+        os.close(fd)
+      self.failUnlessEqual(env, {})
+    finally:
+      client.close()
+      server.close()
+
+  def testInvalidMagic(self):
+    (client, server) = socket.socketpair()
+    try:
+      client.sendall(b"GET / HTTP/1.0\r\n\r\n")
+      self.failUnlessRaises(errors.BrokerError, broker.ReceiveRequest, server)
+    finally:
+      client.close()
+      server.close()
+
+  def testClosedDuringRequest(self):
+    (client, server) = socket.socketpair()
+    try:
+      client.sendall(broker.REQUEST_MAGIC)
+      client.close()
+      self.failUnlessRaises(errors.BrokerError, broker.ReceiveRequest, server)
+    finally:
+      server.close()
+
+  def testPeerUid(self):
+    (client, server) = socket.socketpair()
+    try:
+      self.failUnlessEqual(broker.GetPeerUid(server), os.getuid())
+    finally:
+      client.close()
+      server.close()
+
+
+def _EchoHandler():
+  line = sys.stdin.readline()
+  sys.stdout.write("%s %s" % (os.environ["GREETING"], line))
+  return 7
+
+
+class TestBrokerServer(unittest.TestCase):
+  """Tests for BrokerServer"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, "broker.sock")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _Run(self, server, fn):
+    server.Start()
+    thread = threading.Thread(target=server.Run)
+    thread.start()
+    try:
+      return fn()
+    finally:
+      server.Stop()
+      thread.join()
+      server.Close()
+
+  def _Login(self):
+    (in_read, in_write) = os.pipe()
+    (out_read, out_write) = os.pipe()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self.path)
+      broker.SendRequest(sock, [in_read, out_write], {"GREETING": "Hello"})
+      os.close(in_read)
+      os.close(out_write)
+
+      os.write(in_write, b"World\n")
+      os.close(in_write)
+
+      try:
+        status = broker.ReadReply(sock)
+      except errors.BrokerError:
+        status = None
+
+      output = b""
+      while True:
+        data = os.read(out_read, 1024)
+        if not data:
+          break
+        output += data
+      os.close(out_read)
+
+      return (status, output)
+    finally:
+      sock.close()
+
+  def testServe(self):
+    server = broker.BrokerServer(self.path, _EchoHandler)
+    (status, output) = self._Run(server, self._Login)
+    self.failUnlessEqual(status, 7)
+    self.failUnlessEqual(output, b"Hello World\n")
+    self.failIf(os.path.exists(self.path))
+
+  def testConcurrent(self):
+    server = broker.BrokerServer(self.path, _EchoHandler)
+
+    def _LoginMany():
+      results = []
+      threads = [threading.Thread(target=lambda: results.append(self._Login()))
+                 for _ in range(5)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      return results
+
+    results = self._Run(server, _LoginMany)
+    self.failUnlessEqual(results, [(7, b"Hello World\n")] * 5)
+
+  def testOtherUser(self):
+    server = broker.BrokerServer(self.path, _EchoHandler,
+                                 _uid=os.getuid() + 1)
+    (status, output) = self._Run(server, self._Login)
+    self.failUnlessEqual(status, None)
+    self.failUnlessEqual(output, b"")
+
+  def testStaleSocket(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(self.path)
+    sock.close()
+
+    server = broker.BrokerServer(self.path, _EchoHandler)
+    (status, _) = self._Run(server, self._Login)
+    self.failUnlessEqual(status, 7)
+
+  def testReload(self):
+    reloads = []
+    server = broker.BrokerServer(self.path, _EchoHandler,
+                                 reload_fn=lambda: reloads.append(None))
+
+    def _ReloadAndLogin():
+      server.RequestReload()
+      return self._Login()
+
+    self._Run(server, _ReloadAndLogin)
+    self.failUnlessEqual(len(reloads), 1)
+
+  def testAlreadyRunning(self):
+    server = broker.BrokerServer(self.path, _EchoHandler)
+    other = broker.BrokerServer(self.path, _EchoHandler)
+    self.failUnlessRaises(errors.BrokerError, self._Run, server, other.Start)
+
+
+if __name__ == '__main__':
+  unittest.main()
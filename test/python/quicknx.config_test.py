@@ -0,0 +1,161 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Script for unittesting the config module"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from quicknx import config
+from quicknx import constants
+from quicknx import errors
+
+
+class TestLoadConfig(unittest.TestCase):
+  """Tests for LoadConfig"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.tmpdir, "quicknx.conf")
+    self.snapshot_dir = os.path.join(self.tmpdir, "snapshots")
+    os.mkdir(self.snapshot_dir)
+
+    self.parsed = []
+    self._orig_read_config = config._ReadConfig
+
+    def _CountingReadConfig(filename):
+      self.parsed.append(filename)
+      return self._orig_read_config(filename)
+
+    config._ReadConfig = _CountingReadConfig
+
+  def tearDown(self):
+    config._ReadConfig = self._orig_read_config
+    shutil.rmtree(self.tmpdir)
+
+  def _WriteConfig(self, text):
+    fh = open(self.filename, "w")
+    try:
+      fh.write("[global]\n" + text)
+    finally:
+      fh.close()
+
+  def _Load(self, hostname="host1"):
+    return config.LoadConfig(self.filename, _snapshot_dir=self.snapshot_dir,
+                             _hostname=hostname)
+
+  def testSnapshot(self):
+    self._WriteConfig("auth-method = su\n")
+
+    cfg = self._Load()
+    self.failUnlessEqual(cfg.auth_method, "su")
+    self.failUnlessEqual(cfg.auth_ssh_host, "host1")
+    self.failUnlessEqual(len(self.parsed), 1)
+
+    snapshot = self._Load()
+    self.failUnlessEqual(len(self.parsed), 1)
+    self.failUnless(isinstance(snapshot, config.Config))
+    self.failUnlessEqual(snapshot.__dict__, cfg.__dict__)
+
+  def testChangedFile(self):
+    self._WriteConfig("auth-method = su\n")
+    self.failUnlessEqual(self._Load().auth_method, "su")
+
+    self._WriteConfig("auth-method = pam\n")
+    self.failUnlessEqual(self._Load().auth_method, "pam")
+    self.failUnlessEqual(len(self.parsed), 2)
+
+  def testChangedHostname(self):
+    self._WriteConfig("")
+    self.failUnlessEqual(self._Load().auth_ssh_host, "host1")
+    self.failUnlessEqual(self._Load(hostname="host2").auth_ssh_host, "host2")
+    self.failUnlessEqual(len(self.parsed), 2)
+
+  def testMissingFile(self):
+    cfg = self._Load()
+    self.failUnlessEqual(cfg.auth_ssh_host, "host1")
+    self._Load()
+    self.failUnlessEqual(len(self.parsed), 1)
+
+  def testWritableSnapshotIgnored(self):
+    self._WriteConfig("")
+    self._Load()
+
+    for name in os.listdir(self.snapshot_dir):
+      os.chmod(os.path.join(self.snapshot_dir, name), 0o666)
+
+    self._Load()
+    self.failUnlessEqual(len(self.parsed), 2)
+
+  def testInvalidSnapshot(self):
+    self._WriteConfig("")
+    self._Load()
+
+    for name in os.listdir(self.snapshot_dir):
+      fh = open(os.path.join(self.snapshot_dir, name), "w")
+      fh.write("garbage")
+      fh.close()
+
+    self.failUnlessEqual(self._Load().auth_ssh_host, "host1")
+    self.failUnlessEqual(len(self.parsed), 2)
+
+  def testNoSnapshotDir(self):
+    shutil.rmtree(self.snapshot_dir)
+    self._WriteConfig("auth-method = su\n")
+    self.failUnlessEqual(self._Load().auth_method, "su")
+
+  def testUnsupportedAttribute(self):
+    self._WriteConfig("auth-method = su\n")
+
+    orig_init = config.Config.__init__
+
+    def _Init(cfg, *args, **kwargs):
+      orig_init(cfg, *args, **kwargs)
+      cfg.unsupported = object()
+
+    config.Config.__init__ = _Init
+    try:
+      self.failUnlessEqual(self._Load().auth_method, "su")
+    finally:
+      config.Config.__init__ = orig_init
+
+    self.failIf(os.listdir(self.snapshot_dir))
+
+  def testChoices(self):
+    self._WriteConfig("session-proxy = handoff\nauth-relay = splice\n")
+    cfg = self._Load()
+    self.failUnlessEqual(cfg.session_proxy, constants.SESSION_PROXY_HANDOFF)
+    self.failUnlessEqual(cfg.auth_relay, constants.AUTH_RELAY_SPLICE)
+
+    for text in ["session-proxy = socat\n", "auth-relay = Splice\n"]:
+      self._WriteConfig(text)
+      self.failUnlessRaises(errors.ConfigurationError, self._Load)
+
+    # Invalid configurations aren't saved as snapshots
+    self.failUnlessEqual(len(os.listdir(self.snapshot_dir)), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
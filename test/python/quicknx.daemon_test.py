@@ -22,14 +22,59 @@
 """Script for unittesting the daemon module"""
 
 
+import os
+import signal
 import unittest
-from cStringIO import StringIO
 
-from quicknx import constants
+import gobject
+
 from quicknx import daemon
 
 
-# TODO: Write unittests for quicknx.daemon
+class TestProgram(unittest.TestCase):
+  """Tests for Program"""
+
+  def _RunUntilExited(self, prog):
+    """Runs the mainloop until the program's exit has been handled.
+
+    """
+    loop = gobject.MainLoop()
+    status = []
+
+    def _Exited(_, exitcode, signum):
+      status.append((exitcode, signum))
+      loop.quit()
+
+    prog.connect(daemon.Program.EXITED_SIGNAL, _Exited)
+    timeout_id = gobject.timeout_add(10000, loop.quit)
+    try:
+      loop.run()
+    finally:
+      gobject.source_remove(timeout_id)
+
+    return status
+
+  def testWaitTimeout(self):
+    prog = daemon.Program(["sleep", "10"])
+    prog.Start()
+
+    self.failIf(prog.Wait(timeout=0.05))
+
+    os.kill(prog.pid, signal.SIGKILL)
+    self.failUnless(prog.Wait(timeout=10))
+
+    # The exit status is still collected by the mainloop
+    self.failUnlessEqual(self._RunUntilExited(prog),
+                         [(None, signal.SIGKILL)])
+
+  def testWaitExited(self):
+    prog = daemon.Program(["true"])
+    prog.Start()
+
+    self.failUnlessEqual(self._RunUntilExited(prog), [(0, None)])
+
+    # The child has been reaped, the recorded status is used
+    self.failUnless(prog.Wait(timeout=0))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,231 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Script for unittesting the metrics module"""
+
+
+import unittest
+
+from quicknx import errors
+from quicknx import metrics
+
+import mocks
+
+
+class TestMarkPhase(unittest.TestCase):
+  """Tests for MarkPhase"""
+
+  def test(self):
+    faketime = mocks.FakeTime(seconds=100)
+    phases = {}
+
+    self.failUnless(metrics.MarkPhase(phases, "login", _time=faketime))
+    faketime.AddSeconds(5)
+    self.failUnless(metrics.MarkPhase(phases, "xauth", _time=faketime))
+    faketime.AddSeconds(5)
+    self.failIf(metrics.MarkPhase(phases, "login", _time=faketime))
+
+    self.failUnlessEqual(phases, {"login": 100.0, "xauth": 105.0})
+
+
+class TestGetPhaseDurations(unittest.TestCase):
+  """Tests for GetPhaseDurations"""
+
+  def testEmpty(self):
+    self.failUnlessEqual(metrics.GetPhaseDurations({}), [])
+
+  def testSingle(self):
+    self.failUnlessEqual(metrics.GetPhaseDurations({"a": 10.0}),
+                         [(metrics.PHASE_TOTAL, 0.0)])
+
+  def testOrder(self):
+    phases = {
+      "userapp": 17.0,
+      "login-start": 10.0,
+      "xauth": 12.5,
+      "login": 11.0,
+      }
+    self.failUnlessEqual(metrics.GetPhaseDurations(phases), [
+      ("login", 1.0),
+      ("xauth", 1.5),
+      ("userapp", 4.5),
+      (metrics.PHASE_TOTAL, 7.0),
+      ])
+
+
+class TestHistogram(unittest.TestCase):
+  """Tests for Histogram"""
+
+  def testObserve(self):
+    hist = metrics.Histogram(buckets=[1.0, 5.0])
+    for value in [0.5, 1.0, 3.0, 7.0, 9.0]:
+      hist.Observe(value)
+
+    self.failUnlessEqual(hist.count, 5)
+    self.failUnlessEqual(hist.sum, 20.5)
+    self.failUnlessEqual(hist.counts, [2, 1, 2])
+    self.failUnlessEqual(hist.GetCumulativeCounts(),
+                         [(1.0, 2), (5.0, 3), (None, 5)])
+
+  def testRestore(self):
+    hist = metrics.Histogram()
+    hist.Observe(0.2)
+    hist.Observe(12.0)
+
+    restored = metrics.Histogram.Restore(hist.Serialize())
+    self.failUnlessEqual(restored.counts, hist.counts)
+    self.failUnlessEqual(restored.count, 2)
+    self.failUnlessEqual(restored.sum, hist.sum)
+
+  def testRestoreDifferentBuckets(self):
+    hist = metrics.Histogram(buckets=[1.0, 5.0])
+    hist.Observe(2.0)
+
+    restored = metrics.Histogram.Restore(hist.Serialize())
+    self.failUnlessEqual(restored.buckets, metrics.LATENCY_BUCKETS)
+    self.failUnlessEqual(restored.count, 0)
+
+  def testRestoreInvalid(self):
+    for state in [None, [], "", {"buckets": []}]:
+      self.failUnlessEqual(metrics.Histogram.Restore(state).count, 0)
+
+
+class TestPhaseLatencies(unittest.TestCase):
+  """Tests for PhaseLatencies"""
+
+  def test(self):
+    lat = metrics.PhaseLatencies()
+    lat.Observe("unix-kde", [("xauth", 0.2), (metrics.PHASE_TOTAL, 3.0)])
+    lat.Observe("unix-kde", [("xauth", 0.02), (metrics.PHASE_TOTAL, 1.5)])
+    lat.Observe("unix-gnome", [("xauth", 0.3)])
+
+    restored = metrics.PhaseLatencies.Restore(lat.Serialize())
+
+    result = [(phase, sesstype, hist.count, hist.sum)
+              for (phase, sesstype, hist) in restored.GetHistograms()]
+    self.failUnlessEqual(result, [
+      (metrics.PHASE_TOTAL, "unix-kde", 2, 4.5),
+      ("xauth", "unix-gnome", 1, 0.3),
+      ("xauth", "unix-kde", 2, 0.22),
+      ])
+
+  def testRestoreInvalid(self):
+    for state in [None, {}, [["a", "b"]], "x"]:
+      latencies = metrics.PhaseLatencies.Restore(state)
+      self.failUnlessEqual(latencies.GetHistograms(), [])
+
+
+class TestRegistry(unittest.TestCase):
+  """Tests for Registry"""
+
+  def setUp(self):
+    self.registry = metrics.Registry()
+
+  def testEmpty(self):
+    self.registry.GetCounter("foo_total", "Foo")
+    self.failUnlessEqual(self.registry.FormatText(), "")
+
+  def testSameMetric(self):
+    counter = self.registry.GetCounter("foo_total", "Foo")
+    self.failUnless(self.registry.GetCounter("foo_total", "Foo") is counter)
+    self.failUnlessRaises(errors.ProgrammerError, self.registry.GetGauge,
+                          "foo_total", "Foo")
+
+  def testCounter(self):
+    counter = self.registry.GetCounter("foo_total", "Number of foos")
+    counter.Inc()
+    counter.Inc(amount=10)
+    counter.Inc(labels={"b": "x\"y", "a": "1"})
+
+    self.failUnlessEqual(counter.Get(), 11)
+    self.failUnlessEqual(counter.Get(labels={"a": "1", "b": "x\"y"}), 1)
+    self.failUnlessEqual(self.registry.FormatText(), "".join([
+      "# HELP foo_total Number of foos\n",
+      "# TYPE foo_total counter\n",
+      "foo_total 11\n",
+      "foo_total{a=\"1\",b=\"x\\\"y\"} 1\n",
+      ]))
+
+  def testGauge(self):
+    gauge = self.registry.GetGauge("sessions", "Sessions")
+    gauge.Set(1, labels={"state": "starting"})
+    gauge.Set(0, labels={"state": "starting"})
+    gauge.Inc(labels={"state": "running"})
+    gauge.Inc(labels={"state": "running"})
+    gauge.Dec(labels={"state": "running"})
+
+    self.failUnlessEqual(self.registry.FormatText(), "".join([
+      "# HELP sessions Sessions\n",
+      "# TYPE sessions gauge\n",
+      "sessions{state=\"running\"} 1\n",
+      "sessions{state=\"starting\"} 0\n",
+      ]))
+
+  def testHistogram(self):
+    hist = self.registry.GetHistogram("rpc_seconds", "RPC")
+    hist.Observe(0.02, labels={"cmd": "start"})
+    hist.Observe(100.0, labels={"cmd": "start"})
+
+    lines = self.registry.FormatText().splitlines()
+    self.failUnlessEqual(lines[:4], [
+      "# HELP rpc_seconds RPC",
+      "# TYPE rpc_seconds histogram",
+      "rpc_seconds_bucket{cmd=\"start\",le=\"0.01\"} 0",
+      "rpc_seconds_bucket{cmd=\"start\",le=\"0.025\"} 1",
+      ])
+    self.failUnlessEqual(lines[-3:], [
+      "rpc_seconds_bucket{cmd=\"start\",le=\"+Inf\"} 2",
+      "rpc_seconds_sum{cmd=\"start\"} 100.02",
+      "rpc_seconds_count{cmd=\"start\"} 2",
+      ])
+
+  def testMerge(self):
+    self.registry.GetCounter("foo_total", "Foo").Inc(amount=2)
+    self.registry.GetGauge("bar", "Bar").Set(5)
+    self.registry.GetHistogram("baz_seconds", "Baz").Observe(1.0)
+
+    restored = metrics.Registry.Restore(self.registry.Serialize())
+    self.failUnlessEqual(restored.FormatText(), self.registry.FormatText())
+
+    other = metrics.Registry()
+    other.GetCounter("foo_total", "Foo").Inc(amount=3)
+    other.GetGauge("bar", "Bar").Set(1)
+    other.GetHistogram("baz_seconds", "Baz").Observe(2.0)
+    other.GetCounter("new_total", "New").Inc()
+
+    restored.Merge(other)
+
+    self.failUnlessEqual(restored.GetCounter("foo_total", "Foo").Get(), 5)
+    self.failUnlessEqual(restored.GetGauge("bar", "Bar").Get(), 1)
+    self.failUnlessEqual(restored.GetCounter("new_total", "New").Get(), 1)
+
+    hist = restored.GetHistogram("baz_seconds", "Baz").Get()
+    self.failUnlessEqual(hist.count, 2)
+    self.failUnlessEqual(hist.sum, 3.0)
+
+  def testRestoreInvalid(self):
+    for state in [None, [], {"a": None}, {"a": {"type": "unknown"}}]:
+      self.failUnlessEqual(metrics.Registry.Restore(state).GetMetrics(), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+
+"""Script for unittesting the node module"""
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from quicknx import node
+
+
+class _FakeConfig(object):
+  def __init__(self, hostname=None, ttl=3600, timeout=2):
+    self.hostname = hostname
+    self.hostname_cache_ttl = ttl
+    self.hostname_resolve_timeout = timeout
+
+
+class _FakeTime(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def time(self):
+    return self.now
+
+
+class TestGetHostname(unittest.TestCase):
+  """Tests for GetHostname"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.time = _FakeTime()
+    self.lookups = []
+    self.result = "node1.example.com"
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _Resolve(self, timeout):
+    self.lookups.append(timeout)
+    return self.result
+
+  def _Get(self, cfg):
+    return node.GetHostname(cfg, _cache_dir=self.tmpdir,
+                            _resolve_fn=self._Resolve, _time=self.time)
+
+  def testConfigured(self):
+    cfg = _FakeConfig(hostname="nx.example.com")
+    self.failUnlessEqual(self._Get(cfg), "nx.example.com")
+    self.failIf(self.lookups)
+
+  def testCached(self):
+    cfg = _FakeConfig(timeout=5)
+    self.failUnlessEqual(self._Get(cfg), "node1.example.com")
+    self.failUnlessEqual(self.lookups, [5])
+
+    self.result = "other.example.com"
+    self.time.now += 3599
+    self.failUnlessEqual(self._Get(cfg), "node1.example.com")
+    self.failUnlessEqual(len(self.lookups), 1)
+
+    self.time.now += 1
+    self.failUnlessEqual(self._Get(cfg), "other.example.com")
+    self.failUnlessEqual(len(self.lookups), 2)
+
+  def testTimeout(self):
+    cfg = _FakeConfig()
+    self.result = None
+    self.failUnless(self._Get(cfg))
+    self.failUnlessEqual(len(self.lookups), 1)
+
+    # The short hostname is only used for a short time
+    self.result = "node1.example.com"
+    self._Get(cfg)
+    self.failUnlessEqual(len(self.lookups), 1)
+    self.time.now += node._HOSTNAME_FAILURE_TTL
+    self.failUnlessEqual(self._Get(cfg), "node1.example.com")
+    self.failUnlessEqual(len(self.lookups), 2)
+
+  def testNoCache(self):
+    cfg = _FakeConfig(ttl=0)
+    self._Get(cfg)
+    self._Get(cfg)
+    self.failUnlessEqual(len(self.lookups), 2)
+    self.failIf(os.listdir(self.tmpdir))
+
+  def testInvalidCache(self):
+    cfg = _FakeConfig()
+    self._Get(cfg)
+
+    for name in os.listdir(self.tmpdir):
+      fh = open(os.path.join(self.tmpdir, name), "w")
+      fh.write("garbage")
+      fh.close()
+
+    self.failUnlessEqual(self._Get(cfg), "node1.example.com")
+    self.failUnlessEqual(len(self.lookups), 2)
+
+  def testNoCacheDir(self):
+    shutil.rmtree(self.tmpdir)
+    self.failUnlessEqual(self._Get(_FakeConfig()), "node1.example.com")
+    os.mkdir(self.tmpdir)
+
+  def testResolve(self):
+    self.failUnless(node._ResolveHostname(10))
+
+  def testResolveSingleLookup(self):
+    release = threading.Event()
+    calls = []
+
+    def _SlowGetFqdn():
+      calls.append(None)
+      release.wait()
+      return "node1.example.com"
+
+    # A pending lookup is reused instead of starting more threads
+    for _ in range(3):
+      self.failUnlessEqual(node._ResolveHostname(0.01, _getfqdn=_SlowGetFqdn),
+                           None)
+    self.failUnlessEqual(len(calls), 1)
+
+    release.set()
+    self.failUnlessEqual(node._ResolveHostname(10, _getfqdn=_SlowGetFqdn),
+                         "node1.example.com")
+    self.failUnlessEqual(len(calls), 1)
+
+    # Finished lookups aren't reused
+    self.failUnlessEqual(node._ResolveHostname(10, _getfqdn=_SlowGetFqdn),
+                         "node1.example.com")
+    self.failUnlessEqual(len(calls), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -22,7 +22,9 @@
 """Script for unittesting the protocol module"""
 
 
+import os
 import unittest
+from cStringIO import StringIO
 
 from quicknx import constants
 from quicknx import errors
@@ -32,6 +34,119 @@ from quicknx import utils
 import mocks
 
 
+class _RecordingOutput(object):
+  def __init__(self):
+    self.written = []
+    self.data = ""
+
+  def write(self, data):
+    self.data += data
+
+  def flush(self):
+    if self.data:
+      self.written.append(self.data)
+    self.data = ""
+
+
+class TestNxServerBase(unittest.TestCase):
+  """Tests for NxServerBase"""
+
+  def _Run(self, lines, handler):
+    output = _RecordingOutput()
+    server = protocol.NxServerBase(StringIO("".join(lines)), output,
+                                   lambda line: handler(server, line))
+    server.Start()
+    return output.written
+
+  def testBatched(self):
+    def _Handler(server, line):
+      if line == "bye":
+        raise protocol.NxQuitServer()
+      for i in range(5):
+        server.Write(700 + i, message=line)
+
+    written = self._Run(["list\n", "bye\n"], _Handler)
+
+    # One write per read and one at the end
+    self.failUnlessEqual(written, [
+      "NX> 105 ",
+      "".join("NX> %d list\n" % (700 + i) for i in range(5)) +
+      "NX> 105 ",
+      "NX> 999 Bye.\n",
+      ])
+
+  def testFlush(self):
+    flushed = []
+
+    def _Handler(server, line):
+      server.WriteLine("Waiting")
+      server.Flush()
+      flushed.append(len(output.written))
+      server.Write(700, message="Done")
+
+    output = _RecordingOutput()
+    server = protocol.NxServerBase(StringIO("wait\n"), output,
+                                   lambda line: _Handler(server, line))
+    server.Start()
+
+    self.failUnlessEqual(flushed, [2])
+    self.failUnlessEqual(output.written, ["NX> 105 ", "Waiting\n",
+                                          "NX> 700 Done\nNX> 105 ",
+                                          "NX> 999 Bye.\n"])
+
+
+class TestReadTimeout(unittest.TestCase):
+  """Tests for NxServerBase.ReadLine with a read timeout"""
+
+  def setUp(self):
+    (read_fd, self.write_fd) = os.pipe()
+    self.input = os.fdopen(read_fd, "r")
+    self.output = _RecordingOutput()
+
+  def tearDown(self):
+    self.input.close()
+    if self.write_fd is not None:
+      os.close(self.write_fd)
+
+  def _GetServer(self, handler=None):
+    return protocol.NxServerBase(self.input, self.output,
+                                 handler or (lambda line: None),
+                                 read_timeout=0.2)
+
+  def testLines(self):
+    server = self._GetServer()
+    os.write(self.write_fd, b"hello\nworld\n")
+    self.failUnlessEqual(server.ReadLine(), "hello")
+    self.failUnlessEqual(server.ReadLine(), "world")
+
+  def testTimeout(self):
+    server = self._GetServer()
+    self.failUnlessRaises(protocol.NxReadTimeout, server.ReadLine)
+
+  def testPartialLine(self):
+    server = self._GetServer()
+    os.write(self.write_fd, b"hel")
+    self.failUnlessRaises(protocol.NxReadTimeout, server.ReadLine)
+
+  def testClosed(self):
+    server = self._GetServer()
+    os.write(self.write_fd, b"last")
+    os.close(self.write_fd)
+    self.write_fd = None
+    self.failUnlessEqual(server.ReadLine(), "last")
+    self.failUnlessRaises(protocol.NxQuitServer, server.ReadLine)
+
+  def testStart(self):
+    lines = []
+    server = self._GetServer(handler=lines.append)
+    os.write(self.write_fd, b"first\n")
+    server.Start()
+    self.failUnlessEqual(lines, ["first"])
+    self.failUnlessEqual(self.output.written[-1],
+                         "NX> 500 ERROR: No input received within 0.2"
+                         " seconds\nNX> 999 Bye.\n")
+
+
 class TestParseParameters(unittest.TestCase):
   """Tests for ParseParameters"""
 
@@ -48,26 +163,29 @@ class TestParseParameters(unittest.TestCase):
                           _logging=self._fake_logging)
 
   def test(self):
-    self._DoTest("", [])
-    self._DoTest(" ", [])
-    self._DoTest("\t", [])
-    self._DoTest("--session=\"\"", [("session", "")])
-    self._DoTest("--session=\"\" --name=\"\"", [("session", ""), ("name", "")])
-    self._DoTest("--session=\"123\"", [("session", "123")])
-    self._DoTest(" --session=\"123\"", [("session", "123")])
-    self._DoTest("--session=\"123\" ", [("session", "123")])
-    self._DoTest(" --session=\"123\" ", [("session", "123")])
+    self._DoTest("", {})
+    self._DoTest(" ", {})
+    self._DoTest("\t", {})
+    self._DoTest("--session=\"\"", {"session": ""})
+    self._DoTest("--session=\"\" --name=\"\"", {"session": "", "name": ""})
+    self._DoTest("--session=\"123\"", {"session": "123"})
+    self._DoTest(" --session=\"123\"", {"session": "123"})
+    self._DoTest("--session=\"123\" ", {"session": "123"})
+    self._DoTest(" --session=\"123\" ", {"session": "123"})
 
     self._DoTest("--session=\"123\" --name=\"dummy\"",
-                 [("session", "123"), ("name", "dummy")])
+                 {"session": "123", "name": "dummy"})
     self._DoTest(" --session=\"123\" --name=\"dummy\" ",
-                 [("session", "123"), ("name", "dummy")])
+                 {"session": "123", "name": "dummy"})
     self._DoTest("\t--session=\"123\"\t--name=\"dummy\"\n",
-                 [("session", "123"), ("name", "dummy")])
+                 {"session": "123", "name": "dummy"})
     self._DoTest("--session=\" value with spaces \" --name=\" a b\tc \"\n",
-                 [("session", " value with spaces "), ("name", " a b\tc ")])
+                 {"session": " value with spaces ", "name": " a b\tc "})
+    self._DoTest("--Session=\"123\"", {"Session": "123"})
+    self._DoTest("--a=\"1\"--b=\"2\"", {"a": "1", "b": "2"})
 
-    self._DoTest("--name=\"x\" --name=\"y\"", [("name", "x"), ("name", "y")])
+    # The last value wins
+    self._DoTest("--name=\"x\" --name=\"y\"", {"name": "y"})
 
     self._DoFailTest(",")
     self._DoFailTest("-")
@@ -81,6 +199,14 @@ class TestParseParameters(unittest.TestCase):
     self._DoFailTest("--xyz=\"\",--name=\"\"")
     self._DoFailTest("--xyz=\"\", --name=\"\"")
     self._DoFailTest("--xyz=\"\" , --name=\"\"")
+    self._DoFailTest("--9=\"\"")
+    self._DoFailTest("--xyz=\"\" x")
+
+  def testMany(self):
+    params = dict(("p%d" % i, "value %d" % i) for i in range(5000))
+    text = " ".join(["--%s=\"%s\"" % item for item in params.items()])
+    self._DoTest(text, params)
+    self._DoFailTest(text + " x")
 
 
 class TestUnquoteParameterValue(unittest.TestCase):
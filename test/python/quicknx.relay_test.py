@@ -0,0 +1,194 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+"""Script for unittesting the relay module"""
+
+
+import fcntl
+import os
+import pty
+import socket
+import tempfile
+import threading
+import unittest
+
+from quicknx import relay
+
+
+def _ReadAll(fd):
+  data = []
+  while True:
+    buf = os.read(fd, 4096)
+    if not buf:
+      break
+    data.append(buf)
+  return b"".join(data)
+
+
+class TestRelay(unittest.TestCase):
+  """Tests for Relay"""
+
+  def _TestSocketPairs(self, use_splice):
+    (client, relay_in) = socket.socketpair()
+    (relay_out, server) = socket.socketpair()
+
+    data = os.urandom(1024 * 1024)
+
+    def _Send():
+      client.sendall(data)
+      client.shutdown(socket.SHUT_WR)
+
+    sender = threading.Thread(target=_Send)
+    sender.start()
+
+    result = []
+
+    def _Receive():
+      result.append(_ReadAll(server.fileno()))
+
+    receiver = threading.Thread(target=_Receive)
+    receiver.start()
+
+    counts = relay.Relay([(relay_in.fileno(), relay_out.fileno())],
+                         use_splice=use_splice).Run()
+
+    # The relay doesn't close descriptors
+    relay_out.close()
+
+    sender.join()
+    receiver.join()
+
+    self.failUnlessEqual(counts, [len(data)])
+    self.failUnlessEqual(result, [data])
+
+    for sock in [client, relay_in, server]:
+      sock.close()
+
+  def testSocketPairs(self):
+    self._TestSocketPairs(False)
+
+  def testSocketPairsSplice(self):
+    if not relay.HaveSplice():
+      self.skipTest("splice(2) not available")
+    self._TestSocketPairs(True)
+
+  def testPty(self):
+    (master, slave) = pty.openpty()
+    out = tempfile.TemporaryFile()
+    try:
+      os.write(slave, b"Hello World\n")
+      os.close(slave)
+
+      for use_splice in [False, relay.HaveSplice()]:
+        relay.Relay([(master, out.fileno())], use_splice=use_splice).Run()
+    finally:
+      os.close(master)
+
+    out.seek(0)
+    self.failUnless(b"Hello World" in out.read())
+
+  def testRegularFile(self):
+    src = tempfile.TemporaryFile()
+    src.write(b"x" * 100000)
+    src.flush()
+    src.seek(0)
+
+    (relay_out, server) = socket.socketpair()
+    try:
+      counts = relay.Relay([(src.fileno(), relay_out.fileno())]).Run()
+      relay_out.close()
+      self.failUnlessEqual(counts, [100000])
+      self.failUnlessEqual(len(_ReadAll(server.fileno())), 100000)
+    finally:
+      server.close()
+
+  def testBlockingRestored(self):
+    (read_fd, write_fd) = os.pipe()
+    out = tempfile.TemporaryFile()
+    try:
+      os.write(write_fd, b"data")
+      os.close(write_fd)
+
+      relay.Relay([(read_fd, out.fileno())]).Run()
+
+      self.failIf(fcntl.fcntl(read_fd, fcntl.F_GETFL) & os.O_NONBLOCK)
+    finally:
+      os.close(read_fd)
+
+  def testDuplicateReader(self):
+    self.failUnlessRaises(ValueError, relay.Relay, [(0, 1), (0, 2)])
+
+
+class TestRunTcpProxy(unittest.TestCase):
+  """Tests for RunTcpProxy"""
+
+  def _Test(self, use_splice):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    received = []
+
+    def _Serve():
+      (conn, _) = listener.accept()
+      try:
+        # Wait for client to finish, then reply
+        received.append(_ReadAll(conn.fileno()))
+        conn.sendall(b"Reply " * 1000)
+      finally:
+        conn.close()
+
+    server = threading.Thread(target=_Serve)
+    server.start()
+
+    (client, proxy_in) = socket.socketpair()
+    (proxy_out, client_out) = socket.socketpair()
+    try:
+      client.sendall(b"Request " * 1000)
+      client.shutdown(socket.SHUT_WR)
+
+      (sent, recv) = relay.RunTcpProxy(listener.getsockname(),
+                                       proxy_in.fileno(), proxy_out.fileno(),
+                                       buffer_size=64 * 1024,
+                                       use_splice=use_splice)
+      proxy_out.close()
+
+      server.join()
+
+      self.failUnlessEqual(received, [b"Request " * 1000])
+      self.failUnlessEqual(_ReadAll(client_out.fileno()), b"Reply " * 1000)
+      self.failUnlessEqual((sent, recv), (8000, 6000))
+    finally:
+      for sock in [listener, client, proxy_in, client_out]:
+        sock.close()
+
+  def testReadWrite(self):
+    self._Test(False)
+
+  def testSplice(self):
+    if not relay.HaveSplice():
+      self.skipTest("splice(2) not available")
+    self._Test(True)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -150,6 +150,19 @@ class TestNxSessionManager(unittest.TestCase):
     self.failUnlessEqual(result[1].state, constants.SESS_STATE_RUNNING)
     self.failIf(set([result[0].id, result[1].id]) - set([sess1.id, sess3.id]))
 
+  def testIterSessionsWithFilter(self):
+    (sess1, _, _, _) = self._CreateSession("localhost", 1, "user_a")
+    (sess2, _, _, _) = self._CreateSession("localhost", 2, "user_a")
+    self._CreateSession("localhost", 3, "user_b")
+
+    result = self.mgr.IterSessionsWithFilter("user_a", None)
+    self.failIf(isinstance(result, list))
+    self.failUnlessEqual(sorted(sess.id for sess in result),
+                         sorted([sess1.id, sess2.id]))
+
+    result = self.mgr.IterSessionsWithFilter(None, self._FilterTypeUnixKde)
+    self.failUnlessEqual(list(result), [])
+
   @staticmethod
   def _FilterTypeUnixKde(sess):
     return sess.type == "unix-kde"
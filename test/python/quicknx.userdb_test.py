@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+
+# Copyright (C) 2009 Google Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+
+
+"""Script for unittesting the userdb module"""
+
+
+import os
+import pwd
+import shutil
+import tempfile
+import unittest
+
+from quicknx import userdb
+
+
+class _FakeTime(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def time(self):
+    return self.now
+
+
+class TestGetUserProfile(unittest.TestCase):
+  """Tests for GetUserProfile"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.time = _FakeTime()
+    self.lookups = []
+    self.shell = "/bin/sh"
+    userdb._profiles.clear()
+
+  def tearDown(self):
+    userdb._profiles.clear()
+    shutil.rmtree(self.tmpdir)
+
+  def _Lookup(self, username):
+    self.lookups.append(username)
+    return userdb.UserProfile(username, 1000, 100, "/home/%s" % username,
+                              self.shell, "de_CH.UTF-8")
+
+  def _Get(self, username, ttl):
+    return userdb.GetUserProfile(username, ttl=ttl, _cache_dir=self.tmpdir,
+                                 _lookup_fn=self._Lookup, _time=self.time)
+
+  def testInProcess(self):
+    profile = self._Get("user1", 0)
+    self.failUnlessEqual(profile.homedir, "/home/user1")
+    self.failUnless(self._Get("user1", 0) is profile)
+    self.failUnlessEqual(self.lookups, ["user1"])
+    self.failIf(os.listdir(self.tmpdir))
+
+  def testCacheFile(self):
+    profile = self._Get("user1", 300)
+    self._Get("user2", 300)
+    self.failUnlessEqual(self.lookups, ["user1", "user2"])
+
+    # New process
+    userdb._profiles.clear()
+    self.time.now += 299
+    cached = self._Get("user1", 300)
+    self.failUnlessEqual(cached.Serialize(), profile.Serialize())
+    self._Get("user2", 300)
+    self.failUnlessEqual(len(self.lookups), 2)
+
+  def testExpired(self):
+    self._Get("user1", 300)
+
+    userdb._profiles.clear()
+    self.shell = "/bin/bash"
+    self.time.now += 300
+    self.failUnlessEqual(self._Get("user1", 300).shell, "/bin/bash")
+    self.failUnlessEqual(len(self.lookups), 2)
+
+  def testInvalidCache(self):
+    self._Get("user1", 300)
+
+    for name in os.listdir(self.tmpdir):
+      fh = open(os.path.join(self.tmpdir, name), "w")
+      fh.write("[1, 2]")
+      fh.close()
+
+    userdb._profiles.clear()
+    self.failUnlessEqual(self._Get("user1", 300).uid, 1000)
+    self.failUnlessEqual(len(self.lookups), 2)
+
+  def testCurrentUser(self):
+    pw = pwd.getpwuid(os.getuid())
+    profile = userdb.GetUserProfile(pw.pw_name)
+    self.failUnlessEqual(profile.uid, pw.pw_uid)
+    self.failUnlessEqual(profile.homedir, pw.pw_dir)
+    self.failUnlessEqual(profile.shell, pw.pw_shell)
+
+  def testUnknownUser(self):
+    self.failUnlessRaises(KeyError, userdb.GetUserProfile,
+                          "no-such-user-quicknx")
+
+
+class TestReadLanguage(unittest.TestCase):
+  """Tests for reading the language from ~/.dmrc"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _Write(self, text):
+    fh = open(os.path.join(self.tmpdir, ".dmrc"), "w")
+    try:
+      fh.write(text)
+    finally:
+      fh.close()
+
+  def testLanguage(self):
+    self._Write("[Desktop]\nSession=gnome\nLanguage=de_CH.UTF-8\n")
+    self.failUnlessEqual(userdb._ReadLanguage(self.tmpdir), "de_CH.UTF-8")
+
+  def testNoLanguage(self):
+    self._Write("[Desktop]\nSession=gnome\n")
+    self.failUnlessEqual(userdb._ReadLanguage(self.tmpdir), None)
+
+  def testMissing(self):
+    self.failUnlessEqual(userdb._ReadLanguage(self.tmpdir), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
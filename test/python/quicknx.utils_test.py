@@ -23,13 +23,17 @@
 
 
 import fcntl
+import logging
 import os
 import shutil
+import socket
+import sys
 import tempfile
 import unittest
 from cStringIO import StringIO
 
 from quicknx import constants
+from quicknx import errors
 from quicknx import utils
 
 import mocks
@@ -198,6 +202,171 @@ class TestSetCloseOnExecFlag(unittest.TestCase):
                 fcntl.FD_CLOEXEC)
 
 
+class TestCloseFds(unittest.TestCase):
+  """Tests for CloseFds"""
+
+  def _Test(self, **kwargs):
+    (read_fd, write_fd) = os.pipe()
+    others = [os.dup(read_fd) for _ in range(3)]
+
+    pid = os.fork()
+    if pid == 0:
+      try:
+        utils.CloseFds(keep=[write_fd, others[1]], **kwargs)
+
+        result = []
+        for fd in [0, 1, 2, read_fd] + others:
+          try:
+            fcntl.fcntl(fd, fcntl.F_GETFD)
+          except EnvironmentError:
+            continue
+          result.append(fd)
+
+        os.write(write_fd, repr(result).encode("ascii"))
+      finally:
+        os._exit(0)
+
+    os.close(write_fd)
+    try:
+      data = os.read(read_fd, 1024)
+      os.waitpid(pid, 0)
+    finally:
+      os.close(read_fd)
+      for fd in others:
+        os.close(fd)
+
+    self.failUnlessEqual(data.decode("ascii"), repr([others[1]]))
+
+  def testProcFd(self):
+    self._Test()
+
+  def testCloseRange(self):
+    self._Test(_have_close_range=True, _proc_fd_dir="/does/not/exist")
+
+  def testAll(self):
+    self._Test(_have_close_range=False, _proc_fd_dir="/does/not/exist")
+
+
+class TestAsyncSyslogHandler(unittest.TestCase):
+  """Tests for AsyncSyslogHandler"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.address = os.path.join(self.tmpdir, "log")
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.sock.bind(self.address)
+    self.sock.settimeout(5)
+
+  def tearDown(self):
+    self.sock.close()
+    shutil.rmtree(self.tmpdir)
+
+  def _Log(self, handler, level, msg, exc_info=None):
+    record = logging.LogRecord("test", level, __file__, 1, msg, None,
+                               exc_info)
+    handler.handle(record)
+
+  def testSend(self):
+    handler = utils.AsyncSyslogHandler("tester", address=self.address)
+    try:
+      self._Log(handler, logging.ERROR, "Hello World")
+      self._Log(handler, logging.DEBUG, "Second")
+      handler.flush()
+    finally:
+      handler.close()
+
+    first = self.sock.recv(1024).decode("utf-8")
+    self.failUnless(first.startswith("<11>"))
+    self.failUnless(first.endswith(" tester[%d]: Hello World" % os.getpid()))
+    self.failUnless(self.sock.recv(1024).decode("utf-8").startswith("<15>"))
+    self.failUnlessEqual(handler.dropped, 0)
+
+  def testException(self):
+    handler = utils.AsyncSyslogHandler("tester", address=self.address)
+    handler.setFormatter(logging.Formatter())
+    try:
+      try:
+        raise Exception("Failure")
+      except Exception:
+        self._Log(handler, logging.ERROR, "Error", exc_info=sys.exc_info())
+      handler.flush()
+    finally:
+      handler.close()
+
+    messages = []
+    self.sock.setblocking(False)
+    while True:
+      try:
+        messages.append(self.sock.recv(1024).decode("utf-8"))
+      except EnvironmentError:
+        break
+
+    self.failUnless(len(messages) > 2)
+    self.failUnless(messages[0].endswith(": Error"))
+    self.failUnless(messages[-1].endswith(": Exception: Failure"))
+
+  def testFlush(self):
+    handler = utils.AsyncSyslogHandler("tester", address=self.address)
+    try:
+      # Stays below the socket's default queue length
+      for i in range(8):
+        self._Log(handler, logging.INFO, "Message %d" % i)
+      handler.flush()
+
+      self.sock.setblocking(False)
+      received = 0
+      while True:
+        try:
+          self.sock.recv(1024)
+        except EnvironmentError:
+          break
+        received += 1
+    finally:
+      handler.close()
+
+    self.failUnlessEqual(received, 8)
+
+  def testForkedChild(self):
+    handler = utils.AsyncSyslogHandler("tester", address=self.address)
+    try:
+      self._Log(handler, logging.INFO, "Parent")
+      handler.flush()
+
+      pid = os.fork()
+      if pid == 0:
+        try:
+          self._Log(handler, logging.INFO, "Child")
+          handler.flush()
+        finally:
+          os._exit(0)
+
+      os.waitpid(pid, 0)
+    finally:
+      handler.close()
+
+    self.failUnless(self.sock.recv(1024).endswith(b": Parent"))
+    message = self.sock.recv(1024)
+    self.failUnless(message.endswith(b": Child"))
+    self.failUnless((b"tester[%d]" % pid) in message)
+
+  def testQueueFull(self):
+    handler = utils.AsyncSyslogHandler("tester", address=self.address,
+                                       max_queued=3, _start=False)
+    for i in range(5):
+      self._Log(handler, logging.INFO, "Message %d" % i)
+    self.failUnlessEqual(handler.dropped, 2)
+
+  def testNoSyslog(self):
+    handler = utils.AsyncSyslogHandler("tester",
+                                       address=self.address + ".missing")
+    try:
+      self._Log(handler, logging.INFO, "Lost")
+      handler.flush()
+    finally:
+      handler.close()
+    self.failUnlessEqual(handler.dropped, 1)
+
+
 class TestListVisibleFiles(unittest.TestCase):
   """Test case for ListVisibleFiles"""
 
@@ -240,6 +409,40 @@ class TestListVisibleFiles(unittest.TestCase):
     self._test(files, expected)
 
 
+class TestReadOwnFile(unittest.TestCase):
+  """Tests for ReadOwnFile"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, "file")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _Write(self, data, mode):
+    utils.WriteFile(self.path, data=data, mode=mode)
+
+  def testRead(self):
+    self._Write("Hello World", 0o600)
+    self.failUnlessEqual(utils.ReadOwnFile(self.path), b"Hello World")
+
+  def testMissing(self):
+    self.failUnlessEqual(utils.ReadOwnFile(self.path), None)
+
+  def testWritable(self):
+    self._Write("data", 0o600)
+    os.chmod(self.path, 0o620)
+    self.failUnlessEqual(utils.ReadOwnFile(self.path), None)
+    os.chmod(self.path, 0o602)
+    self.failUnlessEqual(utils.ReadOwnFile(self.path), None)
+
+  def testSymlink(self):
+    target = os.path.join(self.tmpdir, "target")
+    utils.WriteFile(target, data="data", mode=0o600)
+    os.symlink(target, self.path)
+    self.failUnlessEqual(utils.ReadOwnFile(self.path), None)
+
+
 class TestFormatTable(unittest.TestCase):
   """Tests for FormatTable"""
 
@@ -300,6 +503,27 @@ class TestFormatTable(unittest.TestCase):
     # No data and no columns
     self.failUnlessEqual(utils.FormatTable([], []), ["", ""])
 
+  def testIterTable(self):
+    consumed = []
+
+    def _Data():
+      for i in range(1, 4):
+        consumed.append(i)
+        yield i
+
+    columns = [
+      ("col1", 5, lambda i: str(i)),
+      ("col2", 8, lambda i: "%04x" % (2 ** i)),
+      ]
+
+    rows = utils.IterTable(_Data(), columns)
+    self.failUnlessEqual(next(rows), "col1  col2")
+    self.failUnlessEqual(next(rows), "----- --------")
+    self.failUnlessEqual(consumed, [])
+    self.failUnlessEqual(next(rows), "1     0002")
+    self.failUnlessEqual(consumed, [1])
+    self.failUnlessEqual(list(rows), ["2     0004", "3     0008"])
+
 
 class _RetryTestHelper(object):
   def __init__(self, want):
@@ -348,6 +572,131 @@ class TestRetry(unittest.TestCase):
         self.failUnlessEqual(obj.calls, calls - 1)
 
 
+class TestSlotSemaphore(unittest.TestCase):
+  """Tests for SlotSemaphore"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test(self):
+    sems = [utils.SlotSemaphore(self.tmpdir, "test", 2) for _ in range(3)]
+
+    self.failUnless(sems[0].TryAcquire())
+    self.failUnless(sems[1].TryAcquire())
+    self.failIf(sems[2].TryAcquire())
+
+    # Other names use other slots
+    other = utils.SlotSemaphore(self.tmpdir, "other", 1)
+    self.failUnless(other.TryAcquire())
+    other.Release()
+
+    sems[0].Release()
+    self.failUnless(sems[2].TryAcquire())
+    self.failIf(sems[0].TryAcquire())
+
+    for sem in sems:
+      sem.Release()
+
+    self.failUnlessEqual(sorted(os.listdir(self.tmpdir)),
+                         ["other-0.lock", "test-0.lock", "test-1.lock"])
+
+
+class TestTicketQueue(unittest.TestCase):
+  """Tests for TicketQueue"""
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test(self):
+    queues = [utils.TicketQueue(self.tmpdir, "test", 3) for _ in range(4)]
+
+    self.failUnless(queues[0].IsEmpty())
+
+    for queue in queues[:3]:
+      self.failUnless(queue.TryEnter())
+    self.failIf(queues[3].TryEnter())
+
+    self.failIf(queues[3].IsEmpty())
+    self.failUnless(queues[0].IsFirst())
+    self.failIf(queues[1].IsFirst())
+    self.failIf(queues[2].IsFirst())
+
+    queues[0].Leave()
+    self.failUnless(queues[1].IsFirst())
+    self.failIf(queues[2].IsFirst())
+
+    # Re-entering puts a waiter at the end
+    self.failUnless(queues[0].TryEnter())
+    self.failIf(queues[0].IsFirst())
+
+    queues[1].Leave()
+    queues[2].Leave()
+    self.failUnless(queues[0].IsFirst())
+
+    queues[0].Leave()
+    self.failUnless(queues[3].IsEmpty())
+
+  def testCrashed(self):
+    (first, second) = [utils.TicketQueue(self.tmpdir, "test", 2)
+                       for _ in range(2)]
+    self.failUnless(first.TryEnter())
+    self.failUnless(second.TryEnter())
+    self.failIf(second.IsFirst())
+
+    # Only the lock is released, the ticket stays in the slot file
+    first._slots.Release()
+    self.failUnless(second.IsFirst())
+
+
+class TestWaitForChild(unittest.TestCase):
+  """Tests for WaitForChild"""
+
+  def _Start(self, read_fd, write_fd):
+    pid = os.fork()
+    if pid == 0:
+      try:
+        # Exit once the pipe is closed
+        os.close(write_fd)
+        os.read(read_fd, 1)
+      finally:
+        os._exit(0)
+    return pid
+
+  def _Test(self, use_pidfd):
+    (read_fd, write_fd) = os.pipe()
+    try:
+      pid = self._Start(read_fd, write_fd)
+      os.close(read_fd)
+
+      self.failIf(utils.WaitForChild(pid, timeout=0.1, _use_pidfd=use_pidfd))
+    finally:
+      os.close(write_fd)
+
+    self.failUnless(utils.WaitForChild(pid, timeout=30.0,
+                                       _use_pidfd=use_pidfd))
+
+    # The child must not have been reaped
+    (waited_pid, status) = os.waitpid(pid, 0)
+    self.failUnlessEqual(waited_pid, pid)
+    self.failUnless(os.WIFEXITED(status))
+    self.failUnlessEqual(os.WEXITSTATUS(status), 0)
+
+    # Already reaped
+    self.failUnless(utils.WaitForChild(pid, _use_pidfd=use_pidfd))
+
+  def testPidfd(self):
+    self._Test(True)
+
+  def testPoll(self):
+    self._Test(False)
+
+
 class TestShellQuoting(unittest.TestCase):
   """Test case for shell quoting functions"""
 
@@ -400,5 +749,93 @@ class TestGetSignalName(unittest.TestCase):
                      utils.GetSignalName(999, _signal=fake_signal))
 
 
+class TestStepGraph(unittest.TestCase):
+  """Tests for StepGraph"""
+
+  def setUp(self):
+    self.faketime = mocks.FakeTime()
+    self.calls = []
+    self.done = []
+    self.graph = utils.StepGraph(done_fn=lambda: self.done.append(True),
+                                 _time=self.faketime)
+
+  def _Step(self, name, duration=0):
+    def fn():
+      self.calls.append(name)
+      self.faketime.AddSeconds(duration)
+    return fn
+
+  def testOverlap(self):
+    graph = self.graph
+    graph.AddStep("xauth", self._Step("xauth"), wait=True)
+    graph.AddStep("options", self._Step("options", 1))
+    graph.AddStep("agent", self._Step("agent"), deps=["xauth", "options"])
+    graph.AddStep("xrdb", self._Step("xrdb"), deps=["agent"], wait=True)
+    graph.AddStep("app", self._Step("app"), deps=["agent"])
+
+    graph.Start()
+    self.failUnlessEqual(self.calls, ["xauth", "options"])
+    self.failIf(self.done)
+
+    self.faketime.AddSeconds(2)
+    graph.Finish("xauth")
+    self.failUnlessEqual(self.calls, ["xauth", "options", "agent", "xrdb",
+                                      "app"])
+    self.failIf(self.done)
+
+    self.faketime.AddSeconds(5)
+    graph.Finish("xrdb")
+    self.failUnlessEqual(self.done, [True])
+
+    self.failUnlessEqual(graph.GetTimings(), [
+      ("xauth", 0.0, 3.0),
+      ("options", 0.0, 1.0),
+      ("agent", 3.0, 3.0),
+      ("xrdb", 3.0, 8.0),
+      ("app", 3.0, 3.0),
+      ])
+    self.failUnlessEqual(graph.GetCriticalPath(), ["xauth", "agent", "xrdb"])
+
+  def testUnknownDependency(self):
+    self.graph.AddStep("a", self._Step("a"), deps=["b"])
+    self.failUnlessRaises(errors.ProgrammerError, self.graph.Start)
+    self.failIf(self.calls)
+
+  def testDuplicateStep(self):
+    self.graph.AddStep("a", self._Step("a"))
+    self.failUnlessRaises(errors.ProgrammerError, self.graph.AddStep,
+                          "a", self._Step("a"))
+
+
+class TestLazyModule(unittest.TestCase):
+  """Tests for LazyModule"""
+
+  def test(self):
+    module = utils.LazyModule("os.path")
+    self.failUnless("not loaded" in repr(module))
+    self.failUnlessEqual(module.join("a", "b"), os.path.join("a", "b"))
+    self.failIf("not loaded" in repr(module))
+
+  def testMissing(self):
+    # Errors only show up on first use
+    module = utils.LazyModule("quicknx.does_not_exist")
+    self.failUnlessRaises(ImportError, getattr, module, "foo")
+
+
+class TestProfileImports(unittest.TestCase):
+  """Tests for ProfileImports"""
+
+  def test(self):
+    profile = utils.ProfileImports("quicknx.errors")
+    names = [name for (name, _, _) in profile]
+    self.failUnless("quicknx.errors" in names)
+    for (_, own, total) in profile:
+      self.failUnless(0 <= own <= total)
+
+  def testError(self):
+    self.failUnlessRaises(errors.GenericError, utils.ProfileImports,
+                          "quicknx.does_not_exist")
+
+
 if __name__ == '__main__':
   unittest.main()